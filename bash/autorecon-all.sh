@@ -55,5 +55,6 @@ cd $SUBJECTS_DIR
 cp $2/scripts/recon-all.log $WD
 tar cjf $WD/$1_output.tar.bz2 *
 cd $WD
+sha1sum $1_output.tar.bz2 > $1_output.tar.bz2.sha1
 
 exit $exitcode
@@ -73,7 +73,11 @@ fi
 
 cd ${SUBJECTS_DIR}
 mv $subject/scripts/recon-all.log $subject/scripts/recon-all-step1.log
-tar cJf ${WD}/${subject}_recon1_output.tar.xz *
+# write the scripts directory first so the logs can be read without
+# decompressing the whole archive
+{ find $subject/scripts; find * -path $subject/scripts -prune -o -print; } | \
+    tar cJf ${WD}/${subject}_recon1_output.tar.xz --no-recursion -T -
 cd ${WD}
+sha1sum ${subject}_recon1_output.tar.xz > ${subject}_recon1_output.tar.xz.sha1
 
 exit $exitcode
\ No newline at end of file
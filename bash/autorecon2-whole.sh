@@ -23,6 +23,10 @@ else
     # OSG_WN_TMP doesn't exist or isn't defined
     SUBJECTS_DIR=`mktemp -d --tmpdir=$PWD`
 fi
+if [ -e $2_recon1_output.tar.xz.sha1 ];
+then
+    sha1sum -c $2_recon1_output.tar.xz.sha1 || exit 1
+fi
 cp $2_recon1_output.tar.xz $SUBJECTS_DIR
 cd $SUBJECTS_DIR
 tar xvaf $2_recon1_output.tar.xz
@@ -47,6 +51,10 @@ then
 fi
 cd $SUBJECTS_DIR
 mv $2/scripts/recon-all.log $2/scripts/recon-all-step2.log
-tar cJf $WD/$2_recon2_output.tar.xz *
+# write the scripts directory first so the logs can be read without
+# decompressing the whole archive
+{ find $2/scripts; find * -path $2/scripts -prune -o -print; } | \
+    tar cJf $WD/$2_recon2_output.tar.xz --no-recursion -T -
 cd $WD
+sha1sum $2_recon2_output.tar.xz > $2_recon2_output.tar.xz.sha1
 exit $exitcode
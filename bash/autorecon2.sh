@@ -25,6 +25,10 @@ else
     SUBJECTS_DIR=`mktemp -d --tmpdir=$PWD`
 fi
 
+if [ -e $2_recon1_output.tar.xz.sha1 ];
+then
+    sha1sum -c $2_recon1_output.tar.xz.sha1 || exit 1
+fi
 cp $2_recon1_output.tar.xz $SUBJECTS_DIR
 cd $SUBJECTS_DIR
 tar xvaf $2_recon1_output.tar.xz
@@ -50,6 +54,10 @@ then
 fi
 cd $SUBJECTS_DIR
 mv $2/scripts/recon-all.log $2/scripts/recon-all-step2-$3.log
-tar cJf $WD/$2_recon2_$3_output.tar.xz *
+# write the scripts directory first so the logs can be read without
+# decompressing the whole archive
+{ find $2/scripts; find * -path $2/scripts -prune -o -print; } | \
+    tar cJf $WD/$2_recon2_$3_output.tar.xz --no-recursion -T -
 cd $WD
+sha1sum $2_recon2_$3_output.tar.xz > $2_recon2_$3_output.tar.xz.sha1
 exit $exitcode
\ No newline at end of file
@@ -23,6 +23,13 @@ else
     # OSG_WN_TMP doesn't exist or isn't defined
     SUBJECTS_DIR=`mktemp -d --tmpdir=$PWD`
 fi
+for manifest in $2_recon2_*.tar.xz.sha1;
+do
+    if [ -e "$manifest" ];
+    then
+        sha1sum -c $manifest || exit 1
+    fi
+done
 cp $2_recon2_*.tar.xz $SUBJECTS_DIR
 cd $SUBJECTS_DIR
 if [ -e "$2_recon2_lh_output.tar.xz" ];
@@ -59,4 +66,5 @@ rm fsaverage lh.EC_average rh.EC_average
 tar cjf $WD/$2_output.tar.bz2 *
 cp $2/scripts/recon-all.log $WD
 cd $WD
+sha1sum $2_output.tar.bz2 > $2_output.tar.bz2.sha1
 exit $exitcode
\ No newline at end of file
@@ -69,6 +69,7 @@ then
   exitcode=1
 fi
 cd $WD
-sha1sum $WD/${subject}_output.tar.bz2
+sha1sum ${subject}_output.tar.bz2 > ${subject}_output.tar.bz2.sha1
+cat ${subject}_output.tar.bz2.sha1
 exit $exitcode
 
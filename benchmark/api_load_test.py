@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+
+# Load test for the fsurf REST API, starts a throwaway postgres cluster,
+# loads the schema, seeds users and jobs and then drives the flask app
+# with concurrent clients that follow the call patterns used by fsurf
+
+import argparse
+import hashlib
+import httplib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+import psycopg2
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SCHEMA_FILE = os.path.join(REPO_DIR, 'postgresql', 'schema.sql')
+WSGI_DIR = os.path.join(REPO_DIR, 'wsgi')
+
+USER_PASSWORD = 'loadtest'
+DB_NAME = 'fsurf_load'
+DB_USER = 'fsurf'
+# relative weights for the operations done by each simulated client
+DEFAULT_MIX = 'list:40,status:40,submit:5,output:15'
+# states assigned to seeded jobs and the weight given to each one
+JOB_STATES = (('COMPLETED', 60), ('DELETED', 20), ('FAILED', 10),
+              ('RUNNING', 5), ('QUEUED', 5))
+# number of job ids per user kept around to use in status/output requests
+SAMPLE_JOBS = 50
+PERCENTILES = (50, 99)
+
+
+def start_postgres(pg_bin, work_dir, port, max_connections):
+    """
+    Create and start a throwaway postgres cluster
+
+    :param pg_bin: directory with the postgres binaries
+    :param work_dir: directory to place the cluster in
+    :param port: port for postgres to listen on
+    :param max_connections: max_connections setting for the cluster
+    :return: path to cluster data directory
+    """
+    data_dir = os.path.join(work_dir, 'pgdata')
+    log_file = os.path.join(work_dir, 'postgres.log')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([os.path.join(pg_bin, 'initdb'),
+                               '-D', data_dir,
+                               '-U', DB_USER,
+                               '-A', 'trust',
+                               '-E', 'UTF8'],
+                              stdout=devnull)
+        options = "-p {0} -k {1} -c listen_addresses=127.0.0.1 " \
+                  "-c max_connections={2} -c fsync=off " \
+                  "-c synchronous_commit=off".format(port,
+                                                     work_dir,
+                                                     max_connections)
+        subprocess.check_call([os.path.join(pg_bin, 'pg_ctl'),
+                               '-D', data_dir,
+                               '-l', log_file,
+                               '-o', options,
+                               '-w', 'start'],
+                              stdout=devnull)
+    return data_dir
+
+
+def stop_postgres(pg_bin, data_dir):
+    """
+    Stop a postgres cluster started by start_postgres
+
+    :param pg_bin: directory with the postgres binaries
+    :param data_dir: path to cluster data directory
+    :return: None
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([os.path.join(pg_bin, 'pg_ctl'),
+                         '-D', data_dir,
+                         '-m', 'fast',
+                         '-w', 'stop'],
+                        stdout=devnull)
+
+
+def create_database(db_params):
+    """
+    Create the database used for the load test and load the schema
+    into it
+
+    :param db_params: dictionary with connection parameters
+    :return: None
+    """
+    params = dict(db_params)
+    params['database'] = 'postgres'
+    conn = psycopg2.connect(**params)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("CREATE DATABASE {0}".format(db_params['database']))
+    conn.close()
+    conn = psycopg2.connect(**db_params)
+    cursor = conn.cursor()
+    with open(SCHEMA_FILE) as schema:
+        cursor.execute(schema.read())
+    conn.commit()
+    conn.close()
+
+
+def seed_database(db_params, num_users, num_jobs):
+    """
+    Populate the database with users, jobs, job runs and input files
+
+    :param db_params: dictionary with connection parameters
+    :param num_users: number of users to create
+    :param num_jobs: number of jobs to create
+    :return: dictionary mapping usernames to a tuple of lists with
+             sample job ids and sample completed jobs (id, subject)
+    """
+    conn = psycopg2.connect(**db_params)
+    cursor = conn.cursor()
+    user_insert = "INSERT INTO freesurfer_interface.users(username," \
+                  "                                       first_name," \
+                  "                                       last_name," \
+                  "                                       email," \
+                  "                                       institution," \
+                  "                                       phone," \
+                  "                                       password," \
+                  "                                       salt) " \
+                  "VALUES(%s, 'Load', 'Test', %s, 'None', 'None', %s, %s)"
+    users = []
+    for i in range(num_users):
+        username = "loaduser{0}".format(i)
+        salt = hashlib.sha256(os.urandom(32)).hexdigest()
+        password = hashlib.sha256(salt + USER_PASSWORD).hexdigest()
+        cursor.execute(user_insert,
+                       [username, username + '@example.com', password, salt])
+        users.append(username)
+
+    # pick job states using cumulative weights on random()
+    total = float(sum(weight for _, weight in JOB_STATES))
+    state_expr = "CASE "
+    running = 0
+    for state, weight in JOB_STATES[:-1]:
+        running += weight
+        state_expr += "WHEN r < {0} THEN '{1}' ".format(running / total, state)
+    state_expr += "ELSE '{0}' END".format(JOB_STATES[-1][0])
+    job_insert = "INSERT INTO freesurfer_interface.jobs(name," \
+                 "                                      username," \
+                 "                                      subject," \
+                 "                                      multicore," \
+                 "                                      state," \
+                 "                                      job_date," \
+                 "                                      options," \
+                 "                                      purged," \
+                 "                                      num_inputs," \
+                 "                                      version) " \
+                 "SELECT 'subject_' || i, " \
+                 "       'loaduser' || (i %% %s), " \
+                 "       'subject_' || i, " \
+                 "       i %% 4 <> 0, " \
+                 "       (" + state_expr + ")::freesurfer_interface.job_state, " \
+                 "       now() - random() * interval '90 days', " \
+                 "       'None', " \
+                 "       FALSE, " \
+                 "       1, " \
+                 "       '5.3.0' " \
+                 "FROM (SELECT i, random() AS r " \
+                 "      FROM generate_series(1, %s) AS i) AS seed"
+    cursor.execute(job_insert, [num_users, num_jobs])
+    run_insert = "INSERT INTO freesurfer_interface.job_run(job_id," \
+                 "                                         pegasus_ts," \
+                 "                                         walltime," \
+                 "                                         cputime," \
+                 "                                         started," \
+                 "                                         ended," \
+                 "                                         tasks," \
+                 "                                         tasks_completed) " \
+                 "SELECT id, " \
+                 "       to_char(job_date, 'YYYYMMDD\"T\"HH24MISS-0000'), " \
+                 "       36000, " \
+                 "       72000, " \
+                 "       job_date + interval '5 minutes', " \
+                 "       job_date + interval '10 hours', " \
+                 "       30, " \
+                 "       CASE WHEN state = 'RUNNING' THEN 10 ELSE 30 END " \
+                 "FROM freesurfer_interface.jobs " \
+                 "WHERE state <> 'QUEUED'"
+    cursor.execute(run_insert)
+    input_insert = "INSERT INTO freesurfer_interface.input_files(filename," \
+                   "                                             path," \
+                   "                                             job_id," \
+                   "                                             purged," \
+                   "                                             subject_dir) " \
+                   "SELECT subject || '_defaced.mgz', " \
+                   "       '/dev/null', " \
+                   "       id, " \
+                   "       state IN ('COMPLETED', 'DELETED'), " \
+                   "       FALSE " \
+                   "FROM freesurfer_interface.jobs"
+    cursor.execute(input_insert)
+    conn.commit()
+    cursor.execute("ANALYZE")
+
+    sample_query = "SELECT id, subject, state " \
+                   "FROM freesurfer_interface.jobs " \
+                   "WHERE username = %s " \
+                   "ORDER BY random() " \
+                   "LIMIT %s"
+    samples = {}
+    for username in users:
+        cursor.execute(sample_query, [username, SAMPLE_JOBS])
+        job_ids = []
+        completed = []
+        for row in cursor.fetchall():
+            job_ids.append(row[0])
+            if row[2] == 'COMPLETED':
+                completed.append((row[0], row[1]))
+        samples[username] = (job_ids, completed)
+    conn.close()
+    return samples
+
+
+def create_outputs(base_dir, samples, output_size):
+    """
+    Create dummy output tarballs for the sampled completed jobs
+
+    :param base_dir: directory used as FREESURFER_BASE by the app
+    :param samples: dictionary returned by seed_database
+    :param output_size: size in bytes of each output file
+    :return: None
+    """
+    chunk = os.urandom(min(output_size, 1024 * 1024))
+    for username, (_, completed) in samples.iteritems():
+        result_dir = os.path.join(base_dir, username, 'results')
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        for job_id, subject in completed:
+            output_file = os.path.join(result_dir,
+                                       "{0}_{1}_output.tar.bz2".format(job_id,
+                                                                       subject))
+            with open(output_file, 'wb') as fh:
+                remaining = output_size
+                while remaining > 0:
+                    fh.write(chunk[:remaining])
+                    remaining -= len(chunk)
+
+
+def write_app_config(work_dir, db_params):
+    """
+    Write a flask config file for the app
+
+    :param work_dir: directory to place config file in
+    :param db_params: dictionary with connection parameters
+    :return: path to config file
+    """
+    config_file = os.path.join(work_dir, 'fsurf-load.config')
+    with open(config_file, 'w') as fh:
+        fh.write("DB_NAME = {0!r}\n".format(db_params['database']))
+        fh.write("DB_USER = {0!r}\n".format(db_params['user']))
+        fh.write("DB_HOST = {0!r}\n".format(db_params['host']))
+        fh.write("DB_PASSWD = {0!r}\n".format(db_params['password']))
+    return config_file
+
+
+def start_app(config_file, base_dir, port):
+    """
+    Import the flask app and serve it from a background thread using
+    the threaded werkzeug server
+
+    :param config_file: path to flask config file
+    :param base_dir: directory to use as FREESURFER_BASE
+    :param port: port to listen on, 0 picks a free port
+    :return: (server, module with the app)
+    """
+    from werkzeug.serving import make_server
+    os.environ['FSURF_CONFIG_FILE'] = config_file
+    sys.path.insert(0, WSGI_DIR)
+    import freesurfer_interface
+    freesurfer_interface.FREESURFER_BASE = base_dir
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, freesurfer_interface.app,
+                         threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server, freesurfer_interface
+
+
+class Results(object):
+    """
+    Latencies and errors collected by the client threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, elapsed, ok):
+        """
+        Record the outcome of a request
+
+        :param name: name of the operation or request
+        :param elapsed: time in seconds taken
+        :param ok: True if the request succeeded
+        :return: None
+        """
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class LoadClient(object):
+    """
+    Simulated fsurf user, each operation reproduces the requests that
+    the matching fsurf command makes
+    """
+    def __init__(self, host, port, prefix, username, samples, upload_body,
+                 results):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.username = username
+        self.job_ids, self.completed = samples
+        self.upload_body = upload_body
+        self.results = results
+
+    def request(self, method, noun, params, body=None, headers=None):
+        """
+        Make a request using a new connection, like fsurf does, and
+        read the entire response
+
+        :param method: HTTP method to use
+        :param noun: endpoint path relative to the url prefix
+        :param params: dictionary with query parameters
+        :param body: request body if any
+        :param headers: dictionary with extra headers
+        :return: (status, response body)
+        """
+        url = "{0}/{1}?{2}".format(self.prefix, noun,
+                                   urllib.urlencode(params))
+        start = time.time()
+        status = 0
+        chunks = []
+        try:
+            conn = httplib.HTTPConnection(self.host, self.port)
+            conn.request(method, url, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            status = resp.status
+            while True:
+                chunk = resp.read(1024 * 1024)
+                if not chunk:
+                    break
+                # output tarballs are discarded as they are read
+                if noun != 'job/output':
+                    chunks.append(chunk)
+            conn.close()
+        except (httplib.HTTPException, IOError):
+            pass
+        self.results.record("{0} {1}".format(method, noun),
+                            time.time() - start,
+                            status == 200)
+        return status, ''.join(chunks)
+
+    def get_token(self):
+        """
+        Get a salt and generate a token the same way fsurf does
+
+        :return: dictionary with userid, token and timestamp parameters
+        """
+        status, response = self.request('GET', 'user/salt',
+                                        {'userid': self.username})
+        if status != 200:
+            return None
+        salt = json.loads(response)['result']
+        timestamp = str(time.time())
+        token = hashlib.sha256(salt + USER_PASSWORD).hexdigest()
+        token = hashlib.sha256(token + timestamp).hexdigest()
+        return {'userid': self.username,
+                'token': token,
+                'timestamp': timestamp}
+
+    def op_list(self):
+        """
+        Reproduce fsurf list
+
+        :return: True on success
+        """
+        params = self.get_token()
+        if params is None:
+            return False
+        params['all'] = False
+        status, _ = self.request('GET', 'job', params)
+        return status == 200
+
+    def op_status(self):
+        """
+        Reproduce fsurf status for a single job
+
+        :return: True on success
+        """
+        if not self.job_ids:
+            return True
+        params = self.get_token()
+        if params is None:
+            return False
+        params['jobid'] = random.choice(self.job_ids)
+        status, _ = self.request('GET', 'job/status', params)
+        return status == 200
+
+    def op_submit(self):
+        """
+        Reproduce fsurf submit with a single input file
+
+        :return: True on success
+        """
+        params = self.get_token()
+        if params is None:
+            return False
+        subject = "load_{0}".format(random.randint(0, 1 << 30))
+        params.update({'multicore': True,
+                       'num_inputs': 1,
+                       'options': None,
+                       'version': '5.3.0',
+                       'subject': subject,
+                       'jobname': "validation_{0}".format(subject)})
+        status, response = self.request('POST', 'job', params)
+        if status != 200:
+            return False
+        job_id = json.loads(response)['job_id']
+        params = self.get_token()
+        if params is None:
+            return False
+        filename = "{0}_defaced.mgz".format(subject)
+        params.update({'filename': filename,
+                       'subjectdir': False,
+                       'jobid': job_id})
+        boundary = '--------------MIME_Content_Boundary---------------'
+        body = "\r\n".join(['--' + boundary,
+                            'Content-Disposition: form-data; '
+                            'name="input_file"; '
+                            'filename="{0}"'.format(filename),
+                            'Content-Type: application/octet-stream',
+                            '',
+                            self.upload_body,
+                            '--' + boundary + '--',
+                            ''])
+        headers = {'Content-Type':
+                   'multipart/form-data; boundary=%s' % boundary}
+        status, _ = self.request('POST', 'job/input', params, body, headers)
+        return status == 200
+
+    def op_output(self):
+        """
+        Reproduce fsurf output for a completed job
+
+        :return: True on success
+        """
+        if not self.completed:
+            return True
+        params = self.get_token()
+        if params is None:
+            return False
+        params['jobid'] = random.choice(self.completed)[0]
+        status, _ = self.request('GET', 'job/output', params)
+        return status == 200
+
+
+def run_client(client, mix, stop_time, results):
+    """
+    Run operations picked from the mix until stop_time
+
+    :param client: LoadClient instance
+    :param mix: list of (operation, cumulative weight)
+    :param stop_time: time to stop at
+    :param results: Results instance
+    :return: None
+    """
+    total = mix[-1][1]
+    while time.time() < stop_time:
+        pick = random.uniform(0, total)
+        for operation, weight in mix:
+            if pick <= weight:
+                break
+        start = time.time()
+        try:
+            ok = getattr(client, 'op_' + operation)()
+        except Exception:
+            ok = False
+        results.record("op " + operation, time.time() - start, ok)
+
+
+def sample_connections(db_params, stop_event, samples):
+    """
+    Periodically count the connections open to the database
+
+    :param db_params: dictionary with connection parameters
+    :param stop_event: threading.Event set when sampling should stop
+    :param samples: list that connection counts are appended to
+    :return: None
+    """
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    query = "SELECT count(*) " \
+            "FROM pg_stat_activity " \
+            "WHERE datname = current_database() AND pid <> pg_backend_pid()"
+    while not stop_event.is_set():
+        cursor.execute(query)
+        samples.append(cursor.fetchone()[0])
+        stop_event.wait(0.25)
+    conn.close()
+
+
+def parse_mix(mix_string):
+    """
+    Parse a operation mix given as op:weight,op:weight
+
+    :param mix_string: string with mix
+    :return: list of (operation, cumulative weight)
+    """
+    mix = []
+    total = 0
+    for entry in mix_string.split(','):
+        operation, weight = entry.split(':')
+        if not hasattr(LoadClient, 'op_' + operation):
+            raise argparse.ArgumentTypeError("Unknown operation: "
+                                             "{0}".format(operation))
+        total += float(weight)
+        mix.append((operation, total))
+    return mix
+
+
+def percentile(values, pct):
+    """
+    Get a percentile from a sorted list of values
+
+    :param values: sorted list of values
+    :param pct: percentile to get
+    :return: value at percentile
+    """
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def get_db_sessions(db_params):
+    """
+    Get the number of sessions opened on the database so far, this is
+    only tracked by postgres 14 and later
+
+    :param db_params: dictionary with connection parameters
+    :return: number of sessions or None if not available
+    """
+    conn = psycopg2.connect(**db_params)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT sessions "
+                       "FROM pg_stat_database "
+                       "WHERE datname = current_database()")
+        return cursor.fetchone()[0]
+    except psycopg2.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def get_connect_time(metrics):
+    """
+    Get the mean time requests spent connecting to the database from
+    the output of the metrics endpoint
+
+    :param metrics: text from the metrics endpoint
+    :return: mean time in seconds or None if nothing was recorded
+    """
+    pattern = re.compile(r'^fsurf_request_phase_seconds_(sum|count)\{.*'
+                         r'phase="db_connect"\}\s+(\S+)', re.MULTILINE)
+    totals = {'sum': 0.0, 'count': 0}
+    for kind, value in pattern.findall(metrics):
+        totals[kind] += float(value)
+    if not totals['count']:
+        return None
+    return totals['sum'] / totals['count']
+
+
+def print_report(results, elapsed, connection_samples, db_sessions,
+                 connect_time):
+    """
+    Print throughput, latency and connection statistics
+
+    :param results: Results instance
+    :param elapsed: duration of test in seconds
+    :param connection_samples: list of open connection counts
+    :param db_sessions: number of database sessions opened or None
+    :param connect_time: mean time per request spent connecting to the
+                         database or None
+    :return: None
+    """
+    header = "{0:<22} {1:>8} {2:>8} {3:>7}".format('Name', 'Count',
+                                                   'Req/s', 'Errors')
+    for pct in PERCENTILES:
+        header += " {0:>9}".format("p{0} ms".format(pct))
+    sys.stdout.write(header + "\n")
+    total_requests = 0
+    for name in sorted(results.latencies):
+        latencies = sorted(results.latencies[name])
+        if not name.startswith('op '):
+            total_requests += len(latencies)
+        line = "{0:<22} {1:>8} {2:>8.1f} {3:>7}".format(name,
+                                                        len(latencies),
+                                                        len(latencies) / elapsed,
+                                                        results.errors.get(name, 0))
+        for pct in PERCENTILES:
+            line += " {0:>9.1f}".format(percentile(latencies, pct) * 1000)
+        sys.stdout.write(line + "\n")
+    sys.stdout.write("\nHTTP requests: {0} in {1:.1f}s, "
+                     "{2:.1f} req/s\n".format(total_requests,
+                                              elapsed,
+                                              total_requests / elapsed))
+    if connection_samples:
+        sys.stdout.write("DB connections open: "
+                         "mean {0:.1f}, max {1}\n".format(sum(connection_samples) /
+                                                          float(len(connection_samples)),
+                                                          max(connection_samples)))
+    if db_sessions is not None and total_requests:
+        sys.stdout.write("DB sessions opened: {0} "
+                         "({1:.2f} per request)\n".format(db_sessions,
+                                                          db_sessions /
+                                                          float(total_requests)))
+    if connect_time is not None:
+        sys.stdout.write("Time connecting to DB: "
+                         "{0:.1f} ms per request\n".format(connect_time * 1000))
+
+
+def main():
+    """
+    Setup the database and app, run the load test and report results
+    """
+    parser = argparse.ArgumentParser(description="Load test the fsurf "
+                                                 "REST API")
+    parser.add_argument('--pg-bin', dest='pg_bin', default=None,
+                        help='Directory with postgres binaries (initdb, '
+                             'pg_ctl) used to run a throwaway cluster')
+    parser.add_argument('--db-port', dest='db_port', type=int,
+                        default=None,
+                        help='Port postgres listens on, defaults to 55432 '
+                             'for the throwaway cluster')
+    parser.add_argument('--max-connections', dest='max_connections',
+                        type=int, default=300,
+                        help='max_connections for the throwaway cluster')
+    parser.add_argument('--db-host', dest='db_host', default=None,
+                        help='Use an existing postgres server instead of '
+                             'a throwaway cluster, a new database is '
+                             'created on it')
+    parser.add_argument('--db-user', dest='db_user', default=DB_USER,
+                        help='User for existing postgres server')
+    parser.add_argument('--db-password', dest='db_password', default='',
+                        help='Password for existing postgres server')
+    parser.add_argument('--db-name', dest='db_name', default=DB_NAME,
+                        help='Name of database to create')
+    parser.add_argument('--users', dest='users', type=int, default=100,
+                        help='Number of users to seed')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=10000,
+                        help='Number of jobs to seed')
+    parser.add_argument('--clients', dest='clients', type=int, default=20,
+                        help='Number of concurrent clients')
+    parser.add_argument('--duration', dest='duration', type=float,
+                        default=30,
+                        help='Duration of the test in seconds')
+    parser.add_argument('--mix', dest='mix', type=parse_mix,
+                        default=parse_mix(DEFAULT_MIX),
+                        help='Operation mix as op:weight,... using '
+                             'list, status, submit, output '
+                             '(default {0})'.format(DEFAULT_MIX))
+    parser.add_argument('--input-size', dest='input_size', type=int,
+                        default=1024 * 1024,
+                        help='Size in bytes of files uploaded by submit')
+    parser.add_argument('--output-size', dest='output_size', type=int,
+                        default=1024 * 1024,
+                        help='Size in bytes of output files downloaded')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        default=False,
+                        help='Keep the work directory and cluster data')
+    args = parser.parse_args(sys.argv[1:])
+
+    work_dir = tempfile.mkdtemp(prefix='fsurf-load-')
+    data_dir = None
+    if args.db_host:
+        db_port = args.db_port or 5432
+        db_params = {'host': args.db_host,
+                     'port': db_port,
+                     'user': args.db_user,
+                     'password': args.db_password,
+                     'database': args.db_name}
+    else:
+        pg_bin = args.pg_bin
+        if pg_bin is None:
+            for path in os.environ.get('PATH', '').split(os.pathsep):
+                if os.path.isfile(os.path.join(path, 'initdb')):
+                    pg_bin = path
+                    break
+            else:
+                sys.stderr.write("Can't find initdb, use --pg-bin\n")
+                sys.exit(1)
+        db_port = args.db_port or 55432
+        db_params = {'host': '127.0.0.1',
+                     'port': db_port,
+                     'user': DB_USER,
+                     'password': '',
+                     'database': args.db_name}
+    # the app doesn't pass a port when connecting so use libpq's
+    # environment variable to point it at the right server
+    os.environ['PGPORT'] = str(db_port)
+    try:
+        if not args.db_host:
+            sys.stdout.write("Starting postgres in {0}\n".format(work_dir))
+            data_dir = start_postgres(pg_bin, work_dir, db_port,
+                                      args.max_connections)
+        create_database(db_params)
+        sys.stdout.write("Seeding {0} users and {1} jobs\n".format(args.users,
+                                                                   args.jobs))
+        start = time.time()
+        samples = seed_database(db_params, args.users, args.jobs)
+        base_dir = os.path.join(work_dir, 'fsurf')
+        create_outputs(base_dir, samples, args.output_size)
+        sys.stdout.write("Seeded in {0:.1f}s\n".format(time.time() - start))
+
+        config_file = write_app_config(work_dir, db_params)
+        server, interface = start_app(config_file, base_dir, 0)
+        results = Results()
+        upload_body = os.urandom(args.input_size)
+        stop_time = time.time() + args.duration
+        clients = []
+        for i in range(args.clients):
+            username = "loaduser{0}".format(i % args.users)
+            client = LoadClient('127.0.0.1', server.server_port,
+                                interface.URL_PREFIX, username,
+                                samples[username], upload_body, results)
+            client_thread = threading.Thread(target=run_client,
+                                             args=(client, args.mix,
+                                                   stop_time, results))
+            client_thread.daemon = True
+            clients.append(client_thread)
+
+        connection_samples = []
+        stop_event = threading.Event()
+        sampler = threading.Thread(target=sample_connections,
+                                   args=(db_params, stop_event,
+                                         connection_samples))
+        sampler.daemon = True
+        sampler.start()
+        sessions_start = get_db_sessions(db_params)
+        sys.stdout.write("Running {0} clients for {1}s\n".format(args.clients,
+                                                                 args.duration))
+        start = time.time()
+        for client_thread in clients:
+            client_thread.start()
+        for client_thread in clients:
+            client_thread.join()
+        elapsed = time.time() - start
+        stop_event.set()
+        sampler.join()
+
+        db_sessions = None
+        sessions_end = get_db_sessions(db_params)
+        if sessions_start is not None and sessions_end is not None:
+            # roughly discount the sessions used by the sampler and by
+            # these queries
+            db_sessions = sessions_end - sessions_start - 2
+        connect_time = None
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request('GET', interface.URL_PREFIX + '/metrics')
+        resp = conn.getresponse()
+        if resp.status == 200:
+            connect_time = get_connect_time(resp.read())
+        conn.close()
+        server.shutdown()
+        sys.stdout.write("\n")
+        print_report(results, elapsed, connection_samples, db_sessions,
+                     connect_time)
+    finally:
+        if data_dir is not None:
+            stop_postgres(pg_bin, data_dir)
+        if args.keep:
+            sys.stdout.write("Work directory kept at {0}\n".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
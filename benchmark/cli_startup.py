@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Startup benchmark for the fsurf client, times commands that don't need
+# the network and reports the modules imported while fsurf starts, similar
+# to the output of python -X importtime on python 3.7+
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FSURF_SCRIPT = os.path.join(REPO_DIR, 'python', 'fsurf')
+
+# commands timed by default, none of these contact the server
+DEFAULT_COMMANDS = ['--version',
+                    '--help',
+                    'status --help',
+                    'submit --help',
+                    'output --help']
+# milliseconds fsurf may add to the startup of a bare interpreter
+DEFAULT_BUDGET = 50
+
+# run in a separate interpreter, times each import done while running
+# fsurf and prints one line per module as depth, self time and
+# cumulative time in microseconds and module name
+IMPORT_HOOK = r'''
+import sys
+import time
+import __builtin__
+
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+original_import = __builtin__.__import__
+stack = []
+records = []
+
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return original_import(name, *args, **kwargs)
+    stack.append(0)
+    start = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if name in sys.modules:
+            records.append((len(stack), elapsed - children, elapsed, name))
+
+__builtin__.__import__ = timed_import
+start = time.time()
+with open(script) as f:
+    code = compile(f.read(), script, 'exec')
+compile_time = time.time() - start
+out = sys.stdout
+sys.stdout = sys.stderr = open('/dev/null', 'w')
+try:
+    exec(code, {'__name__': '__main__', '__file__': script})
+except SystemExit:
+    pass
+finally:
+    __builtin__.__import__ = original_import
+    for depth, self_time, cumulative, name in records:
+        out.write("{0} {1} {2} {3}\n".format(depth, int(self_time * 1e6),
+                                             int(cumulative * 1e6), name))
+    out.write("-1 {0} {0} <compile {1}>\n".format(int(compile_time * 1e6),
+                                                  script))
+'''
+
+
+def time_command(python, command, runs):
+    """
+    Run a command several times and time each run
+
+    :param python: list with interpreter and arguments to run
+    :param command: list of arguments for the interpreter
+    :param runs: number of times to run the command
+    :return: sorted list of wall times in milliseconds
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(python + command, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    return sorted(times)
+
+
+def import_report(python, script, arguments):
+    """
+    Get the time spent importing each module while running fsurf
+
+    :param python: list with interpreter and arguments to run
+    :param script: path to fsurf
+    :param arguments: arguments to pass to fsurf
+    :return: list of (depth, self us, cumulative us, module) tuples
+    """
+    output = subprocess.check_output(python + ['-c', IMPORT_HOOK, script] +
+                                     arguments)
+    records = []
+    for line in output.splitlines():
+        depth, self_time, cumulative, name = line.split(' ', 3)
+        records.append((int(depth), int(self_time), int(cumulative), name))
+    return records
+
+
+def main():
+    """
+    Time fsurf commands, report imports and check the startup budget
+
+    :return: exit code (0 if within budget, 1 otherwise)
+    """
+    parser = argparse.ArgumentParser(description="Measure fsurf startup "
+                                                 "time")
+    parser.add_argument('--python', dest='python', default='python2',
+                        help='Python interpreter used to run fsurf')
+    parser.add_argument('--fsurf', dest='fsurf', default=FSURF_SCRIPT,
+                        help='Path to fsurf script')
+    parser.add_argument('--runs', dest='runs', type=int, default=20,
+                        help='Number of times each command is run')
+    parser.add_argument('--command', dest='commands', action='append',
+                        default=None,
+                        help='fsurf arguments to time, can be used '
+                             'multiple times (default: {0})'.format(
+                                 ', '.join(DEFAULT_COMMANDS)))
+    parser.add_argument('--budget', dest='budget', type=float,
+                        default=DEFAULT_BUDGET,
+                        help='Milliseconds each command may take over a '
+                             'bare interpreter, based on the fastest run')
+    parser.add_argument('--imports', dest='imports', action='store_true',
+                        default=False,
+                        help='Show time spent importing each module')
+    args = parser.parse_args(sys.argv[1:])
+    commands = args.commands or DEFAULT_COMMANDS
+
+    # -E and -s so user site packages and PYTHON* variables don't
+    # change the results
+    python = [args.python, '-E', '-s']
+    baseline = time_command(python, ['-c', 'pass'], args.runs)
+    sys.stdout.write("{0:<24} {1:>9} {2:>9} {3:>9}\n".format('command',
+                                                             'best ms',
+                                                             'median ms',
+                                                             'over ms'))
+    sys.stdout.write("{0:<24} {1:>9.1f} {2:>9.1f} {3:>9}\n".format(
+        '(interpreter)', baseline[0], baseline[len(baseline) / 2], '-'))
+    over_budget = []
+    for command in commands:
+        times = time_command(python, [args.fsurf] + command.split(),
+                             args.runs)
+        overhead = times[0] - baseline[0]
+        if overhead > args.budget:
+            over_budget.append(command)
+        sys.stdout.write("{0:<24} {1:>9.1f} {2:>9.1f} {3:>9.1f}\n".format(
+            command, times[0], times[len(times) / 2], overhead))
+
+    if args.imports:
+        for command in commands:
+            records = import_report(python, args.fsurf, command.split())
+            total = sum(record[1] for record in records)
+            sys.stdout.write("\nstartup of fsurf {0} "
+                             "({1:.1f} ms)\n".format(command, total / 1000.0))
+            sys.stdout.write("import time: self [us] | cumulative | "
+                             "imported package\n")
+            for depth, self_time, cumulative, name in records:
+                sys.stdout.write("import time: {0:>9} | {1:>10} | "
+                                 "{2}{3}\n".format(self_time, cumulative,
+                                                   '  ' * max(depth, 0),
+                                                   name))
+
+    if over_budget:
+        sys.stdout.write("\nOver the {0:.0f} ms budget: {1}\n".format(
+            args.budget, ', '.join(over_budget)))
+        return 1
+    sys.stdout.write("\nAll commands within the {0:.0f} ms "
+                     "budget\n".format(args.budget))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,8 +12,14 @@ CREATE TYPE freesurfer_interface.job_state AS ENUM (
     'ERROR'
 );
 
+CREATE TYPE freesurfer_interface.input_state AS ENUM (
+    'PENDING',
+    'VALID',
+    'INVALID'
+);
+
 CREATE TYPE freesurfer_interface.freesufer_version AS ENUM (
-    '5.1.0'
+    '5.1.0',
     '5.3.0',
     '6.0.0'
 );
@@ -41,7 +47,8 @@ CREATE TABLE freesurfer_interface.jobs (
     options         VARCHAR(1024),
     purged          BOOLEAN NOT NULL DEFAULT FALSE,
     num_inputs      INTEGER NOT NULL DEFAULT 0,
-    version         freesurfer_interface.freesufer_version NOT NULL DEFAULT '5.3.0'
+    version         freesurfer_interface.freesufer_version NOT NULL DEFAULT '5.3.0',
+    output_sha1     CHAR(40)
 );
 
 CREATE TABLE freesurfer_interface.job_run (
@@ -56,16 +63,75 @@ CREATE TABLE freesurfer_interface.job_run (
     tasks_completed INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE TABLE freesurfer_interface.task_run (
+    id              SERIAL PRIMARY KEY,
+    job_run_id      INTEGER NOT NULL REFERENCES freesurfer_interface.job_run(id),
+    task            VARCHAR(128) NOT NULL,
+    stage           VARCHAR(128) NOT NULL,
+    host            VARCHAR(256),
+    site            VARCHAR(256),
+    started         TIMESTAMP NOT NULL,
+    ended           TIMESTAMP NOT NULL,
+    duration        DOUBLE PRECISION NOT NULL DEFAULT 0,
+    cputime         DOUBLE PRECISION NOT NULL DEFAULT 0,
+    cores           INTEGER NOT NULL DEFAULT 1,
+    maxrss          BIGINT NOT NULL DEFAULT 0,
+    exit_code       INTEGER,
+    bytes_in        BIGINT NOT NULL DEFAULT 0,
+    bytes_out       BIGINT NOT NULL DEFAULT 0,
+    recorded        TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX task_run_job_run_idx ON freesurfer_interface.task_run(job_run_id);
+
 CREATE TABLE freesurfer_interface.input_files (
     id              SERIAL PRIMARY KEY,
     filename        VARCHAR(255) NOT NULL,
     path            VARCHAR(1024) NOT NULL,
     job_id          INTEGER NOT NULL REFERENCES freesurfer_interface.jobs(id),
     purged          BOOLEAN NOT NULL DEFAULT FALSE,
-    subject_dir     BOOLEAN NOT NULL DEFAULT FALSE
+    subject_dir     BOOLEAN NOT NULL DEFAULT FALSE,
+    sha256          CHAR(64),
+    state           freesurfer_interface.input_state NOT NULL DEFAULT 'PENDING',
+    validation_error VARCHAR(1024)
+);
+
+CREATE TABLE freesurfer_interface.input_blobs (
+    id              SERIAL PRIMARY KEY,
+    username        VARCHAR(128) NOT NULL REFERENCES freesurfer_interface.users(username),
+    sha256          CHAR(64) NOT NULL,
+    path            VARCHAR(1024) NOT NULL,
+    size            BIGINT NOT NULL DEFAULT 0,
+    ref_count       INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (username, sha256)
 );
 
 
+CREATE TABLE freesurfer_interface.sessions (
+    id              SERIAL PRIMARY KEY,
+    username        VARCHAR(128) NOT NULL REFERENCES freesurfer_interface.users(username),
+    token_hash      CHAR(64) NOT NULL UNIQUE,
+    created         TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires         TIMESTAMP NOT NULL
+);
+
+CREATE INDEX sessions_username_idx ON freesurfer_interface.sessions(username);
+
+CREATE TABLE freesurfer_interface.outbox (
+    id              SERIAL PRIMARY KEY,
+    username        VARCHAR(128) REFERENCES freesurfer_interface.users(username),
+    recipient       VARCHAR(128) NOT NULL CHECK ( recipient <> ''),
+    subject         VARCHAR(256) NOT NULL,
+    body            TEXT NOT NULL,
+    queued          TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent            TIMESTAMP,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    last_error      VARCHAR(1024)
+);
+
+CREATE INDEX outbox_pending_idx ON freesurfer_interface.outbox(recipient) WHERE sent IS NULL;
+
+
 CREATE TABLE freesurfer_interface.verifications (
     id              SERIAL PRIMARY KEY,
     kernel_version  VARCHAR(128) NOT NULL,
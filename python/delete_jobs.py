@@ -115,6 +115,10 @@ def delete_incomplete_jobs(dry_run=False):
                     if not purge_workflow_file(entry):
                         logger.error("Can't remove {0} for job {1}".format(entry,
                                                                            workflow_id))
+            if not dry_run and \
+               not fsurfer.helpers.release_job_inputs(cursor, workflow_id):
+                logger.error("Can't release stored inputs for "
+                             "job {0}".format(workflow_id))
             logger.info("Setting workflow {0} to DELETED".format(workflow_id))
             cursor.execute(job_update, [workflow_id])
             if dry_run:
@@ -280,6 +284,11 @@ def delete_job():
                                               'results',
                                               "{0}_{1}_output.tar.bz2".format(workflow_id,
                                                                               row[4])))
+            deletion_list.append(os.path.join(fsurfer.FREESURFER_BASE,
+                                              username,
+                                              'results',
+                                              "{0}_{1}_output.zip".format(workflow_id,
+                                                                          row[4])))
             for entry in deletion_list:
                 if args.dry_run:
                     sys.stdout.write("Would delete {0}\n".format(entry))
@@ -288,6 +297,10 @@ def delete_job():
                     if not purge_workflow_file(entry):
                         logger.error("Can't remove {0} for job {1}".format(entry,
                                                                            workflow_id))
+            if not args.dry_run and \
+               not fsurfer.helpers.release_job_inputs(cursor, workflow_id):
+                logger.error("Can't release stored inputs for "
+                             "job {0}".format(workflow_id))
             logger.info("Setting workflow {0} to DELETED".format(workflow_id))
             cursor.execute(job_update, [workflow_id])
             if args.dry_run:
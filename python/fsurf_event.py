@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Record a pegasus notification in the event spool for process_events.py
+# to apply.  Pegasus runs this for every task and workflow that finishes
+# so only the standard library is used and nothing is done besides
+# writing the event
+import errno
+import os
+import sys
+import time
+
+# must match SPOOL_DIR in process_events.py
+SPOOL_DIR = '~/spool/fsurf'
+USAGE = "Usage: {0} task --id JOB_RUN_ID\n" \
+        "       {0} workflow (--success | --failure) --id JOB_RUN_ID\n"
+
+
+def parse_arguments(argv):
+    """
+    Get the event from the command line arguments
+
+    :param argv: list of arguments
+    :return: list of (key, value) tuples for the event or None if the
+             arguments aren't valid
+    """
+    if not argv or argv[0] not in ('task', 'workflow'):
+        return None
+    event = [('event', argv[0])]
+    job_run_id = None
+    success = None
+    arguments = iter(argv[1:])
+    for argument in arguments:
+        if argument == '--id':
+            job_run_id = next(arguments, '')
+        elif argument.startswith('--id='):
+            job_run_id = argument[5:]
+        elif argument == '--success':
+            success = True
+        elif argument == '--failure':
+            success = False
+        else:
+            return None
+    if job_run_id is None or not job_run_id.isdigit():
+        return None
+    event.append(('id', job_run_id))
+    if argv[0] == 'workflow':
+        if success is None:
+            return None
+        event.append(('success', str(success)))
+    else:
+        # process_events.py uses these to find the task's kickstart record
+        for key in sorted(os.environ):
+            if key.startswith('PEGASUS_') and '\n' not in os.environ[key]:
+                event.append((key, os.environ[key]))
+    return event
+
+
+def write_event(spool_dir, event):
+    """
+    Write an event to the spool, the event is written to the tmp
+    directory and then moved to the new directory so that partial
+    events are never read
+
+    :param spool_dir: path to the spool directory
+    :param event: list of (key, value) tuples
+    :return: path to the event file
+    """
+    for name in ('tmp', 'new'):
+        try:
+            os.makedirs(os.path.join(spool_dir, name), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    # names sort in the order the events were written
+    filename = "{0:017.6f}.{1}.{2}".format(time.time(),
+                                           os.getpid(),
+                                           os.uname()[1])
+    temp_path = os.path.join(spool_dir, 'tmp', filename)
+    event_path = os.path.join(spool_dir, 'new', filename)
+    with open(temp_path, 'w') as f:
+        for key, value in event:
+            f.write("{0}={1}\n".format(key, value))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, event_path)
+    return event_path
+
+
+def main():
+    """
+    Write the event given on the command line to the spool
+
+    :return: exit code (0 for success, non-zero for failure)
+    """
+    event = parse_arguments(sys.argv[1:])
+    if event is None:
+        sys.stderr.write(USAGE.format(os.path.basename(sys.argv[0])))
+        return 2
+    try:
+        write_event(os.path.expanduser(SPOOL_DIR), event)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Can't write event to spool: {0}\n".format(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
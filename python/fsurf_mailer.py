@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Send the messages queued in the outbox.  Messages to a recipient are
+# held for a short window and sent together as a digest using a single
+# SMTP connection so that users with large batches don't get an email
+# for every workflow
+import argparse
+import fcntl
+import select
+import smtplib
+import socket
+import sys
+import time
+from email.mime.text import MIMEText
+
+import psycopg2
+import psycopg2.extensions
+
+import fsurfer
+import fsurfer.helpers
+import fsurfer.log
+
+VERSION = fsurfer.__version__
+SENDER = 'fsurf@login.osgconnect.net'
+SMTP_HOST = 'localhost'
+SMTP_PORT = 25
+# seconds a message waits so later messages to the same recipient can
+# be sent with it
+DIGEST_WINDOW = 300
+# seconds to wait for a notification before checking the outbox anyway
+POLL_INTERVAL = 60
+# messages that are refused this many times are no longer retried,
+# failures to reach the SMTP server aren't counted
+MAX_ATTEMPTS = 5
+# errors caused by a message rather than the SMTP server
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)
+# sent messages are removed from the outbox after this long
+PURGE_AGE = '30 days'
+
+DIGEST_TEMPLATE = '''
+This email combines {0} notifications about your FreeSurfer workflows.
+
+{1}
+Please contact user-support@opensciencegrid.org  if you have any questions.
+'''
+DIGEST_SEPARATOR = '-' * 72
+
+
+def get_pending_messages(conn, window):
+    """
+    Get the queued messages for recipients whose oldest message has
+    waited for at least the digest window, the messages are locked
+    until the current transaction ends
+
+    :param conn: database connection to use
+    :param window: seconds to hold messages before sending them
+    :return: list of (recipient, [(id, subject, body), ...]) tuples
+    """
+    message_query = "SELECT id, recipient, subject, body " \
+                    "FROM freesurfer_interface.outbox " \
+                    "WHERE sent IS NULL AND " \
+                    "      attempts < %s AND " \
+                    "      recipient IN (SELECT recipient " \
+                    "                    FROM freesurfer_interface.outbox " \
+                    "                    WHERE sent IS NULL AND " \
+                    "                          attempts < %s " \
+                    "                    GROUP BY recipient " \
+                    "                    HAVING min(queued) <= " \
+                    "                           CURRENT_TIMESTAMP - " \
+                    "                           %s * INTERVAL '1 second') " \
+                    "ORDER BY recipient, id " \
+                    "FOR UPDATE SKIP LOCKED"
+    cursor = conn.cursor()
+    cursor.execute(message_query, [MAX_ATTEMPTS, MAX_ATTEMPTS, window])
+    pending = []
+    for message_id, recipient, subject, body in cursor.fetchall():
+        if not pending or pending[-1][0] != recipient:
+            pending.append((recipient, []))
+        pending[-1][1].append((message_id, subject, body))
+    return pending
+
+
+def build_message(recipient, messages):
+    """
+    Create the email for a recipient, multiple messages are combined
+    into a digest
+
+    :param recipient: email address to send to
+    :param messages: list of (id, subject, body) tuples
+    :return: MIMEText instance
+    """
+    if len(messages) == 1:
+        msg = MIMEText(messages[0][2])
+        msg['Subject'] = messages[0][1]
+    else:
+        sections = []
+        for _, subject, body in messages:
+            sections.append("{0}\n{1}\n{2}\n".format(DIGEST_SEPARATOR,
+                                                     subject,
+                                                     body.strip()))
+        msg = MIMEText(DIGEST_TEMPLATE.format(len(messages),
+                                              '\n'.join(sections)))
+        msg['Subject'] = 'FreeSurfer: {0} workflow ' \
+                         'notifications'.format(len(messages))
+    msg['From'] = SENDER
+    msg['To'] = recipient
+    return msg
+
+
+class Mailer(object):
+    """
+    Send messages over one SMTP connection, connecting when the first
+    message is sent and reconnecting if the server drops the connection
+    """
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT):
+        self.host = host
+        self.port = port
+        self.smtp = None
+
+    def send(self, recipient, msg):
+        """
+        Send a message
+
+        :param recipient: email address to send to
+        :param msg: message to send
+        :return: None
+        :raises smtplib.SMTPException, socket.error
+        """
+        for attempt in range(2):
+            if self.smtp is None:
+                self.smtp = smtplib.SMTP(self.host, self.port)
+            try:
+                self.smtp.sendmail(SENDER, [recipient], msg.as_string())
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None
+                if attempt:
+                    raise
+
+    def close(self):
+        """
+        Close the SMTP connection
+
+        :return: None
+        """
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.smtp.close()
+        self.smtp = None
+
+
+def send_pending(conn, mailer, window=DIGEST_WINDOW, dry_run=False):
+    """
+    Send the messages that have waited for the digest window, each
+    recipient's messages are marked as sent when their email is sent
+
+    :param conn: database connection to use
+    :param mailer: Mailer instance used to send messages
+    :param window: seconds to hold messages before sending them
+    :param dry_run: if True, show the emails instead of sending them
+    :return: number of emails sent
+    """
+    logger = fsurfer.log.get_logger()
+    sent_update = "UPDATE freesurfer_interface.outbox " \
+                  "SET sent = CURRENT_TIMESTAMP, " \
+                  "    attempts = attempts + 1 " \
+                  "WHERE id = ANY(%s)"
+    failed_update = "UPDATE freesurfer_interface.outbox " \
+                    "SET attempts = attempts + 1, " \
+                    "    last_error = %s " \
+                    "WHERE id = ANY(%s)"
+    error_update = "UPDATE freesurfer_interface.outbox " \
+                   "SET last_error = %s " \
+                   "WHERE id = ANY(%s)"
+    cursor = conn.cursor()
+    emails = 0
+    try:
+        for recipient, messages in get_pending_messages(conn, window):
+            message_ids = [message[0] for message in messages]
+            msg = build_message(recipient, messages)
+            if dry_run:
+                sys.stdout.write("{0}\n\n".format(msg.as_string()))
+                continue
+            try:
+                mailer.send(recipient, msg)
+            except MESSAGE_ERRORS as e:
+                logger.exception("Can't email {0}: {1}".format(recipient, e))
+                cursor.execute(failed_update, [str(e)[:1024], message_ids])
+                continue
+            except (smtplib.SMTPException, socket.error) as e:
+                # the SMTP server can't be used, so stop without counting
+                # an attempt and try everything again on the next pass
+                logger.exception("Can't email {0}: {1}".format(recipient, e))
+                cursor.execute(error_update, [str(e)[:1024], message_ids])
+                mailer.close()
+                break
+            cursor.execute(sent_update, [message_ids])
+            # commit after each email so messages aren't sent twice
+            conn.commit()
+            emails += 1
+            logger.info("Emailed {0} with {1} messages".format(recipient,
+                                                               len(messages)))
+    finally:
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    return emails
+
+
+def purge_sent(conn):
+    """
+    Remove old messages that have been sent from the outbox
+
+    :param conn: database connection to use
+    :return: number of messages removed
+    """
+    purge_query = "DELETE FROM freesurfer_interface.outbox " \
+                  "WHERE sent IS NOT NULL AND " \
+                  "      age(sent) > %s"
+    cursor = conn.cursor()
+    cursor.execute(purge_query, [PURGE_AGE])
+    conn.commit()
+    return cursor.rowcount
+
+
+def listen_for_mail():
+    """
+    Get a database connection that is notified when messages are queued
+
+    :return: database connection
+    """
+    listen_conn = fsurfer.helpers.get_db_client()
+    listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listen_conn.cursor().execute("LISTEN " +
+                                 fsurfer.helpers.MAIL_EVENT_CHANNEL)
+    return listen_conn
+
+
+def main():
+    """
+    Send queued messages, waiting for new messages to be queued
+
+    :return: exit code (0 for success, non-zero for failure)
+    """
+    fsurfer.log.initialize_logging()
+    logger = fsurfer.log.get_logger()
+    parser = argparse.ArgumentParser(description="Send queued fsurf emails")
+    # version info
+    parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
+    # Arguments for action
+    parser.add_argument('--dry-run', dest='dry_run',
+                        action='store_true', default=False,
+                        help='Show emails instead of sending them')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true', default=False,
+                        help='Output debug messages')
+    parser.add_argument('--once', dest='once',
+                        action='store_true', default=False,
+                        help='Send pending messages and exit')
+    parser.add_argument('--window', dest='window', type=int,
+                        default=DIGEST_WINDOW,
+                        help='Seconds to hold messages so they can be '
+                             'combined into a digest')
+    parser.add_argument('--smtp-host', dest='smtp_host',
+                        default=SMTP_HOST,
+                        help='SMTP server used to send messages')
+    parser.add_argument('--smtp-port', dest='smtp_port', type=int,
+                        default=SMTP_PORT,
+                        help='Port for SMTP server')
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.debug:
+        fsurfer.log.set_debugging()
+    if args.dry_run:
+        sys.stdout.write("Doing a dry run, no changes will be made\n")
+    try:
+        x = open('/tmp/fsurf_mailer.lock', 'w+')
+        fcntl.flock(x, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.warn('Lock file present, exiting')
+        sys.exit(1)
+
+    mailer = Mailer(args.smtp_host, args.smtp_port)
+    conn = None
+    listen_conn = None
+    try:
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = fsurfer.helpers.get_db_client()
+                if listen_conn is None or listen_conn.closed:
+                    listen_conn = listen_for_mail()
+                emails = send_pending(conn, mailer, args.window, args.dry_run)
+                if emails:
+                    logger.info("Sent {0} emails".format(emails))
+                if args.once:
+                    break
+                if not args.dry_run:
+                    purge_sent(conn)
+                # hold the connection open while messages are arriving
+                # and close it once things are quiet
+                timeout = min(POLL_INTERVAL, max(args.window, 1))
+                if not select.select([listen_conn], [], [], timeout)[0]:
+                    mailer.close()
+                listen_conn.poll()
+                del listen_conn.notifies[:]
+            except psycopg2.Error as e:
+                # messages stay in the outbox and are sent once the
+                # database can be reached again
+                logger.exception("Got pgsql error: {0}".format(e))
+                if args.once:
+                    return 1
+                mailer.close()
+                if conn is not None and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        conn.close()
+                time.sleep(POLL_INTERVAL)
+    finally:
+        mailer.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,7 @@ import argparse
 import sys
 import getpass
 import hashlib
+import os
 import time
 
 import fsurfer
@@ -97,11 +98,24 @@ def add_user(args):
         logger.info("User {0} added".format(username))
         conn.commit()
         conn.close()
-        return 0
     except Exception as e:
         sys.stderr.write("Got exception: {0}".format(e))
         logger.exception("Got exception: {0}".format(e))
         return 1
+    user_dir = os.path.join(fsurfer.FREESURFER_BASE, username)
+    try:
+        logger.info("Creating directories in {0}".format(user_dir))
+        # give the directories to the user that owns FREESURFER_BASE,
+        # the web interface runs as that user and needs to write to them
+        base_info = os.stat(fsurfer.FREESURFER_BASE)
+        fsurfer.helpers.provision_user_dirs(user_dir,
+                                            (base_info.st_uid,
+                                             base_info.st_gid))
+    except (IOError, OSError) as e:
+        # directories will be created on first login instead
+        sys.stderr.write("Can't create directories in {0}: {1}\n".format(user_dir, e))
+        logger.exception("Got exception: {0}".format(e))
+    return 0
 
 
 def disable_user(args):
@@ -122,6 +136,8 @@ def disable_user(args):
     user_disable = "UPDATE freesurfer_interface.users " \
                    "SET password = 'xxx', salt = 'xxx' " \
                    "WHERE username = %s"
+    session_delete = "DELETE FROM freesurfer_interface.sessions " \
+                     "WHERE username = %s"
     try:
         conn = fsurfer.helpers.get_db_client()
         with conn.cursor() as cursor:
@@ -130,6 +146,7 @@ def disable_user(args):
                 sys.stderr.write("{0}\n".format(cursor.statusmessage))
                 logger.error("Got pgsql error: {0}".format(cursor.statusmessage))
                 return 1
+            cursor.execute(session_delete, [username])
         conn.commit()
         logger.info("Disabled user {0}".format(username))
         conn.close()
@@ -16,6 +16,11 @@ from fsurfer import FREESURFER_BASE
 # helper functions
 from helpers import get_db_client
 from helpers import get_db_parameters
+from helpers import notify_job_event
+from helpers import provision_user_dirs
+from helpers import queue_email
+from helpers import release_input_blob
+from helpers import release_job_inputs
 
 from log import get_logger
 from log import initialize_logging
@@ -34,6 +39,11 @@ __all__ = ['create_single_job',
            'create_custom_workflow',
            'get_db_client',
            'get_db_parameters',
+           'notify_job_event',
+           'provision_user_dirs',
+           'queue_email',
+           'release_input_blob',
+           'release_job_inputs',
            'FREESURFER_BASE',
            'FREESURFER_SCRATCH']
 
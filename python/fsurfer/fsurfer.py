@@ -7,6 +7,26 @@ import Pegasus.DAX3
 SCRIPT_DIR = os.path.abspath("/usr/share/fsurfer/scripts")
 FREESURFER_BASE = '/local-scratch/fsurf/'
 FREESURFER_SCRATCH = '/local-scratch/fsurf/scratch'
+# extension of the sha1sum manifests stage scripts write for archives
+MANIFEST_EXTENSION = '.sha1'
+
+
+def use_manifest(job, archive, link, transfer=False):
+    """
+    Declare the checksum manifest written next to an archive so that it
+    is staged along with the archive
+
+    :param job: Pegasus Job using the archive
+    :param archive: pegasus File object for the archive
+    :param link: Pegasus.DAX3.Link.INPUT or Pegasus.DAX3.Link.OUTPUT
+    :param transfer: True to transfer an output manifest to the output site
+    :return: None
+    """
+    manifest = Pegasus.DAX3.File(archive.name + MANIFEST_EXTENSION)
+    if link == Pegasus.DAX3.Link.OUTPUT:
+        job.uses(manifest, link=link, transfer=transfer)
+    else:
+        job.uses(manifest, link=link)
 
 
 def create_single_job(dax, version, cores, subject_files, subject):
@@ -44,7 +64,8 @@ def create_single_job(dax, version, cores, subject_files, subject):
     return errors
 
 
-def create_custom_job(dax, version, cores, subject_dir, subject, options):
+def create_custom_job(dax, version, cores, subject_dir, subject, options,
+                      invoke_cmd=None):
     """
     Create a workflow with a single job that runs freesurfer workflow
     with custom options
@@ -56,6 +77,7 @@ def create_custom_job(dax, version, cores, subject_dir, subject, options):
                          subject dir
     :param subject: name of subject being processed
     :param options: options to FreeSurfer
+    :param invoke_cmd: If not None, cmd to run when the job completes
     :return: exit code (0 for success, 1 for failure)
     :return: False if errors occurred, True otherwise
     """
@@ -72,11 +94,14 @@ def create_custom_job(dax, version, cores, subject_dir, subject, options):
     custom_job.uses(subject_dir, link=Pegasus.DAX3.Link.INPUT)
     output = Pegasus.DAX3.File("{0}_output.tar.bz2".format(subject))
     custom_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
+    use_manifest(custom_job, output, Pegasus.DAX3.Link.OUTPUT, transfer=True)
     logs = Pegasus.DAX3.File("recon-all.log".format(subject))
     custom_job.uses(logs, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
 
     custom_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_memory", "4G"))
     custom_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_cpus", cores))
+    if invoke_cmd:
+        custom_job.invoke('at_end', invoke_cmd)
     dax.addJob(custom_job)
     return True
 
@@ -103,8 +128,10 @@ def create_recon2_job(dax, version, cores, subject):
     recon2_job.addArguments(version, subject, str(cores))
     output = Pegasus.DAX3.File("{0}_recon1_output.tar.xz".format(subject))
     recon2_job.uses(output, link=Pegasus.DAX3.Link.INPUT)
+    use_manifest(recon2_job, output, Pegasus.DAX3.Link.INPUT)
     output = Pegasus.DAX3.File("{0}_recon2_output.tar.xz".format(subject))
     recon2_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
+    use_manifest(recon2_job, output, Pegasus.DAX3.Link.OUTPUT, transfer=True)
     recon2_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_memory", "4G"))
     recon2_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_cpus", cores))
     return recon2_job
@@ -146,6 +173,7 @@ def create_initial_job(dax, version, subject_files, subject, options=None):
         autorecon1_job.uses(subject_file, link=Pegasus.DAX3.Link.INPUT)
     output = Pegasus.DAX3.File("{0}_recon1_output.tar.xz".format(subject))
     autorecon1_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=False)
+    use_manifest(autorecon1_job, output, Pegasus.DAX3.Link.OUTPUT, transfer=False)
     if version == '6.0.0':
         autorecon1_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_memory", "4G"))
     return autorecon1_job
@@ -184,8 +212,10 @@ def create_hemi_job(dax, version, cores, hemisphere, subject, options=None):
         autorecon2_job.addArguments("'{0}'".format(options))
     output = Pegasus.DAX3.File("{0}_recon1_output.tar.xz".format(subject))
     autorecon2_job.uses(output, link=Pegasus.DAX3.Link.INPUT)
+    use_manifest(autorecon2_job, output, Pegasus.DAX3.Link.INPUT)
     output = Pegasus.DAX3.File("{0}_recon2_{1}_output.tar.xz".format(subject, hemisphere))
     autorecon2_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=False)
+    use_manifest(autorecon2_job, output, Pegasus.DAX3.Link.OUTPUT, transfer=False)
     autorecon2_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_memory", "4G"))
     if version != '5.1.0':
         autorecon2_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_cpus", cores))
@@ -227,14 +257,18 @@ def create_final_job(dax, version, subject, serial_job=False, options=None):
     if serial_job:
         recon2_output = Pegasus.DAX3.File("{0}_recon2_output.tar.xz".format(subject))
         autorecon3_job.uses(recon2_output, link=Pegasus.DAX3.Link.INPUT)
+        use_manifest(autorecon3_job, recon2_output, Pegasus.DAX3.Link.INPUT)
     else:
         lh_output = Pegasus.DAX3.File("{0}_recon2_lh_output.tar.xz".format(subject))
         autorecon3_job.uses(lh_output, link=Pegasus.DAX3.Link.INPUT)
+        use_manifest(autorecon3_job, lh_output, Pegasus.DAX3.Link.INPUT)
         rh_output = Pegasus.DAX3.File("{0}_recon2_rh_output.tar.xz".format(subject))
         autorecon3_job.uses(rh_output, link=Pegasus.DAX3.Link.INPUT)
+        use_manifest(autorecon3_job, rh_output, Pegasus.DAX3.Link.INPUT)
     output = Pegasus.DAX3.File("{0}_output.tar.bz2".format(subject))
     logs = Pegasus.DAX3.File("recon-all.log".format(subject))
     autorecon3_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
+    use_manifest(autorecon3_job, output, Pegasus.DAX3.Link.OUTPUT, transfer=True)
     autorecon3_job.uses(logs, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
     if version == '6.0.0':
         autorecon3_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_memory", "4G"))
@@ -262,18 +296,20 @@ def create_serial_workflow(dax, version, cores, subject_file, subject,
         if initial_job is True:
             return True
         if invoke_cmd:
-            initial_job.invoke('on_success', invoke_cmd)
+            initial_job.invoke('at_end', invoke_cmd)
         dax.addJob(initial_job)
     recon2_job = create_recon2_job(dax, version, cores, subject)
     if recon2_job is True:
         return True
     if invoke_cmd:
-        recon2_job.invoke('on_success', invoke_cmd)
+        recon2_job.invoke('at_end', invoke_cmd)
     dax.addJob(recon2_job)
     dax.addDependency(Pegasus.DAX3.Dependency(parent=initial_job, child=recon2_job))
     final_job = create_final_job(dax, version, subject, serial_job=True)
     if final_job is True:
         return True
+    if invoke_cmd:
+        final_job.invoke('at_end', invoke_cmd)
     dax.addJob(final_job)
     dax.addDependency(Pegasus.DAX3.Dependency(parent=recon2_job, child=final_job))
     return False
@@ -316,32 +352,35 @@ def create_diamond_workflow(dax, version, cores, subject_files, subject,
         if not initial_job:
             return False
         if invoke_cmd:
-            initial_job.invoke('on_success', invoke_cmd)
+            initial_job.invoke('at_end', invoke_cmd)
         dax.addJob(initial_job)
     recon2_rh_job = create_hemi_job(dax, version, cores, 'rh', subject, options=options)
     if not recon2_rh_job:
         return False
     if invoke_cmd:
-        recon2_rh_job.invoke('on_success', invoke_cmd)
+        recon2_rh_job.invoke('at_end', invoke_cmd)
     dax.addJob(recon2_rh_job)
     dax.addDependency(Pegasus.DAX3.Dependency(parent=initial_job, child=recon2_rh_job))
     recon2_lh_job = create_hemi_job(dax, version, cores, 'lh', subject, options=options)
     if not recon2_lh_job:
         return False
     if invoke_cmd:
-        recon2_lh_job.invoke('on_success', invoke_cmd)
+        recon2_lh_job.invoke('at_end', invoke_cmd)
     dax.addJob(recon2_lh_job)
     dax.addDependency(Pegasus.DAX3.Dependency(parent=initial_job, child=recon2_lh_job))
     final_job = create_final_job(dax, version, subject, options=options)
     if not final_job:
         return False
+    if invoke_cmd:
+        final_job.invoke('at_end', invoke_cmd)
     dax.addJob(final_job)
     dax.addDependency(Pegasus.DAX3.Dependency(parent=recon2_rh_job, child=final_job))
     dax.addDependency(Pegasus.DAX3.Dependency(parent=recon2_lh_job, child=final_job))
     return True
 
 
-def create_custom_workflow(dax, version, cores, subject_dir, subject, options):
+def create_custom_workflow(dax, version, cores, subject_dir, subject, options,
+                           invoke_cmd=None):
     """
     Create a workflow that processes MRI images using custom options to
     FreeSurfer
@@ -351,6 +390,8 @@ def create_custom_workflow(dax, version, cores, subject_dir, subject, options):
     :param subject_dir: pegasus File object pointing to the subject dir
     :param subject: name of subject being processed
     :param options: Options to use in the workflow
+    :param invoke_cmd: If not None, cmd to run when the job completes
     :return: False if errors occurred, True otherwise
     """
-    return create_custom_job(dax, version, cores, subject_dir, subject, options)
+    return create_custom_job(dax, version, cores, subject_dir, subject, options,
+                             invoke_cmd=invoke_cmd)
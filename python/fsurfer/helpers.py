@@ -3,10 +3,25 @@
 # Copyright 2016 University of Chicago
 # Licensed under the APL 2.0 license
 
+import os
+
 import psycopg2
 
+# the user directory layout is shared with the web interface
+from layout import BLOB_DIR
+from layout import INPUT_SHARDS
+from layout import LAYOUT_MARKER
+from layout import USER_DIRS
+from layout import make_dir
+from layout import provision_user_dirs
 
 PARAM_FILE_LOCATION = "/etc/fsurf/db_info"
+# channel used to notify listeners about changes to workflows
+JOB_EVENT_CHANNEL = "fsurf_job_events"
+# channel used to announce uploaded inputs that need to be validated
+INPUT_EVENT_CHANNEL = "fsurf_input_events"
+# channel used to wake the mailer when messages are queued
+MAIL_EVENT_CHANNEL = "fsurf_mail_events"
 
 
 def get_db_parameters():
@@ -34,3 +49,100 @@ def get_db_client():
     """
     db, user, password, host = get_db_parameters()
     return psycopg2.connect(database=db, user=user, host=host, password=password)
+
+
+def notify_job_event(cursor, job_run_id):
+    """
+    Notify anything listening for workflow changes (e.g. the /job/events
+    endpoint) that a workflow has been updated.  The notification is
+    delivered when the current transaction is committed
+
+    :param cursor: cursor to use for the notification
+    :param job_run_id: id for the job run of the updated workflow
+    :return: None
+    """
+    notify_query = "SELECT pg_notify(%s, job_id::text) " \
+                   "FROM freesurfer_interface.job_run " \
+                   "WHERE id = %s"
+    cursor.execute(notify_query, [JOB_EVENT_CHANNEL, job_run_id])
+
+
+def queue_email(cursor, recipient, subject, body, username=None):
+    """
+    Add a message to the outbox for fsurf_mailer.py to send, messages
+    to the same recipient are combined into a digest.  The message is
+    queued when the current transaction is committed
+
+    :param cursor: cursor to use for the insert
+    :param recipient: email address to send the message to
+    :param subject: subject of the message
+    :param body: text of the message
+    :param username: fsurf user the message is for, if any
+    :return: None
+    """
+    outbox_insert = "INSERT INTO freesurfer_interface.outbox(username, " \
+                    "                                        recipient, " \
+                    "                                        subject, " \
+                    "                                        body) " \
+                    "VALUES(%s, %s, %s, %s)"
+    cursor.execute(outbox_insert, [username, recipient, subject, body])
+    cursor.execute("SELECT pg_notify(%s, '')", [MAIL_EVENT_CHANNEL])
+
+
+def release_input_blob(cursor, input_id):
+    """
+    Drop the reference an input file holds on the stored content it is
+    linked to, the stored content is removed once no input files refer
+    to it.  Changes are made using the current transaction
+
+    :param cursor: cursor to use for updates
+    :param input_id: id of input file entry being removed
+    :return: True if successful, False otherwise
+    """
+    blob_update = "UPDATE freesurfer_interface.input_blobs AS blobs " \
+                  "SET ref_count = blobs.ref_count - 1 " \
+                  "FROM freesurfer_interface.input_files AS inputs, " \
+                  "     freesurfer_interface.jobs AS jobs " \
+                  "WHERE inputs.id = %s AND " \
+                  "      jobs.id = inputs.job_id AND " \
+                  "      blobs.username = jobs.username AND " \
+                  "      blobs.sha256 = inputs.sha256 " \
+                  "RETURNING blobs.id, blobs.path, blobs.ref_count"
+    blob_delete = "DELETE FROM freesurfer_interface.input_blobs " \
+                  "WHERE id = %s AND ref_count <= 0"
+    cursor.execute(blob_update, [input_id])
+    row = cursor.fetchone()
+    if row is None or row[2] > 0:
+        return True
+    try:
+        if os.path.exists(row[1]):
+            os.unlink(row[1])
+    except OSError:
+        return False
+    cursor.execute(blob_delete, [row[0]])
+    return True
+
+
+def release_job_inputs(cursor, job_id):
+    """
+    Mark the input files for a job as purged and release the stored
+    content they are linked to
+
+    :param cursor: cursor to use for updates
+    :param job_id: id of job whose inputs have been removed
+    :return: True if successful, False otherwise
+    """
+    input_select = "SELECT id " \
+                   "FROM freesurfer_interface.input_files " \
+                   "WHERE NOT purged AND job_id = %s"
+    input_update = "UPDATE freesurfer_interface.input_files " \
+                   "SET purged = TRUE  " \
+                   "WHERE id = %s"
+    success = True
+    cursor.execute(input_select, [job_id])
+    for row in cursor.fetchall():
+        if not release_input_blob(cursor, row[0]):
+            success = False
+        cursor.execute(input_update, [row[0]])
+    return success
+
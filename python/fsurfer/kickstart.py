@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+import calendar
+import multiprocessing
+import os
+import re
+import xml.parsers.expat
+
+import dateutil.parser
+
+import log
+
+# pegasus job output files, e.g. autorecon1_ID0000001.out.000
+OUTPUT_FILE_RE = re.compile(r'\.out\.[0-9]+$')
+# bytes read when checking whether a file is a kickstart record
+SNIFF_SIZE = 1024
+READ_SIZE = 64 * 1024
+# number of records needed before using a process pool to parse them
+POOL_THRESHOLD = 8
+# environment variables set on glideins that give the site a job ran at
+SITE_VARIABLES = ('GLIDEIN_Site', 'GLIDEIN_ResourceName', 'OSG_SITE_NAME')
+
+
+def is_kickstart_record(path):
+    """
+    Check the start of a file to see if it holds a kickstart record
+    so that other files aren't parsed
+
+    :param path: path to file
+    :return: True if file looks like a kickstart record
+    """
+    with open(path, 'rb') as f:
+        header = f.read(SNIFF_SIZE).lstrip()
+    return header.startswith('<') and '<invocation' in header
+
+
+def parse_record(path):
+    """
+    Parse a kickstart record, only the usage of the main job is kept so
+    the record is streamed through expat instead of building a tree and
+    captured stdout and stderr are never held in memory
+
+    :param path: path to kickstart record
+    :return: dictionary with start, start_ts, end_ts, duration, utime,
+             maxrss (KB), exitcode, host, site, bytes_in and bytes_out
+             (sizes of the files kickstart was asked to stat before and
+             after the job) for the main job or None if the record
+             doesn't have a main job
+    :raises xml.parsers.expat.ExpatError if the record isn't valid xml
+    :raises ValueError if the main job's times can't be read
+    """
+    data = {'duration': 0.0, 'utime': 0.0, 'maxrss': 0, 'exitcode': None,
+            'host': None, 'site': None, 'bytes_in': 0, 'bytes_out': 0}
+    # depth of nested mainjob elements, usage is only counted within one,
+    # the statcall being read and the site variable whose value is read
+    state = {'mainjob': 0, 'statcall': None, 'env': None}
+    site_values = {}
+
+    def start_element(name, attrs):
+        if name == 'mainjob':
+            state['mainjob'] += 1
+            data['start'] = attrs.get('start', '')
+            data['duration'] += float(attrs.get('duration', ''))
+        elif name == 'usage' and state['mainjob']:
+            data['utime'] += float(attrs.get('utime', ''))
+            if 'maxrss' in attrs:
+                data['maxrss'] = max(data['maxrss'], int(attrs['maxrss']))
+        elif name == 'regular' and state['mainjob']:
+            data['exitcode'] = int(attrs.get('exitcode', 0))
+        elif name == 'invocation':
+            data['host'] = attrs.get('hostname')
+        elif name == 'statcall':
+            state['statcall'] = attrs.get('id')
+        elif name == 'statinfo' and state['statcall'] == 'initial':
+            data['bytes_in'] += int(attrs.get('size', 0))
+        elif name == 'statinfo' and state['statcall'] == 'final':
+            data['bytes_out'] += int(attrs.get('size', 0))
+        elif name == 'env' and attrs.get('key') in SITE_VARIABLES:
+            state['env'] = attrs['key']
+            site_values[state['env']] = ''
+
+    def end_element(name):
+        if name == 'mainjob':
+            state['mainjob'] -= 1
+        elif name == 'statcall':
+            state['statcall'] = None
+        elif name == 'env':
+            state['env'] = None
+
+    def character_data(text):
+        if state['env'] is not None:
+            site_values[state['env']] += text
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+    for variable in SITE_VARIABLES:
+        if site_values.get(variable, '').strip():
+            data['site'] = site_values[variable].strip()
+            break
+    if 'start' not in data:
+        return None
+
+    # convert start date to unix ts
+    # example: 2016-05-18T12:55:23.507-05:00
+    start = dateutil.parser.parse(data['start'])
+    data['start_ts'] = calendar.timegm(start.utctimetuple())
+    data['end_ts'] = data['start_ts'] + int(data['duration'])
+    return data
+
+
+def parse_submit_file(path):
+    """
+    Retrieves the HTCondor classad from a submit file
+
+    :param path: full path to the submit file
+    :return: a dictionary of the classad
+    """
+    ad = {'request_cpus': 1}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+            if line.find('=') == -1:
+                continue
+            key, value = line.split('=', 1)
+            key = key.strip().lower()
+            value = value.strip()
+            ad[key] = value
+    return ad
+
+
+def parse_job_output(path):
+    """
+    Get usage for a pegasus job from its output file and submit file,
+    run in worker processes
+
+    :param path: path to job output file
+    :return: dictionary from parse_record with cores added or None if
+             the file isn't a kickstart record
+    """
+    logger = log.get_logger()
+    if not is_kickstart_record(path):
+        return None
+    try:
+        record = parse_record(path)
+    except (xml.parsers.expat.ExpatError, ValueError) as e:
+        logger.info("Got exception while parsing {0}:\n{1}".format(path, e))
+        return None
+    if record is None:
+        return None
+    submit = parse_submit_file(OUTPUT_FILE_RE.sub('.sub', path))
+    record['cores'] = int(submit['request_cpus'])
+    return record
+
+
+def get_job_outputs(submit_dir):
+    """
+    Get the job output files in a pegasus submit directory
+
+    :param submit_dir: the Pegasus workflow submit dir
+    :return: list of paths to job output files
+    """
+    return [os.path.join(submit_dir, entry)
+            for entry in os.listdir(submit_dir)
+            if OUTPUT_FILE_RE.search(entry)]
+
+
+def parse_job_outputs(paths, workers=None):
+    """
+    Parse job output files, using a pool of processes when there are
+    enough of them
+
+    :param paths: list of paths to job output files
+    :param workers: number of processes to use, defaults to cpu count
+    :return: list of results from parse_job_output in the same order
+             as paths
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 2 or len(paths) < POOL_THRESHOLD:
+        return [parse_job_output(path) for path in paths]
+    pool = multiprocessing.Pool(min(workers, len(paths)))
+    try:
+        return pool.map(parse_job_output, paths)
+    finally:
+        pool.terminate()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Layout of the directories holding a user's inputs and results.  This
+# is used by both the web interface and the backend scripts so that
+# they agree on where files go
+
+import errno
+import hashlib
+import os
+
+# directories created for each user in FREESURFER_BASE
+USER_DIRS = ('input', 'results', 'output', 'workflows')
+# directory in a user's input directory holding inputs stored by hash
+BLOB_DIR = 'blobs'
+# number of shard directories used for job inputs and blobs
+INPUT_SHARDS = 256
+# file written in a user's directory once the layout has been created
+LAYOUT_MARKER = '.layout'
+
+
+def make_dir(path, owner=None):
+    """
+    Create a directory, ignoring errors if it already exists
+
+    :param path: path to directory to create
+    :param owner: if not None, (uid, gid) tuple to give a new
+                  directory to
+    :return: None
+    """
+    try:
+        os.mkdir(path, 0o770)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return
+    if owner is not None:
+        os.chown(path, owner[0], owner[1])
+
+
+def input_shard(job_id):
+    """
+    Get the name of the shard directory holding a job's inputs
+
+    :param job_id: id of the job
+    :return: name of shard directory
+    """
+    return hashlib.md5(str(job_id)).hexdigest()[:2]
+
+
+def get_blob_path(input_dir, sha256):
+    """
+    Get the path used to store an input by hash
+
+    :param input_dir: path to the user's input directory
+    :param sha256: hex sha256 hash of the input
+    :return: path to stored input
+    """
+    return os.path.join(input_dir, BLOB_DIR, sha256[:2], sha256)
+
+
+def provision_user_dirs(user_dir, owner=None):
+    """
+    Create the directory layout used to hold a user's inputs and
+    results, existing directories are left alone.  Job inputs and
+    stored blobs go in shard directories named after the first two hex
+    digits of a hash so that no single directory gets an entry for
+    every job.  Once done, a marker file is written so that the web
+    interface can skip checking the layout
+
+    :param user_dir: path to the user's directory
+    :param owner: if not None, (uid, gid) tuple to give new directories
+                  to, used when the layout is created by another user
+                  than the web interface runs as
+    :return: None
+    """
+    make_dir(user_dir, owner)
+    for name in USER_DIRS:
+        make_dir(os.path.join(user_dir, name), owner)
+    input_dir = os.path.join(user_dir, 'input')
+    make_dir(os.path.join(input_dir, BLOB_DIR), owner)
+    for shard in range(INPUT_SHARDS):
+        make_dir(os.path.join(input_dir, "{0:02x}".format(shard)), owner)
+        make_dir(os.path.join(input_dir, BLOB_DIR, "{0:02x}".format(shard)),
+                 owner)
+    marker = os.path.join(user_dir, LAYOUT_MARKER)
+    open(marker, 'w').close()
+    if owner is not None:
+        os.chown(marker, owner[0], owner[1])
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import log
+
+# ioctl to share the blocks of one file with another (btrfs, xfs)
+FICLONE = 0x40049409
+# largest amount copied by a single copy_file_range or sendfile call
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# extension of the checksum manifests written next to worker outputs
+MANIFEST_EXTENSION = '.sha1'
+# files that are already compressed are stored in output zips as is
+STORED_EXTENSIONS = ('.mgz', '.gz', '.bz2', '.xz', '.zip', '.tgz')
+# members larger than this are spooled to disk when repackaging
+MEMORY_MEMBER_SIZE = 32 * 1024 * 1024
+
+_libc = None
+
+
+def get_libc():
+    """
+    Load the C library so copy_file_range and sendfile can be called,
+    python 2 doesn't provide either
+
+    :return: ctypes.CDLL instance or None if it can't be loaded
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc or None
+
+
+def file_checksum(path, algorithm='sha1'):
+    """
+    Get the checksum of a file
+
+    :param path: path to file
+    :param algorithm: name of hashlib algorithm to use
+    :return: hex digest of file
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def manifest_checksum(path):
+    """
+    Get the checksum computed by a worker for a file from the sha1sum
+    style manifest next to it
+
+    :param path: path to file
+    :return: hex digest from the manifest or None if there isn't one
+    """
+    manifest = path + MANIFEST_EXTENSION
+    if not os.path.isfile(manifest):
+        return None
+    name = os.path.basename(path)
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                continue
+            if os.path.basename(fields[1].strip().lstrip('*')) == name:
+                return fields[0].lower()
+    return None
+
+
+def link_file(source, destination):
+    """
+    Hardlink a file, only works if both are on the same filesystem
+
+    :param source: path to file
+    :param destination: path for the new link
+    :return: True if the file was linked, False otherwise
+    """
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                       errno.ENOTSUP, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def reflink_file(source_fd, destination_fd):
+    """
+    Clone a file's blocks into another file, only works on filesystems
+    with copy on write support
+
+    :param source_fd: file descriptor for the source
+    :param destination_fd: file descriptor for an empty destination
+    :return: True if the file was cloned, False otherwise
+    """
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def kernel_copy(source_fd, destination_fd, size):
+    """
+    Copy a file without passing the data through python using
+    copy_file_range or sendfile
+
+    :param source_fd: file descriptor for the source
+    :param destination_fd: file descriptor for an empty destination
+    :param size: number of bytes to copy
+    :return: True if the file was copied, False if neither call is
+             available
+    """
+    libc = get_libc()
+    if libc is None:
+        return False
+    copied = 0
+    for call in ('copy_file_range', 'sendfile'):
+        function = getattr(libc, call, None)
+        if function is None:
+            continue
+        function.restype = ctypes.c_ssize_t
+        while copied < size:
+            count = min(KERNEL_COPY_SIZE, size - copied)
+            if call == 'copy_file_range':
+                result = function(source_fd, None, destination_fd, None,
+                                  ctypes.c_size_t(count), ctypes.c_uint(0))
+            else:
+                result = function(destination_fd, source_fd, None,
+                                  ctypes.c_size_t(count))
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if copied == 0 and error in (errno.ENOSYS, errno.EXDEV,
+                                             errno.EINVAL, errno.EOPNOTSUPP):
+                    # try the next call
+                    break
+                raise OSError(error, os.strerror(error))
+            if result == 0:
+                break
+            copied += result
+        if copied >= size:
+            return True
+    if copied:
+        raise IOError("Short copy, {0} of {1} bytes copied".format(copied,
+                                                                   size))
+    return False
+
+
+def copy_data(source, destination):
+    """
+    Copy a file's contents to a new file using the fastest method
+    available
+
+    :param source: path to file
+    :param destination: path for copy, must not exist
+    :return: method used to copy the file
+    """
+    size = os.stat(source).st_size
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            if reflink_file(source_file.fileno(), destination_file.fileno()):
+                return 'reflink'
+            if kernel_copy(source_file.fileno(), destination_file.fileno(),
+                           size):
+                return 'kernel'
+            source_file.seek(0)
+            destination_file.seek(0)
+            destination_file.truncate()
+            shutil.copyfileobj(source_file, destination_file, READ_SIZE)
+            return 'copy'
+
+
+def publish_file(source, destination, checksum=None, algorithm='sha1'):
+    """
+    Make a file available at a new location without copying its
+    contents if possible.  A hardlink is used if both paths are on the
+    same filesystem, otherwise the file is cloned or copied by the
+    kernel and a normal copy is made as a last resort.  The file
+    appears at the destination atomically.
+
+    :param source: path to file
+    :param destination: path to publish the file at, replaced if present
+    :param checksum: if given, hex digest the published file must have
+    :param algorithm: hashlib algorithm used for checksum
+    :return: method used to publish the file
+    :raises IOError if the published file doesn't match the checksum
+    """
+    logger = log.get_logger()
+    directory = os.path.dirname(destination)
+    fd, temp_path = tempfile.mkstemp(dir=directory,
+                                     prefix='.' + os.path.basename(destination))
+    os.close(fd)
+    try:
+        os.unlink(temp_path)
+        if link_file(source, temp_path):
+            method = 'link'
+        else:
+            method = copy_data(source, temp_path)
+        if checksum is not None:
+            published_checksum = file_checksum(temp_path, algorithm)
+            if published_checksum != checksum.lower():
+                raise IOError("Checksum mismatch for {0}: expected {1} "
+                              "got {2}".format(source,
+                                               checksum,
+                                               published_checksum))
+        os.rename(temp_path, destination)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    logger.info("Published {0} to {1} using {2}".format(source,
+                                                        destination,
+                                                        method))
+    return method
+
+
+def get_zip_info(member):
+    """
+    Create the zip entry for a tar member
+
+    :param member: tarfile.TarInfo for the member
+    :return: zipfile.ZipInfo instance
+    """
+    # zip can't store dates before 1980
+    date_time = time.localtime(max(member.mtime, 315532800))[:6]
+    info = zipfile.ZipInfo(member.name, date_time)
+    info.create_system = 3
+    if member.issym():
+        info.external_attr = (stat.S_IFLNK | 0o777) << 16
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.external_attr = (stat.S_IFREG | (member.mode & 0o7777)) << 16
+        if member.name.lower().endswith(STORED_EXTENSIONS):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def repackage_output(source, destination):
+    """
+    Repackage a tarball as a zip file so that single files can be read
+    from it without decompressing everything before them.  Members are
+    compressed separately and files that are already compressed are
+    stored as is.  The zip appears at the destination atomically.
+
+    :param source: path to tarball
+    :param destination: path for the zip file, replaced if present
+    :return: number of files in the zip file
+    :raises IOError, OSError, tarfile.TarError if the tarball can't be
+            read or the zip file can't be written
+    """
+    logger = log.get_logger()
+    directory = os.path.dirname(destination)
+    fd, temp_path = tempfile.mkstemp(dir=directory,
+                                     prefix='.' + os.path.basename(destination))
+    os.close(fd)
+    spool_path = temp_path + '.member'
+    count = 0
+    try:
+        archive = tarfile.open(source, mode='r|*')
+        output = zipfile.ZipFile(temp_path, 'w', allowZip64=True)
+        try:
+            for member in archive:
+                if member.issym():
+                    output.writestr(get_zip_info(member), member.linkname)
+                    count += 1
+                    continue
+                if not member.isfile():
+                    # directories are implied by the paths of their files
+                    continue
+                info = get_zip_info(member)
+                member_file = archive.extractfile(member)
+                if member.size <= MEMORY_MEMBER_SIZE:
+                    output.writestr(info, member_file.read())
+                else:
+                    with open(spool_path, 'wb') as f:
+                        shutil.copyfileobj(member_file, f, READ_SIZE)
+                    os.chmod(spool_path, member.mode & 0o7777)
+                    os.utime(spool_path, (member.mtime, member.mtime))
+                    output.write(spool_path, member.name, info.compress_type)
+                    os.unlink(spool_path)
+                count += 1
+        finally:
+            output.close()
+            archive.close()
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, destination)
+    except (IOError, OSError, tarfile.TarError, zipfile.LargeZipFile):
+        for path in (temp_path, spool_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    logger.info("Repackaged {0} as {1} with {2} files".format(source,
+                                                             destination,
+                                                             count))
+    return count
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+import collections
+import os
+import re
+import subprocess
+import tarfile
+import tempfile
+import time
+import xml.parsers.expat
+
+import kickstart
+import log
+
+# intermediate archives written by the autorecon stages, e.g.
+# subject_recon1_output.tar.xz or subject_recon2_lh_output.tar.xz
+ARCHIVE_RE = re.compile(r'_recon[0-9].*_output\.tar\.xz$')
+# recon-all logs inside the intermediate archives
+LOG_MEMBER_RE = re.compile(r'(^|/)scripts/recon-all[^/]*\.log$')
+SCRIPTS_DIR_RE = re.compile(r'(^|/)scripts(/|$)')
+# condor stderr files for pegasus jobs, e.g. autorecon1_ID0000001.err.000
+ERROR_FILE_RE = re.compile(r'\.err\.[0-9]+$')
+# bytes kept from the end of each log that is recovered
+TAIL_SIZE = 256 * 1024
+# maximum size of the combined log
+LOG_SIZE = 4 * 1024 * 1024
+# seconds spent looking for logs in an archive before giving up
+ARCHIVE_TIME_LIMIT = 30
+READ_SIZE = 64 * 1024
+TRUNCATED_MESSAGE = "[... earlier output truncated ...]\n"
+
+
+class TailBuffer(object):
+    """
+    Keep the last bytes written to it so logs can be read without
+    holding all of them in memory
+    """
+    def __init__(self, limit=TAIL_SIZE):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.truncated = False
+
+    def write(self, data):
+        """
+        Add data to the end of the buffer, dropping data from the start
+        if the buffer is over its limit
+
+        :param data: string to add
+        :return: None
+        """
+        if not data:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        """
+        Get the contents of the buffer
+
+        :return: string with at most limit bytes
+        """
+        value = ''.join(self.chunks)
+        if len(value) > self.limit:
+            self.truncated = True
+            value = value[-self.limit:]
+        return value
+
+
+def read_captures(path, limit=TAIL_SIZE):
+    """
+    Get the end of the stdout and stderr captured by kickstart for a job
+    by streaming the record through expat
+
+    :param path: path to kickstart record
+    :param limit: bytes kept from each capture
+    :return: tuple of (exit code of the main job or None,
+             dictionary mapping stdout and stderr to TailBuffers)
+    :raises xml.parsers.expat.ExpatError if the record isn't valid xml
+    """
+    captures = {'stdout': TailBuffer(limit), 'stderr': TailBuffer(limit)}
+    # statcall being read, whether its data is being read and exitcode
+    state = {'statcall': None, 'data': False, 'mainjob': 0, 'exitcode': None}
+
+    def start_element(name, attrs):
+        if name == 'mainjob':
+            state['mainjob'] += 1
+        elif name == 'regular' and state['mainjob']:
+            state['exitcode'] = int(attrs.get('exitcode', 0))
+        elif name == 'statcall':
+            state['statcall'] = attrs.get('id')
+        elif name == 'data' and state['statcall'] in captures:
+            state['data'] = True
+
+    def end_element(name):
+        if name == 'mainjob':
+            state['mainjob'] -= 1
+        elif name == 'statcall':
+            state['statcall'] = None
+        elif name == 'data':
+            state['data'] = False
+
+    def character_data(text):
+        if state['data']:
+            captures[state['statcall']].write(text.encode('utf-8'))
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+    return state['exitcode'], captures
+
+
+def read_tail(path, limit=TAIL_SIZE):
+    """
+    Get the end of a file without reading all of it
+
+    :param path: path to file
+    :param limit: bytes to read from the end of the file
+    :return: a TailBuffer with the end of the file
+    """
+    tail = TailBuffer(limit)
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - limit, 0))
+        tail.truncated = size > limit
+        tail.write(f.read(limit))
+    return tail
+
+
+def get_job_logs(submit_dir, limit=TAIL_SIZE):
+    """
+    Get the output captured for the jobs in a pegasus submit dir, output
+    from jobs that failed is returned first
+
+    :param submit_dir: the Pegasus workflow submit dir
+    :param limit: bytes kept from each capture
+    :return: list of (label, TailBuffer) tuples
+    """
+    logger = log.get_logger()
+    if not os.path.isdir(submit_dir):
+        return []
+    failed = []
+    succeeded = []
+    for path in sorted(kickstart.get_job_outputs(submit_dir)):
+        try:
+            if not kickstart.is_kickstart_record(path):
+                continue
+            exitcode, captures = read_captures(path, limit)
+        except (IOError, OSError, xml.parsers.expat.ExpatError) as e:
+            logger.info("Can't read captures from {0}: {1}".format(path, e))
+            continue
+        name = os.path.basename(path)
+        for stream in ('stdout', 'stderr'):
+            if not captures[stream].size:
+                continue
+            label = "{0} {1} (exit code {2})".format(name, stream, exitcode)
+            if exitcode == 0:
+                succeeded.append((label, captures[stream]))
+            else:
+                failed.append((label, captures[stream]))
+    for entry in sorted(os.listdir(submit_dir)):
+        path = os.path.join(submit_dir, entry)
+        if not ERROR_FILE_RE.search(entry) or not os.path.getsize(path):
+            continue
+        try:
+            failed.append((entry, read_tail(path, limit)))
+        except (IOError, OSError) as e:
+            logger.info("Can't read {0}: {1}".format(path, e))
+    return failed + succeeded
+
+
+def find_archives(directories):
+    """
+    Find the intermediate archives left in a set of directories
+
+    :param directories: list of directories to search
+    :return: list of paths to archives, newest first
+    """
+    archives = []
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            archives.extend(os.path.join(root, filename)
+                            for filename in files
+                            if ARCHIVE_RE.search(filename))
+    return sorted(archives, key=lambda x: os.stat(x).st_mtime, reverse=True)
+
+
+def get_archive_logs(path, limit=TAIL_SIZE, time_limit=ARCHIVE_TIME_LIMIT):
+    """
+    Get the recon-all logs from an intermediate archive by streaming it
+    through xz and tarfile.  Tar stores a directory's files together so
+    reading stops once the scripts directory has been read, or when
+    the time limit runs out
+
+    :param path: path to archive
+    :param limit: bytes kept from each log
+    :param time_limit: seconds to spend reading the archive
+    :return: list of (label, TailBuffer) tuples
+    """
+    logger = log.get_logger()
+    deadline = time.time() + time_limit
+    logs = []
+    devnull = open(os.devnull, 'w')
+    try:
+        xz = subprocess.Popen(['xz', '-dc', path],
+                              stdout=subprocess.PIPE,
+                              stderr=devnull)
+    except OSError as e:
+        logger.error("Can't run xz to read {0}: {1}".format(path, e))
+        devnull.close()
+        return logs
+    in_scripts = False
+    try:
+        archive = tarfile.open(fileobj=xz.stdout, mode='r|')
+        for member in archive:
+            if SCRIPTS_DIR_RE.search(member.name):
+                in_scripts = True
+            elif in_scripts:
+                break
+            if time.time() > deadline:
+                logger.warning("Timed out reading logs from {0}".format(path))
+                break
+            if not member.isfile() or not LOG_MEMBER_RE.search(member.name):
+                continue
+            tail = TailBuffer(limit)
+            member_file = archive.extractfile(member)
+            while True:
+                data = member_file.read(READ_SIZE)
+                if not data:
+                    break
+                tail.write(data)
+            logs.append(("{0}:{1}".format(os.path.basename(path),
+                                          member.name), tail))
+    except (IOError, EOFError, tarfile.TarError) as e:
+        logger.info("Can't read {0}: {1}".format(path, e))
+    finally:
+        xz.stdout.close()
+        if xz.poll() is None:
+            xz.kill()
+        xz.wait()
+        devnull.close()
+    return logs
+
+
+def write_combined_log(sections, path, limit=LOG_SIZE):
+    """
+    Write recovered logs to a single file, the file appears at path
+    atomically
+
+    :param sections: list of (label, TailBuffer) tuples
+    :param path: path to write the combined log to
+    :param limit: maximum size of the combined log
+    :return: number of sections written
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix='.' + os.path.basename(path))
+    written = 0
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for label, tail in sections:
+                text = tail.getvalue()
+                if written and size + len(text) > limit:
+                    break
+                header = "===== {0} =====\n".format(label)
+                if tail.truncated:
+                    header += TRUNCATED_MESSAGE
+                f.write(header)
+                f.write(text)
+                if not text.endswith('\n'):
+                    f.write('\n')
+                size += len(header) + len(text)
+                written += 1
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return written
+
+
+def recover_logs(submit_dir, search_dirs, path):
+    """
+    Recover logs for a failed workflow, the recon-all logs from the
+    newest intermediate archive and the output captured for the
+    workflow's jobs are combined into one log
+
+    :param submit_dir: the Pegasus workflow submit dir
+    :param search_dirs: list of directories to look for archives in
+    :param path: path to write the combined log to
+    :return: True if any logs were recovered, False otherwise
+    """
+    logger = log.get_logger()
+    sections = []
+    for archive in find_archives(search_dirs):
+        archive_logs = get_archive_logs(archive)
+        if archive_logs:
+            # later archives have the logs from earlier stages
+            sections.extend(archive_logs)
+            break
+    sections.extend(get_job_logs(submit_dir))
+    if not sections:
+        logger.info("No logs found in {0}".format(submit_dir))
+        return False
+    written = write_combined_log(sections, path)
+    logger.info("Recovered {0} logs to {1}".format(written, path))
+    return True
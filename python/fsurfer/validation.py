@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+import gzip
+import struct
+import zipfile
+import zlib
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+NIFTI2_MAGIC = 'n+2\x00\r\n\x1a\n'
+MGH_HEADER_SIZE = 284
+MGH_VERSION = 1
+# bytes per voxel for mgh data types (uchar, int, float, short)
+MGH_TYPE_SIZES = {0: 1, 1: 4, 3: 4, 4: 2}
+# magic numbers for MINC 1 (netCDF) and MINC 2 (HDF5) files
+MINC_MAGIC = ('CDF\x01', 'CDF\x02', '\x89HDF\r\n\x1a\n')
+# limits for each of the three spatial dimensions of a volume
+MIN_DIMENSION = 16
+MAX_DIMENSION = 2048
+READ_SIZE = 1024 * 1024
+
+
+def open_input(path):
+    """
+    Open an input file, decompressing it if needed
+
+    :param path: path to file
+    :return: file object
+    """
+    if path.lower().endswith('.gz') or path.lower().endswith('.mgz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_to_end(fh):
+    """
+    Read the rest of a file, for compressed files this also verifies the
+    checksum of the gzip stream
+
+    :param fh: file object to read from
+    :return: number of bytes read
+    """
+    size = 0
+    while True:
+        data = fh.read(READ_SIZE)
+        if not data:
+            return size
+        size += len(data)
+
+
+def check_dimensions(dims):
+    """
+    Check that a volume has three spatial dimensions of a sensible size
+
+    :param dims: list of dimensions for the volume
+    :return: None if dimensions are ok, otherwise an error message
+    """
+    if len(dims) < 3:
+        return "Volume has {0} dimensions, need at least 3".format(len(dims))
+    for dim in dims[:3]:
+        if dim < MIN_DIMENSION or dim > MAX_DIMENSION:
+            return "Volume dimensions {0} are out of range".format(
+                'x'.join(str(x) for x in dims))
+    return None
+
+
+def validate_nifti(path):
+    """
+    Check the header of a NIfTI-1 or NIfTI-2 single file volume and
+    make sure the file holds all of the voxel data
+
+    :param path: path to file
+    :return: tuple of (True if valid, error message)
+    """
+    with open_input(path) as fh:
+        header = fh.read(NIFTI1_HEADER_SIZE)
+        if len(header) < NIFTI1_HEADER_SIZE:
+            return False, "File too short for a NIfTI header"
+        for endian in ('<', '>'):
+            header_size = struct.unpack(endian + 'i', header[:4])[0]
+            if header_size in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+                break
+        else:
+            return False, "Not a NIfTI file"
+        if header_size == NIFTI1_HEADER_SIZE:
+            if header[344:348] != 'n+1\x00':
+                return False, "Not a single file NIfTI-1 volume"
+            dims = struct.unpack(endian + '8h', header[40:56])
+            bitpix = struct.unpack(endian + 'h', header[72:74])[0]
+            vox_offset = int(struct.unpack(endian + 'f', header[108:112])[0])
+        else:
+            header += fh.read(NIFTI2_HEADER_SIZE - NIFTI1_HEADER_SIZE)
+            if len(header) < NIFTI2_HEADER_SIZE:
+                return False, "File too short for a NIfTI-2 header"
+            if header[4:12] != NIFTI2_MAGIC:
+                return False, "Not a single file NIfTI-2 volume"
+            bitpix = struct.unpack(endian + 'h', header[14:16])[0]
+            dims = struct.unpack(endian + '8q', header[16:80])
+            vox_offset = struct.unpack(endian + 'q', header[168:176])[0]
+        if dims[0] < 1 or dims[0] > 7:
+            return False, "Invalid number of dimensions in NIfTI header"
+        dims = dims[1:dims[0] + 1]
+        message = check_dimensions(dims)
+        if message:
+            return False, message
+        if bitpix <= 0 or bitpix % 8 != 0:
+            return False, "Invalid bits per voxel in NIfTI header"
+        data_size = bitpix / 8
+        for dim in dims:
+            data_size *= max(dim, 1)
+        size = len(header) + read_to_end(fh)
+    if size < vox_offset + data_size:
+        return False, "NIfTI file is truncated, expected {0} bytes and " \
+                      "found {1}".format(vox_offset + data_size, size)
+    return True, None
+
+
+def validate_mgh(path):
+    """
+    Check the header of a MGH/MGZ volume and make sure the file holds
+    all of the voxel data
+
+    :param path: path to file
+    :return: tuple of (True if valid, error message)
+    """
+    with open_input(path) as fh:
+        header = fh.read(MGH_HEADER_SIZE)
+        if len(header) < MGH_HEADER_SIZE:
+            return False, "File too short for a MGH header"
+        fields = struct.unpack('>7i', header[:28])
+        version, width, height, depth, frames, data_type, _ = fields
+        if version != MGH_VERSION:
+            return False, "Not a MGH file"
+        if data_type not in MGH_TYPE_SIZES:
+            return False, "Unknown data type {0} in MGH header".format(data_type)
+        message = check_dimensions([width, height, depth])
+        if message:
+            return False, message
+        if frames < 1:
+            return False, "Invalid number of frames in MGH header"
+        data_size = width * height * depth * frames * MGH_TYPE_SIZES[data_type]
+        size = read_to_end(fh)
+    if size < data_size:
+        return False, "MGH file is truncated, expected {0} bytes of " \
+                      "data and found {1}".format(data_size, size)
+    return True, None
+
+
+def validate_minc(path):
+    """
+    Check that a file looks like a MINC 1 or MINC 2 volume
+
+    :param path: path to file
+    :return: tuple of (True if valid, error message)
+    """
+    with open(path, 'rb') as fh:
+        magic = fh.read(8)
+    for minc_magic in MINC_MAGIC:
+        if magic.startswith(minc_magic):
+            return True, None
+    return False, "Not a MINC file"
+
+
+def validate_subject_dir(path):
+    """
+    Check that a zip file with a subject directory can be read, all
+    members pass their checksums and that it has a mri directory
+
+    :param path: path to file
+    :return: tuple of (True if valid, error message)
+    """
+    if not zipfile.is_zipfile(path):
+        return False, "Not a zip file or central directory is missing"
+    with zipfile.ZipFile(path) as zip_file:
+        names = zip_file.namelist()
+        if not names:
+            return False, "Zip file is empty"
+        if not any('mri' in name.split('/')[:-1] for name in names):
+            return False, "Zip file does not have a mri directory"
+        bad_member = zip_file.testzip()
+        if bad_member is not None:
+            return False, "Zip file member {0} is corrupt".format(bad_member)
+    return True, None
+
+
+def validate_input(path, filename, subject_dir):
+    """
+    Check that an uploaded input can be used for a workflow
+
+    :param path: path to uploaded file
+    :param filename: name of file as uploaded
+    :param subject_dir: True if the file is a zipped subject directory
+    :return: tuple of (True if valid, error message)
+    """
+    filename = filename.lower()
+    try:
+        if subject_dir:
+            return validate_subject_dir(path)
+        elif filename.endswith('.nii') or filename.endswith('.nii.gz'):
+            return validate_nifti(path)
+        elif filename.endswith('.mgh') or filename.endswith('.mgz'):
+            return validate_mgh(path)
+        elif filename.endswith('.mnc'):
+            return validate_minc(path)
+    except (IOError, EOFError, struct.error, zlib.error,
+            zipfile.BadZipfile) as e:
+        return False, "Can't read {0}: {1}".format(filename, e)
+    return False, "Unsupported file type for {0}".format(filename)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Repackage the outputs of completed workflows as zip files so that
+# users can download single files from them.  This is run periodically
+# instead of when a workflow finishes because repackaging a large output
+# takes a while and workflows shouldn't wait for it to be marked as
+# completed.  Until the zip is written, users can download the full
+# output
+import argparse
+import fcntl
+import os
+import sys
+
+import psycopg2
+
+import fsurfer
+import fsurfer.helpers
+import fsurfer.log
+import fsurfer.publish
+
+VERSION = fsurfer.__version__
+# workflows that completed more than this many hours ago are skipped
+MAX_AGE = 24
+
+
+def get_completed_workflows(conn, max_age):
+    """
+    Get the workflows that have recently completed
+
+    :param conn: database connection to use
+    :param max_age: hours since completion for workflows to include
+    :return: list of (job_id, username, subject) tuples
+    :raises psycopg2.Error
+    """
+    job_query = "SELECT jobs.id, " \
+                "       jobs.username, " \
+                "       jobs.subject " \
+                "FROM freesurfer_interface.jobs AS jobs " \
+                "WHERE jobs.state = 'COMPLETED' AND " \
+                "      EXISTS (SELECT 1 " \
+                "              FROM freesurfer_interface.job_run AS job_run " \
+                "              WHERE job_run.job_id = jobs.id AND " \
+                "                    job_run.ended > CURRENT_TIMESTAMP - " \
+                "                                    %s * INTERVAL '1 hour') " \
+                "ORDER BY jobs.id"
+    cursor = conn.cursor()
+    cursor.execute(job_query, [max_age])
+    workflows = cursor.fetchall()
+    conn.commit()
+    return workflows
+
+
+def index_output(output_filename, zip_filename):
+    """
+    Repackage a published output as a zip file so that users can
+    download single files from it
+
+    :param output_filename: path to the published output tarball
+    :param zip_filename: path to write the zip file to
+    :return: True if the zip file was written, False otherwise
+    """
+    logger = fsurfer.log.get_logger()
+    try:
+        fsurfer.publish.repackage_output(output_filename, zip_filename)
+    except Exception as e:
+        # the tarball can still be downloaded
+        logger.exception("Can't repackage output, got exception: {0}".format(e))
+        return False
+    return True
+
+
+def main():
+    """
+    Repackage the outputs of recently completed workflows that don't
+    have a zip file yet
+
+    :return: exit code (0 for success, non-zero for failure)
+    """
+    fsurfer.log.initialize_logging()
+    logger = fsurfer.log.get_logger()
+    parser = argparse.ArgumentParser(description="Repackage workflow outputs "
+                                                 "as zip files")
+    # version info
+    parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
+    # Arguments for action
+    parser.add_argument('--dry-run', dest='dry_run',
+                        action='store_true', default=False,
+                        help='Mock actions instead of carrying them out')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true', default=False,
+                        help='Output debug messages')
+    parser.add_argument('--max-age', dest='max_age', type=int,
+                        default=MAX_AGE,
+                        help='Only index outputs of workflows that '
+                             'completed within this many hours')
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.debug:
+        fsurfer.log.set_debugging()
+    if args.dry_run:
+        sys.stdout.write("Doing a dry run, no changes will be made\n")
+    try:
+        x = open('/tmp/fsurf_index.lock', 'w+')
+        fcntl.flock(x, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.warn('Lock file present, exiting')
+        sys.exit(1)
+
+    try:
+        conn = fsurfer.helpers.get_db_client()
+        workflows = get_completed_workflows(conn, args.max_age)
+        conn.close()
+    except psycopg2.Error as e:
+        logger.exception("Got pgsql error: {0}".format(e))
+        return 1
+    errors = False
+    for job_id, username, subject in workflows:
+        results_dir = os.path.join(fsurfer.FREESURFER_BASE,
+                                   username,
+                                   'results')
+        output_filename = os.path.join(results_dir,
+                                       "{0}_{1}_output.tar.bz2".format(job_id,
+                                                                       subject))
+        zip_filename = os.path.join(results_dir,
+                                    "{0}_{1}_output.zip".format(job_id,
+                                                                subject))
+        if not os.path.isfile(output_filename) or \
+           os.path.isfile(zip_filename):
+            continue
+        if args.dry_run:
+            sys.stdout.write("Would repackage {0}\n".format(output_filename))
+            continue
+        logger.info("Repackaging output for workflow {0}".format(job_id))
+        if not index_output(output_filename, zip_filename):
+            errors = True
+    if errors:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
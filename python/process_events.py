@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Apply the task and workflow notifications that fsurf_event.py writes
+# to the event spool.  Events are applied in batches using a single
+# database connection instead of starting a process and connecting to
+# the database for every task that finishes
+import argparse
+import collections
+import fcntl
+import os
+import sys
+import time
+
+import psycopg2
+
+import fsurfer
+import fsurfer.helpers
+import fsurfer.log
+import task_completed
+import workflow_completed
+
+VERSION = fsurfer.__version__
+# must match SPOOL_DIR in fsurf_event.py
+SPOOL_DIR = '~/spool/fsurf'
+# maximum number of events applied in one transaction
+BATCH_SIZE = 500
+# seconds to wait before checking the spool for new events
+POLL_INTERVAL = 2
+# seconds to wait before retrying a workflow event that couldn't be applied
+RETRY_INTERVAL = 60
+# times that workflow events that couldn't be applied can be retried
+RETRY_TIMES = {}
+
+
+def read_event(path):
+    """
+    Read an event written by fsurf_event.py
+
+    :param path: path to event file
+    :return: dictionary with the event or None if it isn't valid
+    """
+    event = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.rstrip('\n').partition('=')
+            if sep:
+                event[key] = value
+    if event.get('event') not in ('task', 'workflow') or \
+            not event.get('id', '').isdigit():
+        return None
+    event['id'] = int(event['id'])
+    return event
+
+
+def get_pending_events(spool_dir, limit=BATCH_SIZE):
+    """
+    Get the oldest events in the spool, events waiting to be retried
+    are skipped until their retry time
+
+    :param spool_dir: path to the spool directory
+    :param limit: maximum number of events to return
+    :return: list of (path, event) tuples in the order the events were
+             written, event is None if the event isn't valid
+    """
+    logger = fsurfer.log.get_logger()
+    new_dir = os.path.join(spool_dir, 'new')
+    if not os.path.isdir(new_dir):
+        return []
+    now = time.time()
+    paths = [os.path.join(new_dir, filename)
+             for filename in sorted(os.listdir(new_dir))]
+    events = []
+    for path in [x for x in paths if RETRY_TIMES.get(x, 0) <= now][:limit]:
+        try:
+            events.append((path, read_event(path)))
+        except (IOError, OSError) as e:
+            logger.exception("Can't read event {0}: {1}".format(path, e))
+    return events
+
+
+def apply_task_events(conn, events):
+    """
+    Record the tasks that finished and increment the # of tasks
+    completed for their workflows using the current transaction
+
+    :param conn: database connection to use
+    :param events: list of task events
+    :return: None
+    :raises psycopg2.Error
+    """
+    logger = fsurfer.log.get_logger()
+    cursor = conn.cursor()
+    completed = collections.OrderedDict()
+    for event in events:
+        job_run_id = event['id']
+        try:
+            info = task_completed.get_task_info(event)
+        except (IOError, OSError) as e:
+            logger.exception("Can't read task output, got exception: {0}".format(e))
+            info = None
+        if info is not None:
+            logger.info("Recording task {0} for workflow {1}".format(info['task'],
+                                                                     job_run_id))
+            cursor.execute("SAVEPOINT record_task")
+            try:
+                task_completed.record_task(cursor, job_run_id, info)
+            except psycopg2.Error as e:
+                # still count the task even if its usage can't be saved
+                logger.exception("Can't record task, got pgsql error: {0}".format(e))
+                cursor.execute("ROLLBACK TO SAVEPOINT record_task")
+            cursor.execute("RELEASE SAVEPOINT record_task")
+        status = event.get('PEGASUS_STATUS', '0')
+        if status != '0':
+            logger.info("Task failed with status {0}".format(status))
+            continue
+        completed[job_run_id] = completed.get(job_run_id, 0) + 1
+    for job_run_id, count in completed.items():
+        logger.info("Incrementing tasks completed for workflow "
+                    "{0} by {1}".format(job_run_id, count))
+        task_completed.increment_tasks(cursor, job_run_id, count)
+
+
+def remove_events(paths):
+    """
+    Remove events from the spool once they have been applied
+
+    :param paths: list of paths to event files
+    :return: None
+    """
+    logger = fsurfer.log.get_logger()
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            logger.exception("Can't remove event {0}: {1}".format(path, e))
+
+
+def apply_workflow_event(conn, event):
+    """
+    Process the results of a workflow that finished
+
+    :param conn: database connection to use
+    :param event: workflow event
+    :return: True if the results were processed, False otherwise
+    :raises psycopg2.Error if the database connection was lost
+    """
+    logger = fsurfer.log.get_logger()
+    success = event.get('success') == 'True'
+    logger.info("Processing workflow {0}, success: {1}".format(event['id'],
+                                                               success))
+    try:
+        if workflow_completed.process_results(event['id'], success, conn):
+            return True
+    except Exception as e:
+        logger.exception("Can't process workflow {0}, "
+                         "got exception: {1}".format(event['id'], e))
+    if conn.closed:
+        raise psycopg2.InterfaceError("connection to database lost")
+    return False
+
+
+def process_events(conn, spool_dir, dry_run=False):
+    """
+    Apply the events in the spool, removing events once they have been
+    applied.  Workflow events that can't be applied are kept and
+    retried after RETRY_INTERVAL seconds
+
+    :param conn: database connection to use
+    :param spool_dir: path to the spool directory
+    :param dry_run: if True, report events without applying them
+    :return: number of events applied
+    :raises psycopg2.Error
+    """
+    logger = fsurfer.log.get_logger()
+    processed = 0
+    while True:
+        pending = get_pending_events(spool_dir)
+        if not pending:
+            break
+        task_events = []
+        workflow_events = []
+        applied = []
+        for path, event in pending:
+            if dry_run:
+                sys.stdout.write("{0}: {1}\n".format(os.path.basename(path),
+                                                     event))
+            elif event is None:
+                logger.error("Ignoring invalid event {0}".format(path))
+                applied.append(path)
+            elif event['event'] == 'task':
+                task_events.append(event)
+                applied.append(path)
+            else:
+                workflow_events.append((path, event))
+        if dry_run:
+            return len(pending)
+
+        try:
+            apply_task_events(conn, task_events)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        remove_events(applied)
+        # workflows finish after their tasks, so they are processed
+        # once the batch's tasks have been counted.  Each event is
+        # removed as soon as it's processed so users aren't emailed twice
+        for path, event in workflow_events:
+            if apply_workflow_event(conn, event):
+                RETRY_TIMES.pop(path, None)
+                remove_events([path])
+            else:
+                logger.error("Keeping event {0} to retry later".format(path))
+                RETRY_TIMES[path] = time.time() + RETRY_INTERVAL
+        processed += len(pending)
+        if len(pending) < BATCH_SIZE:
+            break
+    return processed
+
+
+def main():
+    """
+    Apply events from the spool, waiting for new events
+
+    :return: exit code (0 for success, non-zero for failure)
+    """
+    fsurfer.log.initialize_logging()
+    logger = fsurfer.log.get_logger()
+    parser = argparse.ArgumentParser(description="Apply task and workflow "
+                                                 "events from pegasus")
+    # version info
+    parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
+    # Arguments for action
+    parser.add_argument('--dry-run', dest='dry_run',
+                        action='store_true', default=False,
+                        help='Mock actions instead of carrying them out')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true', default=False,
+                        help='Output debug messages')
+    parser.add_argument('--once', dest='once',
+                        action='store_true', default=False,
+                        help='Apply pending events and exit')
+    parser.add_argument('--spool', dest='spool_dir',
+                        default=SPOOL_DIR,
+                        help='Directory events are written to')
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.debug:
+        fsurfer.log.set_debugging()
+    if args.dry_run:
+        sys.stdout.write("Doing a dry run, no changes will be made\n")
+    try:
+        x = open('/tmp/fsurf_events.lock', 'w+')
+        fcntl.flock(x, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.warn('Lock file present, exiting')
+        sys.exit(1)
+
+    spool_dir = os.path.expanduser(args.spool_dir)
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = fsurfer.helpers.get_db_client()
+            processed = process_events(conn, spool_dir, args.dry_run)
+            if processed:
+                logger.info("Applied {0} events".format(processed))
+        except Exception as e:
+            # events stay in the spool and are applied on a later pass
+            logger.exception("Can't apply events, got exception: {0}".format(e))
+            if args.once:
+                return 1
+            if conn is not None and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()
+        if args.once or args.dry_run:
+            break
+        time.sleep(POLL_INTERVAL)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
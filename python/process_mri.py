@@ -90,7 +90,7 @@ def submit_workflow(subject_files, version, subject_name, user, job_run_id,
         dax.addFile(dax_subject_file)
     workflow_directory = os.path.join(fsurfer.FREESURFER_SCRATCH, user, 'workflows')
     output_directory = os.path.join(fsurfer.FREESURFER_BASE, user, 'workflows', 'output')
-    job_invoke_cmd = "/usr/bin/task_completed.py --id {0}".format(job_run_id)
+    job_invoke_cmd = "/usr/bin/fsurf_event.py task --id {0}".format(job_run_id)
     if workflow == 'serial':
         created = fsurfer.create_serial_workflow(dax,
                                                  version,
@@ -130,7 +130,8 @@ def submit_workflow(subject_files, version, subject_name, user, job_run_id,
                                                      2,  # custom workflows get 2 cores
                                                      dax_subject_files[0],
                                                      subject_name,
-                                                     options)
+                                                     options,
+                                                     invoke_cmd=job_invoke_cmd)
     else:
         created = fsurfer.create_serial_workflow(dax,
                                                  version,
@@ -139,8 +140,8 @@ def submit_workflow(subject_files, version, subject_name, user, job_run_id,
                                                  subject_name)
     if created:
         curr_date = time.strftime("%Y%m%d_%H%M%S", time.gmtime(time.time()))
-        dax.invoke('on_success', "/usr/bin/workflow_completed.py --success --id {0}".format(job_run_id))
-        dax.invoke('on_error', "/usr/bin/workflow_completed.py --failure --id {0}".format(job_run_id))
+        dax.invoke('on_success', "/usr/bin/fsurf_event.py workflow --success --id {0}".format(job_run_id))
+        dax.invoke('on_error', "/usr/bin/fsurf_event.py workflow --failure --id {0}".format(job_run_id))
         dax_name = "freesurfer_{0}.xml".format(curr_date)
         with open(dax_name, 'w') as f:
             dax.writeXML(f)
@@ -230,14 +231,27 @@ def process_images():
 
     conn = fsurfer.helpers.get_db_client()
     cursor = conn.cursor()
+    # only plan workflows once all of their inputs have been uploaded
+    # and validated by validate_inputs.py
     job_query = "SELECT id, username, num_inputs, subject, options, version " \
-                "FROM freesurfer_interface.jobs " \
-                "WHERE state = 'QUEUED'" \
+                "FROM freesurfer_interface.jobs AS jobs " \
+                "WHERE state = 'QUEUED' AND " \
+                "      num_inputs = (SELECT count(DISTINCT filename) " \
+                "                    FROM freesurfer_interface.input_files " \
+                "                    WHERE job_id = jobs.id AND " \
+                "                          state = 'VALID' AND " \
+                "                          NOT purged) " \
                 "ORDER BY RANDOM() " \
                 "LIMIT %s"
-    input_file_query = "SELECT filename, path, subject_dir " \
+    # an upload that was retried may have left more than one row for
+    # an input, only use the first of them
+    input_file_query = "SELECT DISTINCT ON (filename) " \
+                       "       filename, path, subject_dir " \
                        "FROM freesurfer_interface.input_files " \
-                       "WHERE job_id = %s AND NOT purged"
+                       "WHERE job_id = %s AND " \
+                       "      state = 'VALID' AND " \
+                       "      NOT purged " \
+                       "ORDER BY filename, id"
     job_update = "UPDATE freesurfer_interface.jobs " \
                  "SET state = 'RUNNING' " \
                  "WHERE id = %s;"
@@ -253,7 +267,7 @@ def process_images():
                     "VALUES(%s, %s) " \
                     "RETURNING id"
     try:
-        cursor.execute(job_query, (MAX_RUNNING_WORKFLOWS))
+        cursor.execute(job_query, [MAX_RUNNING_WORKFLOWS])
         for row in cursor.fetchall():
             workflow_id = row[0]
             username = row[1]
@@ -331,6 +345,7 @@ def process_images():
                                                 job_run_id])
             if pegasus_ts and not args.dry_run:
                 cursor.execute(job_update, [workflow_id])
+                fsurfer.helpers.notify_job_event(cursor, job_run_id)
                 conn.commit()
                 logger.info("Set workflow {0} status to RUNNING".format(workflow_id))
             else:
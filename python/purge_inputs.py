@@ -45,7 +45,6 @@ def remove_input_directory(input_dir):
     if not os.path.exists(input_dir):
         return True
     try:
-        input_dir = os.path.dirname(input_dir)
         os.rmdir(input_dir)
         logger.info("Removed directory {0}".format(input_dir))
         return True
@@ -112,14 +111,18 @@ def process_inputs():
                     sys.stdout.write("Would delete {0}\n".format(input_file))
                     continue
                 if not os.path.exists(input_file):
+                    # already gone, still mark it purged and release
+                    # the stored input it refers to
                     logger.info("File not present")
-                    continue
-                if not remove_input_file(input_file):
+                elif not remove_input_file(input_file):
                     file_removal_error = True
                     logger.error("Can't remove {0} for job {1}".format(input_file,
                                                                        row[0]))
                 cursor3 = conn.cursor()
                 cursor3.execute(input_update, [input_row[0]])
+                if not fsurfer.helpers.release_input_blob(cursor3, input_row[0]):
+                    logger.error("Can't release stored input for "
+                                 "{0} for job {1}".format(input_file, row[0]))
 
             if not file_removal_error and input_directory:
                 if args.dry_run:
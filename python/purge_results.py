@@ -17,13 +17,15 @@ PARAM_FILE_LOCATION = "/etc/fsurf/db_info"
 VERSION = fsurfer.__version__
 
 
-def purge_workflow_files(result_dir, log_filename, output_filename):
+def purge_workflow_files(result_dir, log_filename, output_filename,
+                         zip_filename):
     """
     Remove the results in specified directory
 
     :param result_dir: path to directory with workflow outputs
     :param log_filename: path to log file for workflow
     :param output_filename: path to mgz output file for workflow
+    :param zip_filename: path to zip of the output for workflow
     :return: True if successfully removed, False otherwise
     """
     logger = fsurfer.log.get_logger()
@@ -36,6 +38,8 @@ def purge_workflow_files(result_dir, log_filename, output_filename):
             os.unlink(log_filename)
         if os.path.isfile(output_filename):
             os.unlink(output_filename)
+        if os.path.isfile(zip_filename):
+            os.unlink(zip_filename)
         return True
     except OSError, e:
         logger.error("Exception: {0}".format(str(e)))
@@ -72,7 +76,6 @@ def remove_input_directory(input_dir):
     if not os.path.exists(input_dir):
         return True
     try:
-        input_dir = os.path.dirname(input_dir)
         os.rmdir(input_dir)
         logger.info("Removed directory {0}".format(input_dir))
         return True
@@ -154,6 +157,11 @@ def process_results():
                                            'results',
                                            "{0}_{1}_output.tar.bz2".format(workflow_id,
                                                                            row[4]))
+            zip_filename = os.path.join(fsurfer.FREESURFER_BASE,
+                                        username,
+                                        'results',
+                                        "{0}_{1}_output.zip".format(workflow_id,
+                                                                    row[4]))
             cursor2 = conn.cursor()
             cursor2.execute(input_select, [workflow_id])
             file_removal_error = False
@@ -174,6 +182,9 @@ def process_results():
                                                                        workflow_id))
                 cursor3 = conn.cursor()
                 cursor3.execute(input_update, [input_row[0]])
+                if not fsurfer.helpers.release_input_blob(cursor3, input_row[0]):
+                    logger.error("Can't release stored input for "
+                                 "{0} for job {1}".format(input_file, workflow_id))
 
             if not file_removal_error and input_directory:
                 if args.dry_run:
@@ -186,13 +197,15 @@ def process_results():
                 sys.stdout.write("Would delete {0}\n".format(result_dir))
                 sys.stdout.write("Would delete {0}\n".format(log_filename))
                 sys.stdout.write("Would delete {0}\n".format(output_filename))
+                sys.stdout.write("Would delete {0}\n".format(zip_filename))
                 continue
             logger.info("Removing {0}, {1}, {2}".format(result_dir,
                                                              log_filename,
                                                              output_filename))
             if not purge_workflow_files(result_dir,
                                         log_filename,
-                                        output_filename):
+                                        output_filename,
+                                        zip_filename):
                 logger.error("Can't remove files for job {0}".format(workflow_id))
                 continue
             logger.info("Setting workflow {0} to DELETED".format(workflow_id))
@@ -33,12 +33,17 @@ def reset_workflow(workflow_id):
     cursor = conn.cursor()
     if DRY_RUN:
         sys.stdout.write("Resetting workflow {0}\n".format(workflow_id))
+    task_run_delete = "DELETE FROM freesurfer_interface.task_run " \
+                      "WHERE job_run_id IN (SELECT id " \
+                      "                     FROM freesurfer_interface.job_run " \
+                      "                     WHERE job_id = %s)"
     job_run_delete = "DELETE FROM freesurfer_interface.job_run " \
                      "WHERE job_id = %s"
     job_reset = "UPDATE freesurfer_interface.jobs " \
                 "SET state = 'QUEUED' " \
                 "WHERE id = %s "
     try:
+        cursor.execute(task_run_delete, [workflow_id])
         cursor.execute(job_run_delete, [workflow_id])
         cursor.execute(job_reset, [workflow_id])
         if DRY_RUN:
@@ -20,6 +20,11 @@ setup(name='fsurfer-backend',
                'task_completed.py',
                'resync_workflows.py',
                'fsurf_user_admin.py',
-               'email_fsurf_notification.py'],
+               'email_fsurf_notification.py',
+               'validate_inputs.py',
+               'fsurf_event.py',
+               'process_events.py',
+               'fsurf_mailer.py',
+               'index_outputs.py'],
       license='Apache 2.0')
 
@@ -1,36 +1,167 @@
 #!/usr/bin/env python
 import argparse
+import glob
+import os
+import re
 import sys
 
 import psycopg2
 
 import fsurfer
 import fsurfer.helpers
+import fsurfer.kickstart
 
 VERSION = fsurfer.__version__
+# pegasus job ids are the job name with a sequence number, e.g.
+# autorecon1_sh_ID0000001, the name is used as the task's stage
+STAGE_RE = re.compile(r'^(.+?)(_sh)?_ID[0-9]+$')
+
+
+def find_task_output(environ):
+    """
+    Find the kickstart record for the pegasus job that finished
+
+    :param environ: environment pegasus gave to the notification
+    :return: path to kickstart record or None if it can't be found
+    """
+    stdout = environ.get('PEGASUS_STDOUT')
+    if stdout and os.path.isfile(stdout):
+        return stdout
+    submit_dir = environ.get('PEGASUS_SUBMIT_DIR')
+    job_id = environ.get('PEGASUS_JOBID')
+    if not submit_dir or not job_id:
+        return None
+    # rotated output from the latest attempt
+    outputs = glob.glob(os.path.join(submit_dir, job_id + '.out.[0-9]*'))
+    if not outputs:
+        return None
+    return max(outputs, key=lambda x: int(x.rsplit('.', 1)[1]))
+
+
+def get_task_info(environ):
+    """
+    Get usage information for a pegasus job that finished from its
+    kickstart record and submit file
+
+    :param environ: environment pegasus gave to the notification
+    :return: dictionary with task information or None if it isn't
+             available
+    """
+    output = find_task_output(environ)
+    if output is None:
+        return None
+    info = fsurfer.kickstart.parse_job_output(output)
+    if info is None:
+        return None
+    task = environ.get('PEGASUS_JOBID') or \
+        fsurfer.kickstart.OUTPUT_FILE_RE.sub('', os.path.basename(output))
+    info['task'] = task
+    match = STAGE_RE.match(task)
+    info['stage'] = match.group(1) if match else task
+    status = environ.get('PEGASUS_STATUS')
+    if status is not None and status.lstrip('-').isdigit():
+        info['exitcode'] = int(status)
+    return info
+
+
+def record_task(cursor, job_run_id, info):
+    """
+    Add a task_run entry for a task that finished
+
+    :param cursor: cursor to use
+    :param job_run_id: id for job run entry
+    :param info: dictionary from get_task_info
+    :return: None
+    """
+    task_insert = "INSERT INTO freesurfer_interface.task_run(job_run_id, " \
+                  "                                          task, " \
+                  "                                          stage, " \
+                  "                                          host, " \
+                  "                                          site, " \
+                  "                                          started, " \
+                  "                                          ended, " \
+                  "                                          duration, " \
+                  "                                          cputime, " \
+                  "                                          cores, " \
+                  "                                          maxrss, " \
+                  "                                          exit_code, " \
+                  "                                          bytes_in, " \
+                  "                                          bytes_out) " \
+                  "VALUES(%s, %s, %s, %s, %s, " \
+                  "       to_timestamp(%s) AT TIME ZONE 'UTC', " \
+                  "       to_timestamp(%s) AT TIME ZONE 'UTC', " \
+                  "       %s, %s, %s, %s, %s, %s, %s)"
+    cursor.execute(task_insert, [job_run_id,
+                                 info['task'],
+                                 info['stage'],
+                                 info['host'],
+                                 info['site'],
+                                 info['start_ts'],
+                                 info['end_ts'],
+                                 info['duration'],
+                                 info['utime'],
+                                 info['cores'],
+                                 info['maxrss'],
+                                 info['exitcode'],
+                                 info['bytes_in'],
+                                 info['bytes_out']])
+
+
+def increment_tasks(cursor, job_run_id, count=1):
+    """
+    Increment the # of tasks completed for a workflow, never going past
+    the number of tasks in the workflow
+
+    :param cursor: cursor to use
+    :param job_run_id: id for job run entry
+    :param count: number of tasks that completed
+    :return: None
+    """
+    run_update = "UPDATE freesurfer_interface.job_run " \
+                 "SET tasks_completed = LEAST(tasks, " \
+                 "                            tasks_completed + %s) " \
+                 "WHERE id = %s AND" \
+                 "      tasks_completed < tasks "
+    cursor.execute(run_update, [count, job_run_id])
+    fsurfer.helpers.notify_job_event(cursor, job_run_id)
 
 
 def update_completed_tasks(job_run_id):
     """
-    Increment # of tasks completed for a workflow
+    Record usage for a task that finished and increment # of tasks
+    completed for a workflow if the task succeeded
 
     :param job_run_id: id for job run entry
     :return: None
     """
-    fsurfer.log.initialize_logging()
     logger = fsurfer.log.get_logger()
 
+    try:
+        info = get_task_info(os.environ)
+    except (IOError, OSError) as e:
+        logger.exception("Can't read task output, got exception: {0}".format(e))
+        info = None
+    status = os.environ.get('PEGASUS_STATUS', '0')
     try:
         conn = fsurfer.helpers.get_db_client()
         cursor = conn.cursor()
+        if info is not None:
+            logger.info("Recording task {0} for workflow {1}".format(info['task'],
+                                                                     job_run_id))
+            try:
+                record_task(cursor, job_run_id, info)
+            except psycopg2.Error as e:
+                # still count the task even if its usage can't be saved
+                logger.exception("Can't record task, got pgsql error: {0}".format(e))
+                conn.rollback()
+        if status != '0':
+            logger.info("Task failed with status {0}".format(status))
+            conn.commit()
+            conn.close()
+            return
         logger.info("Incrementing tasks completed for workflow {0}".format(job_run_id))
-
-        run_update = "UPDATE freesurfer_interface.job_run " \
-                     "SET tasks_completed = tasks_completed + 1 " \
-                     "WHERE id = %s AND" \
-                     "      tasks_completed < tasks "
         logger.info("Updating run {0}".format(job_run_id))
-        cursor.execute(run_update, [job_run_id])
+        increment_tasks(cursor, job_run_id)
         conn.commit()
         conn.close()
     except psycopg2.Error as e:
@@ -40,7 +171,8 @@ def update_completed_tasks(job_run_id):
 
 def main():
     """
-    Increment the number of jobs completed for a fsurf workflow
+    Record a finished task and increment the number of jobs completed
+    for a fsurf workflow
 
     :return: True if any errors occurred during DAX generaton
     """
@@ -53,6 +185,7 @@ def main():
                         action='store', help='Workflow id for job being incremented')
 
     args = parser.parse_args(sys.argv[1:])
+    fsurfer.log.initialize_logging()
     update_completed_tasks(args.workflow_id)
 
     sys.exit(0)
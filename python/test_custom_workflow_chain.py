@@ -18,6 +18,8 @@ REST_ENDPOINT = "http://fsurf.ci-connect.net/freesurfer_test"
 VERSION = 'PKG_VERSION'
 STAGE_OPTIONS = ['-autorecon1', '-autorecon2-volonly', '-autorecon2']
 TIME_WAIT = 3600
+# time in seconds to wait for workflow changes per request
+EVENT_WAIT = 300
 
 
 def zip_directory(zip_obj, directory):
@@ -107,15 +109,21 @@ def wait_for_completion(jobid, user, password, timeout=3):
     """
     running = True
     start_time = time.time()
+    snapshot = None
     while running:
-        status = get_status(jobid, user, password)
-        if (status != 'QUEUED') and (status != 'RUNNING'):
+        status, snapshot = wait_for_change(jobid, user, password, snapshot)
+        if status is None:
+            # job events not available, fall back to polling
+            status = get_status(jobid, user, password)
+            if (status != 'QUEUED') and (status != 'RUNNING'):
+                return True
+            time.sleep(TIME_WAIT)
+        elif (status != 'QUEUED') and (status != 'RUNNING'):
             return True
 
         if (time.time() - start_time) > (86400 * timeout):
             sys.stderr.write("Timed out while processing\n")
             return False
-        time.sleep(TIME_WAIT)
 
 
 def convert_to_zip(tar_file):
@@ -236,6 +244,21 @@ def encode_file(body, filename):
     return content_type, encoded
 
 
+def input_stored(query_parameters, body):
+    """
+    Check whether the server already has an input with the same contents
+    and link it to the workflow if so
+
+    :param query_parameters: parameters that would be used for the upload
+    :param body: binary data that would be uploaded
+    :return: True if the input is stored and the upload can be skipped
+    """
+    query_parameters = dict(query_parameters)
+    query_parameters['sha256'] = hashlib.sha256(body).hexdigest()
+    status, _ = get_response(query_parameters, 'job/input', 'POST')
+    return status == 200
+
+
 def upload_item(query_parameters, noun, filename, body, method, endpoint=REST_ENDPOINT):
     """
     Issue a POST request to given endpoint
@@ -385,6 +408,10 @@ def submit_custom_workflow(username, password, version, subject, subject_dir, op
                 sys.exit(1)
             with open(input_path, 'rb') as f:
                 body = f.read()
+            if input_stored(query_params, body):
+                sys.stdout.write("{0} already on server, skipping "
+                                 "upload\n".format(subject_dir))
+                break
 
             status, response = upload_item(query_params,
                                            'job/input',
@@ -497,6 +524,40 @@ def get_status(workflow_id, username, password):
     return response_obj['job_status']
 
 
+def wait_for_change(workflow_id, username, password, snapshot=None):
+    """
+    Wait for the status of a workflow to change using the job events
+    endpoint
+
+    :param workflow_id: pegasus id for workflow
+    :param username: username to use when authenticating
+    :param password: password to user when authenticating
+    :param snapshot: snapshot returned by the previous call, if any
+    :return: tuple with job status and snapshot, (None, None) on error
+    """
+    query_params = {}
+    timestamp, token = get_token(username, password)
+    if token is None:
+        return None, None
+    query_params['userid'] = username
+    query_params['timestamp'] = timestamp
+    query_params['token'] = token
+    query_params['jobids'] = workflow_id
+    query_params['timeout'] = EVENT_WAIT
+    if snapshot:
+        query_params['snapshot'] = snapshot
+    status, response = get_response(query_params,
+                                    'job/events',
+                                    'GET')
+    if status != 200:
+        return None, None
+    response_obj = json.loads(response)
+    job_status = response_obj['jobs'][0]['job_status']
+    if response_obj['changed']:
+        sys.stdout.write("Current job status: {0}\n".format(job_status))
+    return job_status, response_obj['snapshot']
+
+
 def run_stage(options, input_filename, args):
     """
     Run a Freesurfer stage
@@ -14,6 +14,8 @@ import subprocess
 
 REST_ENDPOINT = "http://fsurf.ci-connect.net/freesurfer_test"
 VERSION = 'PKG_VERSION'
+# time in seconds to wait for workflow changes per request
+EVENT_WAIT = 300
 
 
 def check_freesurfer():
@@ -140,6 +142,21 @@ def encode_file(body, filename):
     return content_type, encoded
 
 
+def input_stored(query_parameters, body):
+    """
+    Check whether the server already has an input with the same contents
+    and link it to the workflow if so
+
+    :param query_parameters: parameters that would be used for the upload
+    :param body: binary data that would be uploaded
+    :return: True if the input is stored and the upload can be skipped
+    """
+    query_parameters = dict(query_parameters)
+    query_parameters['sha256'] = hashlib.sha256(body).hexdigest()
+    status, _ = get_response(query_parameters, 'job/input', 'POST')
+    return status == 200
+
+
 def upload_item(query_parameters, noun, filename, body, method, endpoint=REST_ENDPOINT):
     """
     Issue a POST request to given endpoint
@@ -256,7 +273,7 @@ def submit_standard_workflow(username,
     query_params = {'userid': username,
                     'token': token,
                     'multicore': multicore,
-                    'num_inputs': 1,
+                    'num_inputs': num_inputs,
                     'options': "",
                     'version': version,
                     'subject': subject,
@@ -294,6 +311,10 @@ def submit_standard_workflow(username,
                 sys.exit(1)
             with open(input_path, 'rb') as f:
                 body = f.read()
+            if input_stored(query_params, body):
+                sys.stdout.write("{0} already on server, skipping "
+                                 "upload\n".format(input_file))
+                break
 
             status, response = upload_item(query_params,
                                            'job/input',
@@ -372,6 +393,10 @@ def submit_custom_workflow(username, password, version, subject, subject_dir, op
                 sys.exit(1)
             with open(input_path, 'rb') as f:
                 body = f.read()
+            if input_stored(query_params, body):
+                sys.stdout.write("{0} already on server, skipping "
+                                 "upload\n".format(subject_dir))
+                break
 
             status, response = upload_item(query_params,
                                            'job/input',
@@ -456,6 +481,40 @@ def get_status(workflow_id, username, password):
     return response_obj['job_status']
 
 
+def wait_for_change(workflow_id, username, password, snapshot=None):
+    """
+    Wait for the status of a workflow to change using the job events
+    endpoint
+
+    :param workflow_id: pegasus id for workflow
+    :param username: username to use when authenticating
+    :param password: password to user when authenticating
+    :param snapshot: snapshot returned by the previous call, if any
+    :return: tuple with job status and snapshot, (None, None) on error
+    """
+    query_params = {}
+    timestamp, token = get_token(username, password)
+    if token is None:
+        return None, None
+    query_params['userid'] = username
+    query_params['timestamp'] = timestamp
+    query_params['token'] = token
+    query_params['jobids'] = workflow_id
+    query_params['timeout'] = EVENT_WAIT
+    if snapshot:
+        query_params['snapshot'] = snapshot
+    status, response = get_response(query_params,
+                                    'job/events',
+                                    'GET')
+    if status != 200:
+        return None, None
+    response_obj = json.loads(response)
+    job_status = response_obj['jobs'][0]['job_status']
+    if response_obj['changed']:
+        sys.stdout.write("Current job status: {0}\n".format(job_status))
+    return job_status, response_obj['snapshot']
+
+
 def main():
     """
     Main function that parses arguments and generates the pegasus
@@ -524,16 +583,25 @@ def main():
     running = True
     start_time = time.time()
     error = False
+    snapshot = None
     while running:
-        status = get_status(job_id, args.user, args.password)
-        if (status != 'QUEUED') and (status != 'RUNNING'):
+        status, snapshot = wait_for_change(job_id,
+                                           args.user,
+                                           args.password,
+                                           snapshot)
+        if status is None:
+            # job events not available, fall back to polling
+            status = get_status(job_id, args.user, args.password)
+            if (status != 'QUEUED') and (status != 'RUNNING'):
+                break
+            time.sleep(3600)
+        elif (status != 'QUEUED') and (status != 'RUNNING'):
             break
 
         if (time.time() - start_time) > (86400 * 2):
             sys.stdout.write("Timed out while processing\n")
             error = True
             break
-        time.sleep(3600)
     if error:
         remove_workflow(job_id, args.user, args.password)
         sys.exit(1)
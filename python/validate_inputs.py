@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright 2016 University of Chicago
+# Licensed under the APL 2.0 license
+
+# Validate uploaded inputs in the background so that workflows with
+# bad inputs are marked as errors before process_mri.py plans them
+import argparse
+import fcntl
+import multiprocessing
+import select
+import sys
+
+import psycopg2
+import psycopg2.extensions
+
+import fsurfer
+import fsurfer.helpers
+import fsurfer.log
+import fsurfer.validation
+
+VERSION = fsurfer.__version__
+# number of pending inputs fetched from the database at a time
+BATCH_SIZE = 50
+# seconds to wait for a notification before checking for inputs anyway
+POLL_INTERVAL = 60
+
+
+def check_input(input_info):
+    """
+    Validate an input, run in a worker process
+
+    :param input_info: tuple of (input id, path, filename, subject_dir)
+    :return: tuple of (input id, True if valid, error message)
+    """
+    input_id, path, filename, subject_dir = input_info
+    try:
+        valid, message = fsurfer.validation.validate_input(path,
+                                                           filename,
+                                                           subject_dir)
+    except Exception as e:
+        valid, message = False, "Error while validating: {0}".format(e)
+    return input_id, valid, message
+
+
+def validate_pending(conn, pool, dry_run=False):
+    """
+    Validate pending inputs and update the inputs and workflows using
+    the results
+
+    :param conn: database connection to use
+    :param pool: multiprocessing pool used to validate inputs
+    :param dry_run: if True, report results without making changes
+    :return: number of inputs validated
+    """
+    logger = fsurfer.log.get_logger()
+    cursor = conn.cursor()
+    input_query = "SELECT id, path, filename, subject_dir " \
+                  "FROM freesurfer_interface.input_files " \
+                  "WHERE state = 'PENDING' AND NOT purged " \
+                  "ORDER BY id " \
+                  "LIMIT %s"
+    input_update = "UPDATE freesurfer_interface.input_files " \
+                   "SET state = %s, " \
+                   "    validation_error = %s " \
+                   "WHERE id = %s AND state = 'PENDING' " \
+                   "RETURNING job_id"
+    job_error = "UPDATE freesurfer_interface.jobs " \
+                "SET state = 'ERROR' " \
+                "WHERE id = %s AND state = 'QUEUED'"
+    job_notify = "SELECT pg_notify(%s, %s)"
+    validated = 0
+    while True:
+        cursor.execute(input_query, [BATCH_SIZE])
+        inputs = cursor.fetchall()
+        conn.commit()
+        if not inputs:
+            break
+        for input_id, valid, message in pool.imap_unordered(check_input,
+                                                            inputs):
+            validated += 1
+            if dry_run:
+                sys.stdout.write("Input {0}: {1} {2}\n".format(input_id,
+                                                               valid,
+                                                               message or ''))
+                continue
+            if valid:
+                cursor.execute(input_update, ['VALID', None, input_id])
+            else:
+                logger.info("Input {0} is invalid: {1}".format(input_id,
+                                                               message))
+                cursor.execute(input_update, ['INVALID', message, input_id])
+                row = cursor.fetchone()
+                if row is not None:
+                    cursor.execute(job_error, [row[0]])
+                    if cursor.rowcount == 1:
+                        logger.info("Changed workflow {0} ".format(row[0]) +
+                                    "to ERROR state")
+                        cursor.execute(job_notify,
+                                       [fsurfer.helpers.JOB_EVENT_CHANNEL,
+                                        str(row[0])])
+            conn.commit()
+        if dry_run or len(inputs) < BATCH_SIZE:
+            break
+    return validated
+
+
+def main():
+    """
+    Validate uploaded inputs, waiting for notifications of new uploads
+
+    :return: exit code (0 for success, non-zero for failure)
+    """
+    fsurfer.log.initialize_logging()
+    logger = fsurfer.log.get_logger()
+    parser = argparse.ArgumentParser(description="Validate uploaded inputs")
+    # version info
+    parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
+    # Arguments for action
+    parser.add_argument('--dry-run', dest='dry_run',
+                        action='store_true', default=False,
+                        help='Mock actions instead of carrying them out')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true', default=False,
+                        help='Output debug messages')
+    parser.add_argument('--once', dest='once',
+                        action='store_true', default=False,
+                        help='Validate pending inputs and exit')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of processes used to validate inputs')
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.debug:
+        fsurfer.log.set_debugging()
+    if args.dry_run:
+        sys.stdout.write("Doing a dry run, no changes will be made\n")
+    try:
+        x = open('/tmp/fsurf_validate.lock', 'w+')
+        fcntl.flock(x, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.warn('Lock file present, exiting')
+        sys.exit(1)
+
+    # create worker processes before opening any database connections
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        conn = fsurfer.helpers.get_db_client()
+        listen_conn = fsurfer.helpers.get_db_client()
+        listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        listen_conn.cursor().execute("LISTEN " +
+                                     fsurfer.helpers.INPUT_EVENT_CHANNEL)
+        while True:
+            validated = validate_pending(conn, pool, args.dry_run)
+            logger.info("Validated {0} inputs".format(validated))
+            if args.once:
+                break
+            # wait for an upload to be announced, polling occasionally
+            # in case a notification was missed
+            select.select([listen_conn], [], [], POLL_INTERVAL)
+            listen_conn.poll()
+            del listen_conn.notifies[:]
+    except psycopg2.Error as e:
+        logger.exception("Got pgsql error: {0}".format(e))
+        return 1
+    finally:
+        pool.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,9 +3,7 @@
 # Copyright 2016 University of Chicago
 # Licensed under the APL 2.0 license
 import argparse
-import subprocess
 import sys
-from email.mime.text import MIMEText
 
 import psycopg2
 
@@ -16,34 +14,32 @@ import fsurfer
 VERSION = fsurfer.__version__
 
 
-def email_user(workflow_id, email):
+def email_user(cursor, workflow_id, username, email):
     """
-    Email user informing them that a workflow will be deleted
+    Queue an email informing the user that a workflow will be deleted,
+    the message is sent by fsurf_mailer.py once the current transaction
+    is committed
 
+    :param cursor: cursor to use to queue the message
     :param workflow_id: id for workflow that will be deleted
+    :param username: fsurf user that owns the workflow
     :param email: email address for user
     :return: True on success, False on failure
     """
     logger = fsurfer.log.get_logger()
-    msg = MIMEText('The results from your freesurfer ' +
-                   'workflow {0} '.format(workflow_id) +
-                   'will be deleted in 7 days, please download ' +
-                   'them if you would like to save the results.')
-
-    msg['Subject'] = 'Results for FSurf workflow {0} '.format(workflow_id)
-    msg['Subject'] += 'will be deleted'
-    sender = 'fsurf@login.osgconnect.net'
-    dest = email
-    msg['From'] = sender
-    msg['To'] = dest
+    body = 'The results from your freesurfer ' + \
+           'workflow {0} '.format(workflow_id) + \
+           'will be deleted in 7 days, please download ' + \
+           'them if you would like to save the results.'
+    subject = 'Results for FSurf workflow {0} '.format(workflow_id)
+    subject += 'will be deleted'
     try:
-        sendmail = subprocess.Popen(['/usr/sbin/sendmail', '-t'], stdin=subprocess.PIPE)
-        sendmail.communicate(msg.as_string())
-        logger.info("Emailed {0} about purge for workflow {1}".format(email,
-                                                                      workflow_id))
+        fsurfer.helpers.queue_email(cursor, email, subject, body, username)
+        logger.info("Queued email to {0} about purge for workflow {1}".format(email,
+                                                                              workflow_id))
         return True
-    except subprocess.CalledProcessError as e:
-        logger.exception("Error emailing {0}: {1}".format(email, e))
+    except psycopg2.Error as e:
+        logger.exception("Error queuing email to {0}: {1}".format(email, e))
         return False
 
 
@@ -95,9 +91,10 @@ def process_results():
                 sys.stdout.write("Would email {0}".format(row[2]))
                 sys.stdout.write("about workflow {0}\n".format(row[0]))
                 continue
-            if not email_user(row[0], row[2]):
+            if not email_user(cursor, row[0], row[1], row[2]):
                 logger.error("Can't email {0} for job {1}".format(row[2],
                                                                   row[0]))
+                conn.rollback()
                 continue
             conn.commit()
     except psycopg2.Error, e:
@@ -1,21 +1,15 @@
 #!/usr/bin/env python
 import argparse
 import os
-import subprocess
 import sys
-import shutil
-import xml
-import xml.parsers.expat
-import xml.dom.minidom
-import re
-from email.mime.text import MIMEText
-
-import datetime
-import dateutil.parser
+
 import psycopg2
 
 import fsurfer
 import fsurfer.helpers
+import fsurfer.kickstart
+import fsurfer.publish
+import fsurfer.recovery
 
 VERSION = fsurfer.__version__
 
@@ -44,20 +38,6 @@ available depending on the type of error that was encountered.
 Please contact user-support@opensciencegrid.org  if you have any questions.
 '''
 
-# helper class for time delta calculations
-ZERO = datetime.timedelta(0)
-
-
-class UTC(datetime.tzinfo):
-    def utcoffset(self, dt):
-        return ZERO
-
-    def tzname(self, dt):
-        return "UTC"
-
-    def dst(self, dt):
-        return ZERO
-
 
 def format_seconds(duration, max_comp=2):
     """
@@ -145,58 +125,20 @@ def get_result_base_dir(workflow_info):
                         workflow_info['pegasus_ts'])
 
 
-def parse_ks_record(fname):
+def get_submit_dir(workflow_info):
     """
-    Parses a Pegasus kickstart XML records
-
-    :param fname: the filename of the job output file
-    :return: a data dicttionary with a small set of keys/values from the record
-    """
-
-    data = {'duration': 0.0, 'utime': 0.0}
-
-    dom_tree = xml.dom.minidom.parse(fname)
-    collection = dom_tree.documentElement
-
-    for mainjob in collection.getElementsByTagName('mainjob'):
-        data['start'] = mainjob.getAttribute('start')
-        data['duration'] += float(mainjob.getAttribute("duration"))
-        for usage in mainjob.getElementsByTagName('usage'):
-            data['utime'] += float(usage.getAttribute('utime'))
-
-    # convert start date to unix ts
-    # example: 2016-05-18T12:55:23.507-05:00
-    dt = dateutil.parser.parse(data['start'])
-    # epoch calculations in Python 2.6 makes me sad
-    td = dt - datetime.datetime(1970, 1, 1, tzinfo=UTC())
-    data['start_ts'] = (td.microseconds + (td.seconds + td.days * 86400) * 10**6) / 10**6 
-
-    data['end_ts'] = data['start_ts'] + int(data['duration'])
+    Return the pegasus submit directory for a workflow
 
-    return data
-
-
-def parse_submit_file(fname):
-    """
-    Retrieves the HTCondor classad from a submit file
-
-    :param fname: full path to the submit file
-    :return: a dictionary of the classad
+    :param workflow_info: dictionary with workflow info
+    :return: a string with the directory path to the submit dir
     """
-
-    ad = {'request_cpus': 1}
-    with open(fname) as f:
-        for line in f:
-            line = line.strip()
-            if line == '' or line[0] == '#':
-                continue
-            if line.find('=') == -1:
-                continue
-            key, value = line.split('=', 1)
-            key = key.strip().lower()
-            value = value.strip()
-            ad[key] = value
-    return ad
+    return os.path.join(fsurfer.FREESURFER_SCRATCH,
+                        workflow_info['username'],
+                        'workflows',
+                        'fsurf',
+                        'pegasus',
+                        'freesurfer',
+                        workflow_info['pegasus_ts'])
 
 
 def calculate_usage(submit_dir):
@@ -206,37 +148,17 @@ def calculate_usage(submit_dir):
     :param submit_dir: the Pegasus workflow submit dir
     :return: a tuple with [walltime, cputime] used in seconds
     """
-    fsurfer.log.initialize_logging()
-    logger = fsurfer.log.get_logger()
-
     start_ts = float('inf')
     end_ts = -float('inf')
     total_core_time = 0.0
     if not os.path.isdir(submit_dir):
         return [None, None]
-    for f in os.listdir(submit_dir):
-
-        # only consider files with out and numbers in them
-        if not re.search('\.out\.[0-9]+$', f):
+    job_outputs = fsurfer.kickstart.get_job_outputs(submit_dir)
+    for ks in fsurfer.kickstart.parse_job_outputs(job_outputs):
+        if ks is None:
+            # not a kickstart record
             continue
-
-        full_name = os.path.join(submit_dir, f)
-
-        # parse the kickstart record, if available
-        try:
-            ks = parse_ks_record(full_name)
-            submit_file = re.sub('\.out\.[0-9]+$', '.sub', full_name)
-            submit = parse_submit_file(submit_file)
-        except xml.parsers.expat.ExpatError as e:
-            # not a valid xml file
-            # expect this since some of the files we
-            # look at are not XML
-            logger.info("Got exception while parsing {1}:\n{0}".format(full_name,
-                                                                       e))
-            continue
-
-        cores = int(submit['request_cpus'])
-        total_core_time += cores * ks['duration']
+        total_core_time += ks['cores'] * ks['duration']
 
         if ks['start_ts'] < start_ts:
             start_ts = ks['start_ts']
@@ -251,6 +173,39 @@ def calculate_usage(submit_dir):
     return [None, None]
 
 
+def get_task_usage(conn, job_run_id):
+    """
+    Get the walltime and cpu usage for a workflow from the tasks
+    recorded by task_completed.py as they finished
+
+    :param conn: active pgsql connection to use
+    :param job_run_id: id for a workflow's job run to query
+    :return: a tuple with [walltime, cputime] used in seconds or None if
+             some tasks weren't recorded
+    :raises psycopg2.Error
+    """
+    usage_query = "SELECT job_run.tasks, " \
+                  "       count(DISTINCT CASE WHEN task_run.exit_code = 0 " \
+                  "                           THEN task_run.task END), " \
+                  "       EXTRACT(EPOCH FROM max(task_run.ended) - " \
+                  "                          min(task_run.started)), " \
+                  "       sum(task_run.cores * task_run.duration) " \
+                  "FROM freesurfer_interface.job_run AS job_run " \
+                  "LEFT JOIN freesurfer_interface.task_run AS task_run " \
+                  "  ON task_run.job_run_id = job_run.id " \
+                  "WHERE job_run.id = %s " \
+                  "GROUP BY job_run.tasks"
+    cursor = conn.cursor()
+    cursor.execute(usage_query, [job_run_id])
+    row = cursor.fetchone()
+    if row is None or row[1] < row[0] or row[0] == 0:
+        return None
+    walltime, cputime = row[2], row[3]
+    if walltime > 0 and cputime > 0:
+        return [int(walltime), cputime]
+    return [None, None]
+
+
 def usage_msg(walltime, cputime):
     """
     Return a message summarizing usage
@@ -272,16 +227,27 @@ def usage_msg(walltime, cputime):
     return msg
 
 
-def recover_logs(pegasus_workflow_id):
+def recover_logs(workflow_info, log_filename):
     """
-    Try to recover any logs from a pegasus workflow that has failed. Recovered
-    logs copied to output directory
-
+    Try to recover any logs from a pegasus workflow that has failed.
+    The recon-all logs in the newest intermediate archive left by the
+    workflow and the output captured for its jobs are combined into
+    one log
 
-    :param pegasus_workflow_id: workfow id to check
-    :return: None
+    :param workflow_info: dictionary with information about user workflow
+    :param log_filename: path to write the recovered log to
+    :return: True if any logs were recovered, False otherwise
     """
-    pass
+    logger = fsurfer.log.get_logger()
+    submit_dir = get_submit_dir(workflow_info)
+    search_dirs = [get_result_base_dir(workflow_info), submit_dir]
+    try:
+        return fsurfer.recovery.recover_logs(submit_dir,
+                                             search_dirs,
+                                             log_filename)
+    except (IOError, OSError) as e:
+        logger.exception("Can't recover logs, got exception: {0}".format(e))
+        return False
 
 
 def get_workflow_info(conn, job_run_id):
@@ -329,40 +295,59 @@ def get_workflow_info(conn, job_run_id):
         return
 
 
-def email_user(workflow_info, success, stats_text):
+def email_user(cursor, workflow_info, success, stats_text):
     """
-    Email user with a message indicating that their job has completed.
-    
+    Queue an email to the user with a message indicating that their job
+    has completed, the message is sent by fsurf_mailer.py once the
+    current transaction is committed
+
+    :param cursor: cursor to use to queue the message
     :param workflow_info: dictionary with information about user workflow
     :param success: Boolean indicating whether workflow has succeeded or not
     :param stats_text: string with message about workflow statistics
-    :return: None 
+    :return: None
     """
     logger = fsurfer.log.get_logger()
 
     if success:
-        msg = MIMEText(SUCCESS_EMAIL_TEMPLATE.format(workflow_info['job_id'],
-                                                     workflow_info['submit_date'],
-                                                     stats_text))
-
+        body = SUCCESS_EMAIL_TEMPLATE.format(workflow_info['job_id'],
+                                             workflow_info['submit_date'],
+                                             stats_text)
     else:
-        msg = MIMEText(FAIL_EMAIL_TEMPLATE.format(workflow_info['job_id'],
-                                                  workflow_info['submit_date'],
-                                                  stats_text))
-    msg['Subject'] = 'FreeSurfer workflow {0} completed'.format(workflow_info['job_id'])
-    sender = 'fsurf@login.osgconnect.net'
-    msg['From'] = sender
-    msg['To'] = workflow_info['user_email']
+        body = FAIL_EMAIL_TEMPLATE.format(workflow_info['job_id'],
+                                          workflow_info['submit_date'],
+                                          stats_text)
+    subject = 'FreeSurfer workflow {0} completed'.format(workflow_info['job_id'])
+    fsurfer.helpers.queue_email(cursor,
+                                workflow_info['user_email'],
+                                subject,
+                                body,
+                                workflow_info['username'])
+    logger.info("Queued email to {0} about workflow {1}".format(workflow_info['user_email'],
+                                                                workflow_info['job_id']))
+
+
+def publish_output(source, destination):
+    """
+    Publish a workflow output, checking it against the checksum the
+    worker computed if there is one
+
+    :param source: path to output in the pegasus output directory
+    :param destination: path to publish output at
+    :return: a tuple of (True if the output was published, sha1 checksum
+             from the worker's manifest or None)
+    """
+    logger = fsurfer.log.get_logger()
+    if not os.path.isfile(source):
+        logger.error("Output file {0} not found".format(source))
+        return False, None
     try:
-        sendmail = subprocess.Popen(['/usr/sbin/sendmail', '-t'],
-                                    stdin=subprocess.PIPE)
-        sendmail.communicate(msg.as_string())
-        logger.info("Emailing {0} about workflow {1}".format(workflow_info['user_email'],
-                                                             workflow_info['job_id']))
-    except subprocess.CalledProcessError as e:
-        # don't want exceptions when emailing to stop rest of processing
-        logger.exception("Can't email user, got exception: {0}".format(e))
-        pass
+        checksum = fsurfer.publish.manifest_checksum(source)
+        fsurfer.publish.publish_file(source, destination, checksum)
+    except (IOError, OSError) as e:
+        logger.exception("Exception while publishing file: {0}".format(e))
+        return False, None
+    return True, checksum
 
 
 def copy_outputs(workflow_info, success):
@@ -371,9 +356,8 @@ def copy_outputs(workflow_info, success):
     
     :param workflow_info: dictionary with information about user workflow
     :param success: Boolean indicating whether workflow has succeeded or not
-    :return: None 
+    :return: verified sha1 checksum of the published output or None
     """
-    logger = fsurfer.log.get_logger()
     # copy output to the results directory
     output_filename = os.path.join(fsurfer.FREESURFER_BASE,
                                    workflow_info['username'],
@@ -382,110 +366,85 @@ def copy_outputs(workflow_info, success):
                                                                    workflow_info['subject_name']))
     result_filename = os.path.join(get_result_base_dir(workflow_info),
                                    '{0}_output.tar.bz2'.format(workflow_info['subject_name']))
-    try:
-        if not os.path.isfile(result_filename):
-            logger.error("Output file {0} not found".format(result_filename))
-        else:
-            shutil.copyfile(result_filename, output_filename)
-    except shutil.Error as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    except IOError as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    logger.info("Copied {0} to {1}".format(result_filename, output_filename))
+    # the zip used to download single files is written later by
+    # index_outputs.py so the workflow doesn't wait for it
+    checksum = publish_output(result_filename, output_filename)[1]
     result_logfile = os.path.join(get_result_base_dir(workflow_info),
                                   'recon-all.log')
     log_filename = os.path.join(fsurfer.FREESURFER_BASE,
                                 workflow_info['username'],
                                 'results',
                                 'recon_all-{0}.log'.format(workflow_info['job_id']))
-    try:
-        if not os.path.isfile(result_logfile):
-            logger.error("Output file {0} not found".format(result_logfile))
-            if not success:
-                recover_logs(workflow_info['pegasus_ts'])
-        else:
-            shutil.copyfile(result_logfile, log_filename)
-    except shutil.Error as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    except IOError as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    logger.info("Copied {0} to {1}".format(result_logfile, log_filename))
+    if not publish_output(result_logfile, log_filename)[0] and not success:
+        recover_logs(workflow_info, log_filename)
+    return checksum
 
 
-def process_results(job_run_id, success=True):
+def process_results(job_run_id, success=True, conn=None):
     """
     Email user informing them that a workflow has completed
 
     :param success: True if workflow completed successfully
     :param job_run_id: id for job run id for workflow
-    :return: None
+    :param conn: pgsql connection to use, a new connection is opened
+                 and closed if this is None
+    :return: True if the results were processed or there is no
+             workflow with the job run id, False if there was an error
     """
-    fsurfer.log.initialize_logging()
-    logger = fsurfer.log.get_logger()
+    close_conn = conn is None
+    if close_conn:
+        conn = fsurfer.helpers.get_db_client()
+    try:
+        return update_workflow(conn, job_run_id, success)
+    finally:
+        if close_conn:
+            conn.close()
+
 
-    conn = fsurfer.helpers.get_db_client()
+def update_workflow(conn, job_run_id, success):
+    """
+    Copy a workflow's outputs, update its state and accounting info and
+    email the user
+
+    :param conn: pgsql connection to use
+    :param job_run_id: id for job run id for workflow
+    :param success: True if workflow completed successfully
+    :return: True if successful, False if there was a pgsql error
+    """
+    logger = fsurfer.log.get_logger()
     cursor = conn.cursor()
     try:
         workflow_info = get_workflow_info(conn, job_run_id)
     except psycopg2.Error as e:
         logger.exception("Got pgsql error: {0}".format(e))
-        return
+        conn.rollback()
+        return False
+    if workflow_info is None:
+        return True
 
     stats_text = ""
     walltime = 0
     cputime = 0
     try:
-        submit_dir = os.path.join(fsurfer.FREESURFER_SCRATCH,
-                                  workflow_info['username'],
-                                  'workflows',
-                                  'fsurf',
-                                  'pegasus',
-                                  'freesurfer',
-                                  workflow_info['pegasus_ts'])
-        walltime, cputime = calculate_usage(submit_dir)
+        submit_dir = get_submit_dir(workflow_info)
+        try:
+            usage = get_task_usage(conn, job_run_id)
+        except psycopg2.Error as e:
+            logger.exception("Can't get task usage, got pgsql error: {0}".format(e))
+            conn.rollback()
+            usage = None
+        if usage is None:
+            # tasks weren't all recorded when they finished, fall back
+            # to the kickstart records in the submit dir
+            logger.info("Calculating usage from {0}".format(submit_dir))
+            usage = calculate_usage(submit_dir)
+        walltime, cputime = usage
         stats_text = usage_msg(walltime, cputime)
     except Exception as e:
         logger.exception("Can't calculate stats, got exception: {0}".format(e))
         pass
 
-    email_user(workflow_info, success, stats_text)
-
-    # copy output to the results directory
-    output_filename = os.path.join(fsurfer.FREESURFER_BASE,
-                                   workflow_info['username'],
-                                   'results',
-                                   "{0}_{1}_output.tar.bz2".format(workflow_info['job_id'],
-                                                                   workflow_info['subject_name']))
-    result_filename = os.path.join(get_result_base_dir(workflow_info),
-                                   '{0}_output.tar.bz2'.format(workflow_info['subject_name']))
-    try:
-        if not os.path.isfile(result_filename):
-            logger.error("Output file {0} not found".format(result_filename))
-        else:
-            shutil.copyfile(result_filename, output_filename)
-    except shutil.Error as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    except IOError as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    logger.info("Copied {0} to {1}".format(result_filename, output_filename))
-    result_logfile = os.path.join(get_result_base_dir(workflow_info),
-                                  'recon-all.log')
-    log_filename = os.path.join(fsurfer.FREESURFER_BASE,
-                                workflow_info['username'],
-                                'results',
-                                'recon_all-{0}.log'.format(workflow_info['job_id']))
-    try:
-        if not os.path.isfile(result_logfile):
-            logger.error("Output file {0} not found".format(result_logfile))
-            if not success:
-                recover_logs(workflow_info['pegasus_ts'])
-        else:
-            shutil.copyfile(result_logfile, log_filename)
-    except shutil.Error as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    except IOError as e:
-        logger.exception("Exception while copying file: {0}".format(e))
-    logger.info("Copied {0} to {1}".format(result_logfile, log_filename))
+    output_sha1 = copy_outputs(workflow_info, success)
     try:
         if success:
             state = 'COMPLETED'
@@ -495,9 +454,12 @@ def process_results(job_run_id, success=True):
             logger.warning("Updating workflow {0} to FAILED".format(workflow_info['job_id']))
 
         job_update = "UPDATE freesurfer_interface.jobs  " \
-                     "SET state = %s " \
+                     "SET state = %s, " \
+                     "    output_sha1 = %s " \
                      "WHERE id = %s;"
-        cursor.execute(job_update, [state, workflow_info['job_id']])
+        cursor.execute(job_update, [state,
+                                    output_sha1,
+                                    workflow_info['job_id']])
         logger.info("Updating run {0}".format(job_run_id))
 
         if walltime is None:
@@ -513,12 +475,15 @@ def process_results(job_run_id, success=True):
         cursor.execute(accounting_update, [walltime,
                                            cputime,
                                            job_run_id])
+        email_user(cursor, workflow_info, success, stats_text)
+        fsurfer.helpers.notify_job_event(cursor, job_run_id)
 
         conn.commit()
-        conn.close()
     except psycopg2.Error as e:
         logger.exception("Got pgsql error: {0}".format(e))
-        return
+        conn.rollback()
+        return False
+    return True
 
 
 def main():
@@ -545,10 +510,9 @@ def main():
                         action='store', help='job run id to use')
 
     args = parser.parse_args(sys.argv[1:])
-    if args.success:
-        process_results(args.job_run_id, success=True)
-    else:
-        process_results(args.job_run_id, success=False)
+    fsurfer.log.initialize_logging()
+    if not process_results(args.job_run_id, success=args.success):
+        sys.exit(1)
 
     sys.exit(0)
 
@@ -1,21 +1,70 @@
 #!/usr/bin/env python
 
 import argparse
+import base64
+import binascii
+import bisect
+import errno
+import logging
+import math
+import random
+import re
 import socket
 import sys
 import hashlib
+import json
 import os
+import posixpath
+import select
+import stat
 import tempfile
+import threading
 import time
+import zipfile
 
 import psycopg2
+import psycopg2.extensions
 from flask import Flask
 import flask
 
+# the layout of user directories is shared with the backend scripts
+import fsurfer.layout
+
 CONFIG_FILE_LOCATION = "/etc/fsurf/fsurf-prod.config"
 FREESURFER_BASE = '/local-scratch/fsurf/'
 TIMEZONE = "US/Central"
 URL_PREFIX = "/freesurfer"
+# limit on number of jobs that can be created by a single batch request
+MAX_BATCH_JOBS = 500
+# parameters required for each job in a batch request
+BATCH_JOB_PARAMETERS = {'multicore': bool,
+                        'num_inputs': int,
+                        'version': str,
+                        'subject': str,
+                        'jobname': str}
+# channel that workflow changes are announced on by the backend scripts
+JOB_EVENT_CHANNEL = "fsurf_job_events"
+# channel used to announce uploaded inputs to the validation daemon
+INPUT_EVENT_CHANNEL = "fsurf_input_events"
+# default and maximum time in seconds to hold a /job/events request open
+DEFAULT_EVENT_WAIT = 60
+MAX_EVENT_WAIT = 300
+# upper bounds in seconds for the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# addresses allowed to read the metrics endpoint
+METRICS_ADDRESSES = ('127.0.0.1', '::1')
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# users whose directories this process has already checked
+PROVISIONED_USERS = set()
+# time in seconds the upload token buckets can accumulate tokens for
+UPLOAD_BURST_SECONDS = 10
+# prefix that distinguishes session tokens from password derived tokens
+SESSION_PREFIX = 'session-'
+# symlinks followed when looking up a file in an output zip
+MAX_SYMLINKS = 8
+OUTPUT_CHUNK_SIZE = 1024 * 1024
 
 app = Flask(__name__)
 if 'FSURF_CONFIG_FILE' in os.environ and os.environ['FSURF_CONFIG_FILE']:
@@ -27,6 +76,368 @@ if 'URL_PREFIX' in app.config and app.config['URL_PREFIX']:
     URL_PREFIX = app.config['URL_PREFIX']
 
 
+class Histogram(object):
+    """
+    Cumulative histogram of observed durations
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add an observation to the histogram
+
+        :param value: duration in seconds
+        :return: None
+        """
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class RequestMetrics(object):
+    """
+    Per process request statistics, the WSGI server may run several
+    processes and each one keeps its own statistics
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.phases = {}
+        self.requests = {}
+        self.bytes = {}
+
+    def observe(self, route, method, status, elapsed, phases,
+                bytes_in, bytes_out):
+        """
+        Record information about a completed request
+
+        :param route: url rule that handled the request
+        :param method: HTTP method used
+        :param status: HTTP status code returned
+        :param elapsed: time in seconds taken to handle the request
+        :param phases: dictionary with time in seconds spent in each
+                       phase (db_connect, db_query, auth, ...)
+        :param bytes_in: size of request body
+        :param bytes_out: size of response body
+        :return: None
+        """
+        with self.lock:
+            key = (route, method)
+            self.latency.setdefault(key, Histogram()).observe(elapsed)
+            for phase, phase_time in phases.iteritems():
+                key = (route, phase)
+                self.phases.setdefault(key, Histogram()).observe(phase_time)
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            key = (route, 'in')
+            self.bytes[key] = self.bytes.get(key, 0) + bytes_in
+            key = (route, 'out')
+            self.bytes[key] = self.bytes.get(key, 0) + bytes_out
+
+    def export(self):
+        """
+        Export the statistics using the prometheus text format
+
+        :return: string with statistics
+        """
+        lines = []
+        with self.lock:
+            lines.append('# TYPE fsurf_requests_total counter')
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('fsurf_requests_total{{route="{0}",method="{1}",'
+                             'status="{2}"}} {3}'.format(route, method,
+                                                         status, count))
+            lines.append('# TYPE fsurf_request_bytes_total counter')
+            for (route, direction), count in sorted(self.bytes.items()):
+                lines.append('fsurf_request_bytes_total{{route="{0}",'
+                             'direction="{1}"}} {2}'.format(route, direction,
+                                                           count))
+            lines.append('# TYPE fsurf_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self.latency.items()):
+                labels = 'route="{0}",method="{1}"'.format(route, method)
+                lines.extend(export_histogram('fsurf_request_duration_seconds',
+                                              labels,
+                                              histogram))
+            lines.append('# TYPE fsurf_request_phase_seconds histogram')
+            for (route, phase), histogram in sorted(self.phases.items()):
+                labels = 'route="{0}",phase="{1}"'.format(route, phase)
+                lines.extend(export_histogram('fsurf_request_phase_seconds',
+                                              labels,
+                                              histogram))
+        return "\n".join(lines) + "\n"
+
+
+def export_histogram(name, labels, histogram):
+    """
+    Generate prometheus text format lines for a histogram
+
+    :param name: metric name
+    :param labels: string with labels for the metric
+    :param histogram: Histogram instance to export
+    :return: list of lines
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name,
+                                                            labels,
+                                                            bound,
+                                                            cumulative))
+    lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, histogram.total))
+    lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+    return lines
+
+
+class UploadAdmission(object):
+    """
+    Admission control for uploads using concurrency limits and token
+    buckets limiting bytes per second, both per user and across all
+    users.  Limits are per process, a limit of 0 disables it
+    """
+    def __init__(self, user_concurrency, user_rate,
+                 global_concurrency, global_rate, busy_retry):
+        self.lock = threading.Lock()
+        self.user_concurrency = user_concurrency
+        self.user_rate = user_rate
+        self.global_concurrency = global_concurrency
+        self.global_rate = global_rate
+        self.busy_retry = busy_retry
+        self.active = {}
+        self.total_active = 0
+        self.buckets = {}
+
+    def bucket_wait(self, key, rate, now):
+        """
+        Refill a token bucket and get the time until it has tokens
+
+        :param key: key for the bucket, userid or None for global bucket
+        :param rate: bytes per second the bucket refills at
+        :param now: current time
+        :return: seconds until the bucket has tokens, 0 if it has some
+        """
+        burst = rate * UPLOAD_BURST_SECONDS
+        tokens, last = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        self.buckets[key] = (tokens, now)
+        if tokens >= 0:
+            return 0
+        return -tokens / float(rate)
+
+    def acquire(self, userid, size):
+        """
+        Try to admit an upload, uploads may exceed the tokens available
+        and leave a bucket in debt so that large files can be admitted
+
+        :param userid: user id of user uploading
+        :param size: size of upload in bytes
+        :return: 0 if admitted, otherwise seconds to wait before retrying
+        """
+        with self.lock:
+            if self.global_concurrency and \
+               self.total_active >= self.global_concurrency:
+                return self.busy_retry
+            if self.user_concurrency and \
+               self.active.get(userid, 0) >= self.user_concurrency:
+                return self.busy_retry
+            now = time.time()
+            wait = 0
+            if self.user_rate:
+                wait = max(wait, self.bucket_wait(userid, self.user_rate, now))
+            if self.global_rate:
+                wait = max(wait, self.bucket_wait(None, self.global_rate, now))
+            if wait:
+                return wait
+            if self.user_rate:
+                tokens, last = self.buckets[userid]
+                self.buckets[userid] = (tokens - size, last)
+            if self.global_rate:
+                tokens, last = self.buckets[None]
+                self.buckets[None] = (tokens - size, last)
+            self.active[userid] = self.active.get(userid, 0) + 1
+            self.total_active += 1
+            return 0
+
+    def release(self, userid):
+        """
+        Mark an admitted upload as finished
+
+        :param userid: user id of user uploading
+        :return: None
+        """
+        with self.lock:
+            self.total_active -= 1
+            if self.active.get(userid, 0) <= 1:
+                self.active.pop(userid, None)
+            else:
+                self.active[userid] -= 1
+
+
+class SessionCache(object):
+    """
+    Per process cache of session tokens that have been checked against
+    the database recently so that repeated requests using a session
+    don't need to query the database to authenticate
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get(self, token_hash):
+        """
+        Get the user for a session if it was checked recently
+
+        :param token_hash: sha256 hash of session token
+        :return: user id or None if session isn't cached
+        """
+        with self.lock:
+            if token_hash not in self.sessions:
+                return None
+            userid, valid_until = self.sessions[token_hash]
+            if valid_until < time.time():
+                del self.sessions[token_hash]
+                return None
+            return userid
+
+    def add(self, token_hash, userid, expires):
+        """
+        Cache a session that has been checked against the database
+
+        :param token_hash: sha256 hash of session token
+        :param userid: user id session belongs to
+        :param expires: unix timestamp when session expires
+        :return: None
+        """
+        with self.lock:
+            self.sessions[token_hash] = (userid,
+                                         min(expires, time.time() + self.ttl))
+
+    def remove_user(self, userid):
+        """
+        Remove all cached sessions for a user
+
+        :param userid: user id
+        :return: None
+        """
+        with self.lock:
+            for token_hash, (user, _) in self.sessions.items():
+                if user == userid:
+                    del self.sessions[token_hash]
+
+
+REQUEST_METRICS = RequestMetrics()
+SESSION_CACHE = SessionCache(app.config.get('SESSION_CACHE_TTL', 60))
+UPLOAD_ADMISSION = UploadAdmission(app.config.get('UPLOAD_USER_CONCURRENCY', 2),
+                                   app.config.get('UPLOAD_USER_RATE',
+                                                  20 * 1024 * 1024),
+                                   app.config.get('UPLOAD_GLOBAL_CONCURRENCY', 8),
+                                   app.config.get('UPLOAD_GLOBAL_RATE',
+                                                  100 * 1024 * 1024),
+                                   app.config.get('UPLOAD_BUSY_RETRY', 5))
+SLOW_REQUEST_LOGGER = logging.getLogger('fsurf.slow_requests')
+if app.config.get('SLOW_REQUEST_LOG'):
+    slow_log_handler = logging.FileHandler(app.config['SLOW_REQUEST_LOG'])
+    slow_log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    SLOW_REQUEST_LOGGER.addHandler(slow_log_handler)
+    SLOW_REQUEST_LOGGER.setLevel(logging.INFO)
+
+
+def record_phase(phase, elapsed):
+    """
+    Add time spent in a phase of handling the current request
+
+    :param phase: name of phase (e.g. db_connect, auth)
+    :param elapsed: time in seconds spent
+    :return: None
+    """
+    if flask.has_request_context() and hasattr(flask.g, 'phase_times'):
+        flask.g.phase_times[phase] = flask.g.phase_times.get(phase, 0) + elapsed
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records the time spent executing queries
+    """
+    def execute(self, query, parameters=None):
+        start = time.time()
+        try:
+            return super(TimedCursor, self).execute(query, parameters)
+        finally:
+            record_phase('db_query', time.time() - start)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Note the start time of a request
+    """
+    flask.g.request_start = time.time()
+    flask.g.phase_times = {}
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Arrange for request statistics to be recorded once the response
+    has been sent to the client, so that the time taken to stream
+    files is included
+
+    :param response: flask response for the request
+    :return: the response
+    """
+    if not app.config.get('METRICS_ENABLED', True) or \
+       not hasattr(flask.g, 'request_start'):
+        return response
+    request = flask.request
+    if request.url_rule is not None:
+        route = request.url_rule.rule
+    else:
+        route = 'unmatched'
+    method = request.method
+    status = response.status_code
+    start = flask.g.request_start
+    phases = flask.g.phase_times
+    bytes_in = request.content_length or 0
+    bytes_out = response.content_length or 0
+    userid = request.args.get('userid')
+
+    def finish_request():
+        elapsed = time.time() - start
+        REQUEST_METRICS.observe(route, method, status, elapsed, phases,
+                                bytes_in, bytes_out)
+        if elapsed > app.config.get('SLOW_REQUEST_SECONDS', 5.0) and \
+           random.random() < app.config.get('SLOW_REQUEST_SAMPLE_RATE', 0.1):
+            SLOW_REQUEST_LOGGER.info(json.dumps({'route': route,
+                                                 'method': method,
+                                                 'status': status,
+                                                 'userid': userid,
+                                                 'elapsed': elapsed,
+                                                 'phases': phases,
+                                                 'bytes_in': bytes_in,
+                                                 'bytes_out': bytes_out}))
+
+    response.call_on_close(finish_request)
+    return response
+
+
+@app.route(URL_PREFIX + '/metrics')
+def get_metrics():
+    """
+    Return request statistics for this process, only available to
+    local clients
+
+    :return: a tuple with response_body, status
+    """
+    if flask.request.remote_addr not in METRICS_ADDRESSES:
+        return flask_error_response(403, "Metrics only available locally")
+    return flask.Response(REQUEST_METRICS.export(),
+                          mimetype='text/plain; version=0.0.4')
+
+
 def validate_parameters(parameters):
     """
     Check parameters in request using the parameters specified
@@ -69,10 +480,59 @@ def get_db_client():
 
     :return: a redis client instance or None if failure occurs
     """
-    return psycopg2.connect(database=app.config['DB_NAME'],
+    start = time.time()
+    conn = psycopg2.connect(database=app.config['DB_NAME'],
                             user=app.config['DB_USER'],
                             host=app.config['DB_HOST'],
-                            password=app.config['DB_PASSWD'])
+                            password=app.config['DB_PASSWD'],
+                            cursor_factory=TimedCursor)
+    record_phase('db_connect', time.time() - start)
+    return conn
+
+
+def setup_user_dirs(userid):
+    """
+    Make sure the directories used to hold a user's inputs and results
+    are present.  The layout is normally created when the account is
+    added, the filesystem is only checked the first time this process
+    sees a user
+
+    :param userid: string with user id
+    :return: path to the user's input directory
+    """
+    user_dir = os.path.join(FREESURFER_BASE, userid)
+    if userid in PROVISIONED_USERS:
+        return os.path.join(user_dir, 'input')
+    start = time.time()
+    if not os.path.isfile(os.path.join(user_dir,
+                                       fsurfer.layout.LAYOUT_MARKER)):
+        fsurfer.layout.provision_user_dirs(user_dir)
+    PROVISIONED_USERS.add(userid)
+    record_phase('fs', time.time() - start)
+    return os.path.join(user_dir, 'input')
+
+
+def make_input_dir(userid, input_dir, job_id):
+    """
+    Create a directory to hold an input for a job in the shard
+    directory for the job
+
+    :param userid: string with user id
+    :param input_dir: path to the user's input directory
+    :param job_id: id of the job the input is for
+    :return: path to the new directory
+    """
+    shard = fsurfer.layout.input_shard(job_id)
+    try:
+        return tempfile.mkdtemp(dir=os.path.join(input_dir, shard))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    # layout was removed after this process cached it, recreate it
+    PROVISIONED_USERS.discard(userid)
+    fsurfer.layout.provision_user_dirs(os.path.dirname(input_dir))
+    PROVISIONED_USERS.add(userid)
+    return tempfile.mkdtemp(dir=os.path.join(input_dir, shard))
 
 
 @app.route(URL_PREFIX + '/job', methods=['DELETE'])
@@ -275,11 +735,16 @@ def set_user_password():
     user_update = "UPDATE freesurfer_interface.users " \
                   "SET salt = %s, password = %s " \
                   "WHERE username = %s;"
+    session_delete = "DELETE FROM freesurfer_interface.sessions " \
+                     "WHERE username = %s;"
     try:
         cursor.execute(user_update, (flask.request.args['salt'],
                                      flask.request.args['pw_hash'],
                                      userid))
         if cursor.rowcount == 1:
+            # sessions created with the old password are no longer valid
+            cursor.execute(session_delete, [userid])
+            SESSION_CACHE.remove_user(userid)
             response = {'status': 200,
                         'result': 'Password updated'}
         elif cursor.rowcount == 0:
@@ -306,6 +771,12 @@ def validate_user(userid, token, timestamp):
     :param timestamp: string with the unix timestamp of when token was made
     :return: True if credentials are valid, False otherwise
     """
+    start = time.time()
+    if token and token.startswith(SESSION_PREFIX):
+        try:
+            return validate_session(userid, token)
+        finally:
+            record_phase('auth', time.time() - start)
     conn = get_db_client()
     cursor = conn.cursor()
     salt_query = "SELECT salt, password " \
@@ -323,6 +794,94 @@ def validate_user(userid, token, timestamp):
     finally:
         conn.commit()
         conn.close()
+        record_phase('auth', time.time() - start)
+
+
+def validate_session(userid, token):
+    """
+    Check that a session token is valid for a user, sessions that were
+    checked recently are validated without querying the database
+
+    :param userid: string with user id
+    :param token: session token
+    :return: True if session is valid, False otherwise
+    """
+    token_hash = hashlib.sha256(token).hexdigest()
+    if SESSION_CACHE.get(token_hash) == userid:
+        return True
+    conn = get_db_client()
+    cursor = conn.cursor()
+    session_query = "SELECT EXTRACT(EPOCH FROM sessions.expires - NOW()) " \
+                    "FROM freesurfer_interface.sessions AS sessions " \
+                    "JOIN freesurfer_interface.users AS users " \
+                    "  ON sessions.username = users.username " \
+                    "WHERE sessions.token_hash = %s AND " \
+                    "      sessions.username = %s AND " \
+                    "      sessions.expires > NOW() AND " \
+                    "      users.salt NOT LIKE 'xxx%%';"
+    try:
+        cursor.execute(session_query, [token_hash, userid])
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        SESSION_CACHE.add(token_hash, userid, time.time() + float(row[0]))
+        return True
+    except psycopg2.Error:
+        return False
+    finally:
+        conn.commit()
+        conn.close()
+
+
+@app.route(URL_PREFIX + '/user/session', methods=['POST'])
+def create_session():
+    """
+    Create a session token that can be used in place of the password
+    derived token until it expires
+
+    :return: a tuple with response_body, status
+    """
+    parameters = {'userid': str,
+                  'token': str,
+                  'timestamp': str}
+    if not validate_parameters(parameters):
+        return flask_error_response(400, "Invalid or missing parameter")
+    userid, token, timestamp = get_user_params()
+    if token.startswith(SESSION_PREFIX) or \
+       not validate_user(userid, token, timestamp):
+        return flask_error_response(401, "Invalid username or password")
+    lifetime = app.config.get('SESSION_LIFETIME', 3600)
+    session = SESSION_PREFIX + os.urandom(32).encode('hex')
+    conn = get_db_client()
+    cursor = conn.cursor()
+    session_cleanup = "DELETE FROM freesurfer_interface.sessions " \
+                      "WHERE username = %s AND expires <= NOW();"
+    session_insert = "INSERT INTO freesurfer_interface.sessions" \
+                     "(username, token_hash, expires) " \
+                     "SELECT username, %s, " \
+                     "       NOW() + %s * INTERVAL '1 second' " \
+                     "FROM freesurfer_interface.users " \
+                     "WHERE username = %s AND salt NOT LIKE 'xxx%%';"
+    try:
+        cursor.execute(session_cleanup, [userid])
+        cursor.execute(session_insert, [hashlib.sha256(session).hexdigest(),
+                                        lifetime,
+                                        userid])
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return flask_error_response(401, 'User account disabled')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return flask_error_response(500,
+                                    '500 Server Error\n'
+                                    'Exception: {0}'.format(e))
+    finally:
+        conn.close()
+    response = {'status': 200,
+                'session': session,
+                'expires_in': lifetime}
+    return flask.jsonify(response)
 
 
 @app.route(URL_PREFIX + '/job', methods=['GET'])
@@ -397,71 +956,112 @@ def get_current_jobs():
     return flask.jsonify(response)
 
 
+def query_job_status(cursor, userid, job_ids=None, active=False):
+    """
+    Get status and accounting information for several jobs using a
+    single query
+
+    :param cursor: cursor to use for queries
+    :param userid: string with user id
+    :param job_ids: list of job ids to get status for
+    :param active: if True, get status for all queued or running jobs
+    :return: a list of dictionaries with the status of each job
+    """
+    status_query = "SELECT jobs.id, " \
+                   "       jobs.state, " \
+                   "       jobs.options, " \
+                   "       jobs.num_inputs, " \
+                   "       jobs.subject, " \
+                   "       jobs.job_date, " \
+                   "       jobs.purged, " \
+                   "       jobs.version, " \
+                   "       COALESCE(SUM(job_run.walltime), 0), " \
+                   "       COALESCE(SUM(job_run.cputime), 0), " \
+                   "       COUNT(job_run.id), " \
+                   "       (array_agg(job_run.started " \
+                   "                  ORDER BY job_run.started DESC))[1], " \
+                   "       (array_agg(job_run.ended " \
+                   "                  ORDER BY job_run.started DESC))[1], " \
+                   "       (array_agg(job_run.tasks " \
+                   "                  ORDER BY job_run.started DESC))[1], " \
+                   "       (array_agg(job_run.tasks_completed " \
+                   "                  ORDER BY job_run.started DESC))[1] " \
+                   "FROM freesurfer_interface.jobs AS jobs " \
+                   "LEFT JOIN freesurfer_interface.job_run AS job_run " \
+                   "       ON job_run.job_id = jobs.id " \
+                   "WHERE jobs.username = %s AND {0} " \
+                   "GROUP BY jobs.id " \
+                   "ORDER BY jobs.id"
+    if active:
+        cursor.execute(status_query.format("jobs.state IN ('QUEUED', "
+                                           "                'RUNNING')"),
+                       [userid])
+    else:
+        cursor.execute(status_query.format("jobs.id = ANY(%s)"),
+                       [userid, job_ids])
+    jobs = []
+    for row in cursor.fetchall():
+        job = {'id': row[0],
+               'job_status': row[1],
+               'options': row[2],
+               'num_inputs': row[3],
+               'subject': row[4],
+               'started': time.mktime(row[5].timetuple()),
+               'purged': row[6],
+               'version': row[7],
+               'walltime': row[8],
+               'cputime': row[9],
+               'retries': row[10] - 1}  # retries = number of runs - 1
+        if row[10] > 0:
+            # use times and progress from the most recent run
+            job['started'] = time.mktime(row[11].timetuple())
+            job['ended'] = time.mktime(row[12].timetuple())
+            job['tasks'] = row[13]
+            job['tasks_completed'] = row[14]
+        jobs.append(job)
+    return jobs
+
+
 @app.route(URL_PREFIX + '/job/status')
 def get_job_status():
     """
-    Get status for job specified
+    Get status for job specified by jobid, or for several jobs if a comma
+    separated list of jobids or running=true is given
 
     :return: a tuple with response_body, status
     """
     parameters = {'userid': str,
-                  'token': str,
-                  'jobid': str}
+                  'token': str}
     if not validate_parameters(parameters):
         return flask_error_response(400, "Invalid or missing parameter")
+    args = flask.request.args
+    active = args.get('running', 'false').lower() == 'true'
+    try:
+        if 'jobid' in args:
+            job_ids = [int(args['jobid'])]
+        elif 'jobids' in args:
+            job_ids = [int(x) for x in args['jobids'].split(',')]
+        elif active:
+            job_ids = None
+        else:
+            return flask_error_response(400, "Invalid or missing parameter")
+    except ValueError:
+        return flask_error_response(400, "Invalid or missing parameter")
     userid, secret, timestamp = get_user_params()
     if not validate_user(userid, secret, timestamp):
         return flask_error_response(401, "Invalid username or password")
     response = {'status': 200}
     conn = get_db_client()
     cursor = conn.cursor()
-    job_query = "SELECT state, " \
-                "       options," \
-                "       num_inputs," \
-                "       subject," \
-                "       job_date," \
-                "       purged," \
-                "       version " \
-                "FROM freesurfer_interface.jobs " \
-                "WHERE id = %s AND username = %s;"
-    accounting_query = "SELECT walltime, " \
-                       "       cputime, " \
-                       "       started," \
-                       "       ended, " \
-                       "       tasks, " \
-                       "       tasks_completed " \
-                       "FROM  freesurfer_interface.job_run  " \
-                       "WHERE job_id = %s " \
-                       "ORDER BY started ASC"
     try:
-        cursor.execute(job_query, [flask.request.args['jobid'], userid])
-        row = cursor.fetchone()
-        if row is None:
-            return flask_error_response(404, "Invalid workflow id")
+        jobs = query_job_status(cursor, userid, job_ids, active)
+        if 'jobid' in args:
+            if not jobs:
+                return flask_error_response(404, "Invalid workflow id")
+            response.update(jobs[0])
+            del response['id']
         else:
-            response['job_status'] = row[0]
-            response['options'] = row[1]
-            response['num_inputs'] = row[2]
-            response['subject'] = row[3]
-            response['started'] = time.mktime(row[4].timetuple())
-            response['purged'] = row[5]
-            response['version'] = row[6]
-        cursor.execute(accounting_query, [flask.request.args['jobid']])
-        retries = 0
-        walltime = 0
-        cputime = 0
-        for row in cursor.fetchall():
-            retries += 1
-            walltime += row[0]
-            cputime += row[1]
-            response['started'] = time.mktime(row[2].timetuple())
-            response['ended'] = time.mktime(row[3].timetuple())
-            response['tasks'] = row[4]
-            response['tasks_completed'] = row[5]
-        response['walltime'] = walltime
-        response['cputime'] = cputime
-        response['retries'] = retries - 1  # retries = number of rows - 1
-
+            response['jobs'] = jobs
     except Exception as e:
         return flask_error_response(500,
                                     "500 Server Error\n"
@@ -472,10 +1072,137 @@ def get_job_status():
     return flask.jsonify(response)
 
 
+def get_job_snapshot(cursor, userid, job_ids):
+    """
+    Get the state and progress of the specified jobs
+
+    :param cursor: cursor to use for queries
+    :param userid: string with user id
+    :param job_ids: list of job ids to get information for
+    :return: a tuple with a list of (id, state, tasks_completed, tasks)
+             tuples and a digest of the list
+    """
+    snapshot_query = "SELECT DISTINCT ON (jobs.id) " \
+                     "       jobs.id, " \
+                     "       jobs.state, " \
+                     "       job_run.tasks_completed, " \
+                     "       job_run.tasks " \
+                     "FROM freesurfer_interface.jobs AS jobs " \
+                     "LEFT JOIN freesurfer_interface.job_run AS job_run " \
+                     "       ON job_run.job_id = jobs.id " \
+                     "WHERE jobs.id = ANY(%s) AND " \
+                     "      jobs.username = %s " \
+                     "ORDER BY jobs.id, job_run.started DESC"
+    cursor.execute(snapshot_query, [job_ids, userid])
+    jobs = cursor.fetchall()
+    digest = hashlib.sha1(json.dumps(jobs)).hexdigest()
+    return jobs, digest
+
+
+@app.route(URL_PREFIX + '/job/events')
+def get_job_events():
+    """
+    Wait until the state or number of tasks completed changes for one
+    of the jobs specified and then return the status of the jobs.  The
+    request returns immediately if the jobs have changed since the
+    snapshot given and is held open for up to timeout seconds otherwise
+
+    :return: a tuple with response_body, status
+    """
+    parameters = {'userid': str,
+                  'token': str,
+                  'jobids': str}
+    if not validate_parameters(parameters):
+        return flask_error_response(400, "Invalid or missing parameter")
+    try:
+        job_ids = [int(x) for x in flask.request.args['jobids'].split(',')]
+        timeout = int(flask.request.args.get('timeout', DEFAULT_EVENT_WAIT))
+    except ValueError:
+        return flask_error_response(400, "Invalid or missing parameter")
+    timeout = max(0, min(timeout, MAX_EVENT_WAIT))
+    snapshot = flask.request.args.get('snapshot')
+    userid, secret, timestamp = get_user_params()
+    if not validate_user(userid, secret, timestamp):
+        return flask_error_response(401, "Invalid username or password")
+    response = {'status': 200}
+    conn = get_db_client()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = conn.cursor()
+    try:
+        # listen before querying so that changes made in between
+        # aren't missed
+        cursor.execute("LISTEN {0};".format(JOB_EVENT_CHANNEL))
+        jobs, digest = get_job_snapshot(cursor, userid, job_ids)
+        if not jobs:
+            return flask_error_response(404, "Invalid workflow id")
+        deadline = time.time() + timeout
+        while digest == snapshot:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if select.select([conn], [], [], remaining) == ([], [], []):
+                break
+            conn.poll()
+            updated = False
+            while conn.notifies:
+                notification = conn.notifies.pop(0)
+                if notification.payload.isdigit() and \
+                   int(notification.payload) in job_ids:
+                    updated = True
+            if updated:
+                jobs, digest = get_job_snapshot(cursor, userid, job_ids)
+        response['jobs'] = [{'id': row[0],
+                             'job_status': row[1],
+                             'tasks_completed': row[2],
+                             'tasks': row[3]}
+                            for row in jobs]
+        response['snapshot'] = digest
+        response['changed'] = digest != snapshot
+    except Exception as e:
+        return flask_error_response(500,
+                                    "500 Server Error\n"
+                                    "Exception: {0}".format(e))
+    finally:
+        conn.close()
+    return flask.jsonify(response)
+
+
+def store_upload(fh, blob_dir):
+    """
+    Write an uploaded file to a temporary file in the blob directory,
+    computing the sha256 hash of the data as it is written
+
+    :param fh: file object with the uploaded data
+    :param blob_dir: path to the user's blob directory
+    :return: (path to temporary file, sha256 hex digest, size in bytes)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    temp_fd, temp_path = tempfile.mkstemp(dir=blob_dir, prefix='upload-')
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            while True:
+                chunk = fh.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                temp_file.write(chunk)
+        os.chmod(temp_path, 0o660)
+    except (IOError, OSError):
+        os.unlink(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+
 @app.route(URL_PREFIX + '/job/input', methods=['POST'])
 def get_input():
     """
-    Submit an input for a job to be processed
+    Submit an input for a job to be processed.  Inputs are stored once
+    per user by sha256 hash and linked into the job's input directory.
+    If the request has a sha256 parameter but no file, the input is
+    linked to previously uploaded content with that hash or a 404 is
+    returned if there isn't any so that the client can upload it
 
     :return: a tuple with response_body, status
     """
@@ -488,41 +1215,135 @@ def get_input():
                   'jobid': int}
     if not validate_parameters(parameters):
         return flask_error_response(400, "Invalid or missing parameter")
+    sha256 = flask.request.args.get('sha256', '').lower()
+    if sha256 and not SHA256_PATTERN.match(sha256):
+        return flask_error_response(400, "Invalid or missing parameter")
     userid, token, timestamp = get_user_params()
     if not validate_user(userid, token, timestamp):
         return flask_error_response(401, "Invalid username or password")
     # setup user directories if not present
-    user_dir = os.path.join(FREESURFER_BASE, userid)
-    if not os.path.exists(user_dir):
-        os.mkdir(user_dir, 0o770)
-    output_dir = os.path.join(user_dir, 'input')
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir, 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'results')):
-        os.mkdir(os.path.join(user_dir, 'results'), 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'output')):
-        os.mkdir(os.path.join(user_dir, 'output'), 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'workflows')):
-        os.mkdir(os.path.join(user_dir, 'workflows'), 0o770)
-    conn = get_db_client()
+    output_dir = setup_user_dirs(userid)
+    blob_dir = os.path.join(output_dir, fsurfer.layout.BLOB_DIR)
+    # requests without a body are checking for stored inputs and
+    # aren't subject to upload limits
+    upload_size = flask.request.content_length or 0
+    if upload_size:
+        wait = UPLOAD_ADMISSION.acquire(userid, upload_size)
+        if wait:
+            response = flask_error_response(429,
+                                            "Too many uploads in progress, "
+                                            "retry later")
+            response.headers['Retry-After'] = str(int(math.ceil(wait)))
+            return response
+    try:
+        conn = get_db_client()
+    except psycopg2.Error as e:
+        if upload_size:
+            UPLOAD_ADMISSION.release(userid)
+        return flask_error_response(500,
+                                    "500 Server Error\n"
+                                    "Exception: {0}".format(e))
     cursor = conn.cursor()
+    blob_link = "UPDATE freesurfer_interface.input_blobs " \
+                "SET ref_count = ref_count + 1 " \
+                "WHERE username = %s AND sha256 = %s " \
+                "RETURNING path"
+    blob_insert = "INSERT INTO freesurfer_interface.input_blobs(username," \
+                  "                                             sha256," \
+                  "                                             path," \
+                  "                                             size," \
+                  "                                             ref_count)" \
+                  "VALUES(%s, %s, %s, %s, 1) " \
+                  "ON CONFLICT (username, sha256) DO UPDATE " \
+                  "SET ref_count = input_blobs.ref_count + 1 " \
+                  "RETURNING path"
     input_insert = "INSERT INTO freesurfer_interface.input_files(filename," \
                    "                                             path," \
                    "                                             job_id," \
-                   "                                             subject_dir)" \
-                   "VALUES(%s, %s, %s, %s)"
+                   "                                             subject_dir," \
+                   "                                             sha256)" \
+                   "VALUES(%s, %s, %s, %s, %s)" \
+                   "RETURNING id"
+    input_query = "SELECT sha256 " \
+                  "FROM freesurfer_interface.input_files " \
+                  "WHERE job_id = %s AND filename = %s AND NOT purged " \
+                  "FOR UPDATE"
+    temp_path = None
+    stored_path = None
     try:
-        temp_dir = tempfile.mkdtemp(dir=output_dir)
+        start = time.time()
+        fh = flask.request.files.get('input_file')
+        record_phase('upload', time.time() - start)
+        if fh is None:
+            if not sha256:
+                return flask_error_response(400,
+                                            "Invalid or missing parameter")
+            cursor.execute(blob_link, [userid, sha256])
+            row = cursor.fetchone()
+            if row is None or not os.path.isfile(row[0]):
+                conn.rollback()
+                return flask_error_response(404,
+                                            "Input not stored, upload needed")
+            blob_path = row[0]
+            response['uploaded'] = False
+        else:
+            start = time.time()
+            temp_path, digest, size = store_upload(fh.stream, blob_dir)
+            record_phase('fs', time.time() - start)
+            if sha256 and sha256 != digest:
+                return flask_error_response(400,
+                                            "Uploaded data does not match "
+                                            "sha256 hash")
+            sha256 = digest
+            cursor.execute(blob_insert,
+                           [userid,
+                            sha256,
+                            fsurfer.layout.get_blob_path(output_dir, sha256),
+                            size])
+            blob_path = cursor.fetchone()[0]
+            start = time.time()
+            if os.path.isfile(blob_path):
+                # content already stored
+                os.unlink(temp_path)
+            else:
+                fsurfer.layout.make_dir(os.path.dirname(blob_path))
+                os.rename(temp_path, blob_path)
+                stored_path = blob_path
+            temp_path = None
+            record_phase('fs', time.time() - start)
+            response['uploaded'] = True
+        # a retry of an upload whose response was lost shouldn't add
+        # the input to the workflow again
+        cursor.execute(input_query, [flask.request.args['jobid'],
+                                     flask.request.args['filename']])
+        row = cursor.fetchone()
+        if row is not None:
+            conn.rollback()
+            if stored_path is not None:
+                # the blob entry for the new content was rolled back
+                os.unlink(stored_path)
+            if row[0] != sha256:
+                return flask_error_response(409,
+                                            "A different input with this "
+                                            "name was already uploaded")
+            return flask.jsonify(response)
+        start = time.time()
+        temp_dir = make_input_dir(userid,
+                                  output_dir,
+                                  flask.request.args['jobid'])
         input_file = os.path.join(temp_dir,
                                   flask.request.args['filename'])
-        fh = flask.request.files['input_file']
-        fh.save(input_file)
+        os.link(blob_path, input_file)
+        record_phase('fs', time.time() - start)
         cursor.execute(input_insert,
                        [flask.request.args['filename'],
                         input_file,
                         flask.request.args['jobid'],
-                        flask.request.args['subjectdir']])
-
+                        flask.request.args['subjectdir'],
+                        sha256])
+        # let the validation daemon know about the input
+        cursor.execute("SELECT pg_notify(%s, %s)",
+                       [INPUT_EVENT_CHANNEL, str(cursor.fetchone()[0])])
         conn.commit()
     except Exception, e:
         conn.rollback()
@@ -530,6 +1351,10 @@ def get_input():
                                     "500 Server Error\n"
                                     "Exception: {0}".format(e))
     finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.unlink(temp_path)
+        if upload_size:
+            UPLOAD_ADMISSION.release(userid)
         conn.close()
     return flask.jsonify(response)
 
@@ -557,18 +1382,7 @@ def submit_job():
     if not validate_user(userid, token, timestamp):
         return flask_error_response(401, "Invalid username or password")
     # setup user directories if not present
-    user_dir = os.path.join(FREESURFER_BASE, userid)
-    if not os.path.exists(user_dir):
-        os.mkdir(user_dir, 0o770)
-    output_dir = os.path.join(user_dir, 'input')
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir, 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'results')):
-        os.mkdir(os.path.join(user_dir, 'results'), 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'output')):
-        os.mkdir(os.path.join(user_dir, 'output'), 0o770)
-    if not os.path.exists(os.path.join(user_dir, 'workflows')):
-        os.mkdir(os.path.join(user_dir, 'workflows'), 0o770)
+    setup_user_dirs(userid)
     conn = get_db_client()
     cursor = conn.cursor()
     job_insert = "INSERT INTO freesurfer_interface.jobs(name," \
@@ -603,6 +1417,99 @@ def submit_job():
     return flask.jsonify(response)
 
 
+def validate_batch_jobs(jobs):
+    """
+    Check the job descriptions given in a batch submission
+
+    :param jobs: list of dictionaries describing jobs to create
+    :return: true or false depending on whether the jobs are valid
+    """
+    if not isinstance(jobs, list) or not jobs or len(jobs) > MAX_BATCH_JOBS:
+        return False
+    for job in jobs:
+        if not isinstance(job, dict):
+            return False
+        for key, val in BATCH_JOB_PARAMETERS.iteritems():
+            if key not in job:
+                return False
+            if val == int and (isinstance(job[key], bool) or
+                               not isinstance(job[key], int)):
+                return False
+            elif val == bool and not isinstance(job[key], bool):
+                return False
+            elif val == str and not isinstance(job[key], basestring):
+                return False
+    return True
+
+
+@app.route(URL_PREFIX + '/job/batch', methods=['POST'])
+def submit_jobs():
+    """
+    Submit several jobs to be processed in a single transaction, the
+    jobs are given as a JSON object in the request body
+
+    :return: a tuple with response_body, status
+    """
+    response = {"status": 200,
+                "result": "success"}
+    parameters = {'userid': str,
+                  'token': str}
+    if not validate_parameters(parameters):
+        return flask_error_response(400, "Invalid or missing parameter")
+    userid, token, timestamp = get_user_params()
+    if not validate_user(userid, token, timestamp):
+        return flask_error_response(401, "Invalid username or password")
+    body = flask.request.get_json(force=True, silent=True)
+    if body is None or not validate_batch_jobs(body.get('jobs')):
+        return flask_error_response(400, "Invalid or missing job list")
+    # setup user directories if not present
+    setup_user_dirs(userid)
+    conn = get_db_client()
+    cursor = conn.cursor()
+    id_query = "SELECT nextval(pg_get_serial_sequence(" \
+               "                 'freesurfer_interface.jobs', 'id')) " \
+               "FROM generate_series(1, %s)"
+    job_insert = "INSERT INTO freesurfer_interface.jobs(id," \
+                 "                                      name," \
+                 "                                      state," \
+                 "                                      multicore," \
+                 "                                      username," \
+                 "                                      num_inputs," \
+                 "                                      options," \
+                 "                                      version," \
+                 "                                      subject)" \
+                 "VALUES {0}"
+    job_values = "(%s, %s, 'QUEUED', %s, %s, %s, %s, %s, %s)"
+    try:
+        # ids are allocated before the insert so each job's id is known
+        # without relying on the order of rows from RETURNING
+        cursor.execute(id_query, [len(body['jobs'])])
+        job_ids = [row[0] for row in cursor.fetchall()]
+        values = [cursor.mogrify(job_values, [job_id,
+                                              job['jobname'],
+                                              job['multicore'],
+                                              userid,
+                                              job['num_inputs'],
+                                              str(job.get('options')),
+                                              job['version'],
+                                              job['subject']])
+                  for job_id, job in zip(job_ids, body['jobs'])]
+        cursor.execute(job_insert.format(", ".join(values)))
+        # index is the position of the job in the request
+        response['jobs'] = [[job_id, job['subject'], index]
+                            for index, (job_id, job)
+                            in enumerate(zip(job_ids, body['jobs']))]
+        conn.commit()
+    except Exception, e:
+        conn.rollback()
+        return flask_error_response(500,
+                                    "500 Server Error\n"
+                                    "Exception: {0}".format(e))
+    finally:
+        conn.close()
+    return flask.jsonify(response)
+
+
 @app.route(URL_PREFIX + '/job/output')
 def get_job_output():
     """
@@ -623,7 +1530,7 @@ def get_job_output():
     output_dir = os.path.join(FREESURFER_BASE, userid, 'results')
     conn = get_db_client()
     cursor = conn.cursor()
-    job_query = "SELECT id, subject, state " \
+    job_query = "SELECT id, subject, state, output_sha1 " \
                 "FROM freesurfer_interface.jobs " \
                 "WHERE id = %s AND username = %s;"
     try:
@@ -643,10 +1550,28 @@ def get_job_output():
                                                                            row[1]))
             if os.path.isfile(output_filename):
                 filename = str(os.path.basename(output_filename))
-                return flask.send_file(output_filename,
-                                       mimetype="application/x-bzip2",
-                                       as_attachment=True,
-                                       attachment_filename=filename)
+                if row[3] is None:
+                    # conditional responses support range requests so
+                    # that clients can resume or split downloads
+                    return flask.send_file(output_filename,
+                                           mimetype="application/x-bzip2",
+                                           as_attachment=True,
+                                           attachment_filename=filename,
+                                           conditional=True)
+                # use the checksum from the worker as the etag and
+                # digest so clients can verify the output as they
+                # download it
+                output = flask.send_file(output_filename,
+                                         mimetype="application/x-bzip2",
+                                         as_attachment=True,
+                                         attachment_filename=filename,
+                                         add_etags=False)
+                output.set_etag(row[3])
+                output.headers['Digest'] = "SHA={0}".format(
+                    base64.b64encode(binascii.unhexlify(row[3])))
+                return output.make_conditional(flask.request,
+                                               accept_ranges=True,
+                                               complete_length=os.path.getsize(output_filename))
     except Exception, e:
         return flask_error_response(500,
                                     "500 Server Error\n"
@@ -657,6 +1582,186 @@ def get_job_output():
     return flask.jsonify(response)
 
 
+def find_output_member(archive, path, subject):
+    """
+    Find a file in the zip of a workflow's output, the path can be
+    given relative to the subject directory and symlinks are followed
+
+    :param archive: zipfile.ZipFile for the output
+    :param path: path of the file
+    :param subject: subject name for the workflow
+    :return: zipfile.ZipInfo for the file or None if it isn't present
+    """
+    path = posixpath.normpath(path.lstrip('/'))
+    for _ in range(MAX_SYMLINKS):
+        info = None
+        for name in (path, posixpath.join(subject, path)):
+            try:
+                info = archive.getinfo(name)
+                break
+            except KeyError:
+                continue
+        if info is None:
+            return None
+        if not stat.S_ISLNK(info.external_attr >> 16):
+            return info
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(info.filename),
+                                                 archive.read(info)))
+    return None
+
+
+def stream_output_member(zip_filename, member_name):
+    """
+    Generate the contents of a file in an output zip, the zip is only
+    opened once the response body is read
+
+    :param zip_filename: path to the output zip
+    :param member_name: name of the file in the zip
+    :return: generator yielding chunks of the file
+    """
+    archive = zipfile.ZipFile(zip_filename)
+    try:
+        member = archive.open(member_name)
+        while True:
+            data = member.read(OUTPUT_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+        member.close()
+    finally:
+        archive.close()
+
+
+@app.route(URL_PREFIX + '/job/output/files')
+def get_job_output_files():
+    """
+    List the files in the output from a job
+
+    :return: a tuple with response_body, status
+    """
+    response = {"status": 200,
+                "result": "success"}
+    parameters = {'userid': str,
+                  'token': str,
+                  'jobid': str}
+    if not validate_parameters(parameters):
+        return flask_error_response(400, "Invalid or missing parameter")
+    userid, token, timestamp = get_user_params()
+    if not validate_user(userid, token, timestamp):
+        return flask_error_response(401, "Invalid username or password")
+    output_dir = os.path.join(FREESURFER_BASE, userid, 'results')
+    conn = get_db_client()
+    cursor = conn.cursor()
+    job_query = "SELECT id, subject, state " \
+                "FROM freesurfer_interface.jobs " \
+                "WHERE id = %s AND username = %s;"
+    try:
+        cursor.execute(job_query, [flask.request.args['jobid'], userid])
+        row = cursor.fetchone()
+        if cursor.rowcount == 0:
+            return flask_error_response(404,
+                                        "Workflow not found")
+        elif row[2] != 'COMPLETED':
+            return flask_error_response(404,
+                                        "Workflow does not have any output to "
+                                        "download")
+        zip_filename = os.path.join(output_dir,
+                                    "{0}_{1}_output.zip".format(row[0],
+                                                                row[1]))
+        if not os.path.isfile(zip_filename):
+            return flask_error_response(404,
+                                        "Files in the output aren't "
+                                        "available, download the full output")
+        files = []
+        archive = zipfile.ZipFile(zip_filename)
+        try:
+            for info in archive.infolist():
+                entry = {'path': info.filename,
+                         'size': info.file_size}
+                if stat.S_ISLNK(info.external_attr >> 16):
+                    entry['link'] = archive.read(info)
+                files.append(entry)
+        finally:
+            archive.close()
+        response['subject'] = row[1]
+        response['files'] = files
+    except Exception, e:
+        return flask_error_response(500,
+                                    "500 Server Error\n"
+                                    "Exception: {0}".format(e))
+    finally:
+        conn.commit()
+        conn.close()
+    return flask.jsonify(response)
+
+
+@app.route(URL_PREFIX + '/job/output/file')
+def get_job_output_file():
+    """
+    Return a single file from the output of a job
+
+    :return: a tuple with response_body, status
+    """
+    parameters = {'userid': str,
+                  'token': str,
+                  'jobid': str,
+                  'path': str}
+    if not validate_parameters(parameters):
+        return flask_error_response(400, "Invalid or missing parameter")
+    userid, token, timestamp = get_user_params()
+    if not validate_user(userid, token, timestamp):
+        return flask_error_response(401, "Invalid username or password")
+    output_dir = os.path.join(FREESURFER_BASE, userid, 'results')
+    conn = get_db_client()
+    cursor = conn.cursor()
+    job_query = "SELECT id, subject, state " \
+                "FROM freesurfer_interface.jobs " \
+                "WHERE id = %s AND username = %s;"
+    try:
+        cursor.execute(job_query, [flask.request.args['jobid'], userid])
+        row = cursor.fetchone()
+        if cursor.rowcount == 0:
+            return flask_error_response(404,
+                                        "Workflow not found")
+        elif row[2] != 'COMPLETED':
+            return flask_error_response(404,
+                                        "Workflow does not have any output to "
+                                        "download")
+        zip_filename = os.path.join(output_dir,
+                                    "{0}_{1}_output.zip".format(row[0],
+                                                                row[1]))
+        if not os.path.isfile(zip_filename):
+            return flask_error_response(404,
+                                        "Files in the output aren't "
+                                        "available, download the full output")
+        archive = zipfile.ZipFile(zip_filename)
+        try:
+            info = find_output_member(archive,
+                                      flask.request.args['path'],
+                                      row[1])
+        finally:
+            archive.close()
+        if info is None:
+            return flask_error_response(404,
+                                        "File not found in workflow output")
+        filename = str(posixpath.basename(info.filename))
+        output = flask.Response(stream_output_member(zip_filename,
+                                                     info.filename),
+                                mimetype='application/octet-stream',
+                                direct_passthrough=True)
+        output.headers['Content-Length'] = str(info.file_size)
+        output.headers['Content-Disposition'] = \
+            'attachment; filename="{0}"'.format(filename)
+        return output
+    except Exception, e:
+        return flask_error_response(500,
+                                    "500 Server Error\n"
+                                    "Exception: {0}".format(e))
+    finally:
+        conn.commit()
+        conn.close()
+
+
 @app.route(URL_PREFIX + '/job/log')
 def get_job_log():
     """
@@ -686,7 +1791,8 @@ def get_job_log():
         if cursor.rowcount == 0:
             return flask_error_response(404,
                                         "Workflow not found")
-        elif row[2] != 'COMPLETED':
+        elif row[2] not in ('COMPLETED', 'FAILED'):
+            # logs for failed workflows are recovered when they finish
             return flask_error_response(404,
                                         "Workflow does not have any logs to "
                                         "download")
@@ -698,7 +1804,11 @@ def get_job_log():
                 return flask.send_file(output_filename,
                                        mimetype="text/plain",
                                        as_attachment=True,
-                                       attachment_filename=filename)
+                                       attachment_filename=filename,
+                                       conditional=True)
+            return flask_error_response(404,
+                                        "Workflow does not have any logs to "
+                                        "download")
     except Exception as e:
         return flask_error_response(500,
                                     "500 Server Error\n"